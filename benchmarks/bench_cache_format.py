@@ -0,0 +1,78 @@
+"""Benchmark the results cache value formats against the gzipped json that was written before the header byte.
+
+Usage:
+    python benchmarks/bench_cache_format.py [recorded_answer.json ...]
+
+Pass final answers as returned by /aragorn/query.  Without arguments a synthetic answer of about the size of a big
+creative mode answer is used.  Formats whose library isn't installed are skipped.
+"""
+import gc
+import gzip
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from src import cache_format  # noqa: E402
+from src.service_aggregator import clean_message  # noqa: E402
+from bench_clean_message import synthetic_response  # noqa: E402
+
+FORMATS = [
+    ("gzip", "json", None),
+    ("gzip", "json", 1),
+    ("zstd", "json", None),
+    ("zstd", "msgpack", None),
+    ("lz4", "json", None),
+    ("lz4", "msgpack", None),
+    ("none", "msgpack", None),
+]
+
+
+def legacy_encode(answer):
+    return gzip.compress(json.dumps(answer).encode())
+
+
+def best_of(func, arg, repeat=3):
+    best = None
+    for _ in range(repeat):
+        result = None
+        # like timeit, keep the collector from walking the answers already in memory
+        gc.disable()
+        start = time.perf_counter()
+        result = func(arg)
+        elapsed = time.perf_counter() - start
+        gc.enable()
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def report(label, answer, encode, decode):
+    encode_time, value = best_of(encode, answer)
+    decode_time, decoded = best_of(decode, value)
+    assert decoded == answer
+    print(f"  {label:<28} {len(value) / 1e6:8.2f} MB {encode_time * 1000:10.1f} ms {decode_time * 1000:10.1f} ms")
+
+
+def main(paths):
+    if paths:
+        answers = [(path, json.load(open(path))) for path in paths]
+    else:
+        answers = [("synthetic", clean_message(synthetic_response(50000)))]
+    for name, answer in answers:
+        print(f"{name}: {len(json.dumps(answer)) / 1e6:.1f} MB of json")
+        print(f"  {'format':<28} {'size':>11} {'encode':>13} {'decode':>13}")
+        report("legacy gzip+json", answer, legacy_encode, cache_format.decode_value)
+        for compression, serializer, level in FORMATS:
+            label = f"{compression}+{serializer}" + ("" if level is None else f" level {level}")
+            try:
+                cache_format.encode_value({}, compression, serializer)
+            except cache_format.CacheFormatError:
+                print(f"  {label:<28} not installed")
+                continue
+            report(label, answer, lambda a: cache_format.encode_value(a, compression, serializer, level),
+                   cache_format.decode_value)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,100 @@
+"""Benchmark clean_message against the recursive async de_noneify + to_jsonable_dict pair it replaced.
+
+Usage:
+    python benchmarks/bench_clean_message.py [recorded_response.json ...]
+
+Pass strider responses recorded with DUMPTRUCK = True in service_aggregator (saved as <guid>_<n>.json).  Without
+arguments a synthetic response of about the same shape as a big multistrider rule response is used.
+"""
+import asyncio
+import json
+import os
+import random
+import sys
+import time
+
+import pydantic.json
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from src.service_aggregator import clean_message  # noqa: E402
+
+JSONABLE_TYPES = (dict, list, tuple, str, int, float, bool, type(None))
+
+
+async def de_noneify(message):
+    if isinstance(message, dict):
+        keys_to_remove = []
+        for key, value in message.items():
+            if value is None:
+                keys_to_remove.append(key)
+            else:
+                await de_noneify(value)
+        for key in keys_to_remove:
+            del message[key]
+    elif isinstance(message, list):
+        for item in message:
+            await de_noneify(item)
+
+
+async def to_jsonable_dict(obj):
+    if isinstance(obj, dict):
+        return {key: await to_jsonable_dict(value) for key, value in obj.items()}
+    elif isinstance(obj, list):
+        return [await to_jsonable_dict(value) for value in obj]
+    elif isinstance(obj, tuple):
+        return tuple(await to_jsonable_dict(value) for value in obj)
+    elif isinstance(obj, JSONABLE_TYPES):
+        return obj
+    return pydantic.json.pydantic_encoder(obj)
+
+
+async def old_clean(message):
+    await de_noneify(message)
+    return await to_jsonable_dict(message)
+
+
+def synthetic_response(n_results=20000, seed=0):
+    rng = random.Random(seed)
+    nodes = {f"CHEBI:{i}": {"name": f"chem {i}", "categories": ["biolink:ChemicalEntity"], "is_set": None,
+                            "attributes": [{"attribute_type_id": "biolink:same_as", "value": [f"X:{i}"], "value_type_id": None}]}
+             for i in range(n_results // 4)}
+    edges = {}
+    results = []
+    for r in range(n_results):
+        chem = f"CHEBI:{rng.randrange(len(nodes))}"
+        eid = f"e{r}"
+        edges[eid] = {"subject": chem, "object": "MONDO:1", "predicate": "biolink:treats", "qualifiers": None,
+                      "attributes": [{"attribute_type_id": "biolink:knowledge_level", "value": "prediction", "attributes": None}],
+                      "sources": [{"resource_id": "infores:kg", "resource_role": "primary_knowledge_source", "upstream_resource_ids": None}]}
+        results.append({"node_bindings": {"chemical": [{"id": chem, "query_id": None}], "disease": [{"id": "MONDO:1"}]},
+                        "analyses": [{"resource_id": "infores:aragorn", "score": None, "edge_bindings": {"e0": [{"id": eid}]}}]})
+    return {"message": {"query_graph": {"nodes": {}, "edges": {}}, "knowledge_graph": {"nodes": nodes, "edges": edges},
+                        "results": results, "auxiliary_graphs": None}, "logs": []}
+
+
+def timed(label, func, content, repeat=3):
+    best = None
+    for _ in range(repeat):
+        message = json.loads(content)
+        start = time.perf_counter()
+        result = func(message)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    print(f"  {label:<40} {best * 1000:10.1f} ms")
+    return result
+
+
+def main(paths):
+    if paths:
+        contents = [(path, open(path, "rb").read()) for path in paths]
+    else:
+        contents = [("synthetic", json.dumps(synthetic_response()).encode())]
+    for name, content in contents:
+        print(f"{name}: {len(content) / 1e6:.1f} MB")
+        old = timed("de_noneify + to_jsonable_dict (async)", lambda m: asyncio.run(old_clean(m)), content)
+        new = timed("clean_message", clean_message, content)
+        assert old == new
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,143 @@
+"""Benchmark remove_kgraph_orphans against the recursive version it replaced.
+
+Usage:
+    python benchmarks/bench_filter_kgraph_orphans.py [recorded_response.json ...]
+
+Each response has its results cut to the top 500, as filter_message_top_n does for infer queries, and then its
+orphans removed.  Without arguments a synthetic infer answer with 5,000 results is used, whose creative edges are
+supported by two hop rule paths through a shared pool of lookup edges, some of which have support graphs of their own.
+"""
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from src.operations import remove_kgraph_orphans  # noqa: E402
+
+TOP_N = 500
+
+
+def old_get_edge_support_graphs(edge, edges, auxgraphs, message_edges, message_auxgraphs, nodes, guid):
+    edges.add(edge)
+    nodes.add(message_edges[edge]["subject"])
+    nodes.add(message_edges[edge]["object"])
+    for attribute in message_edges.get(edge, {}).get('attributes', {}):
+        if attribute.get('attribute_type_id', None) == 'biolink:support_graphs':
+            for auxgraph in attribute.get('value', []):
+                if auxgraph not in message_auxgraphs:
+                    raise KeyError(f"{guid}: auxgraph {auxgraph} not in auxiliary_graphs")
+                edges, auxgraphs, nodes = old_get_auxgraph_edges(auxgraph, edges, auxgraphs, message_edges, message_auxgraphs, nodes, guid)
+    return edges, auxgraphs, nodes
+
+
+def old_get_auxgraph_edges(auxgraph, edges, auxgraphs, message_edges, message_auxgraphs, nodes, guid):
+    auxgraphs.add(auxgraph)
+    for aux_edge in message_auxgraphs.get(auxgraph, {}).get('edges', []):
+        if aux_edge not in message_edges:
+            raise KeyError(f"{guid}: aux_edge {aux_edge} not in knowledge_graph.edges")
+        edges, auxgraphs, nodes = old_get_edge_support_graphs(aux_edge, edges, auxgraphs, message_edges, message_auxgraphs, nodes, guid)
+    return edges, auxgraphs, nodes
+
+
+def old_remove_kgraph_orphans(message, guid):
+    kg_edges = message['message']['knowledge_graph']['edges']
+    message_auxgraphs = message["message"].get("auxiliary_graphs", {})
+    nodes, edges, auxgraphs, temp_auxgraphs, temp_edges = set(), set(), set(), set(), set()
+    for result in message['message']['results']:
+        for knodes in result.get('node_bindings', {}).values():
+            nodes.update(k['id'] for k in knodes)
+        for analysis in result.get('analyses', []):
+            for kedges in analysis.get('edge_bindings', {}).values():
+                temp_edges.update(k['id'] for k in kedges)
+            for path_graphs in analysis.get('path_bindings', {}).values():
+                temp_auxgraphs.update(a["id"] for a in path_graphs)
+            temp_auxgraphs.update(analysis.get('support_graphs', []))
+    for edge in temp_edges:
+        edges, auxgraphs, nodes = old_get_edge_support_graphs(edge, edges, auxgraphs, kg_edges, message_auxgraphs, nodes, guid)
+    for auxgraph in temp_auxgraphs:
+        edges, auxgraphs, nodes = old_get_auxgraph_edges(auxgraph, edges, auxgraphs, kg_edges, message_auxgraphs, nodes, guid)
+    kg = message['message']['knowledge_graph']
+    kg['nodes'] = {nid: ndata for nid, ndata in kg['nodes'].items() if nid in nodes}
+    kg['edges'] = {eid: edata for eid, edata in kg_edges.items() if eid in edges}
+    message["message"]["auxiliary_graphs"] = {a: adata for a, adata in message_auxgraphs.items() if a in auxgraphs}
+    return message, 200
+
+
+def support_attribute(auxgraph_ids):
+    return {"attribute_type_id": "biolink:support_graphs", "value": auxgraph_ids}
+
+
+def synthetic_answer(n_results=5000, n_intermediates=500, n_rules=20, seed=0):
+    rng = random.Random(seed)
+    disease = "MONDO:1"
+    nodes = {disease: {"categories": ["biolink:Disease"]}}
+    nodes.update((f"NCBIGene:{i}", {"categories": ["biolink:Gene"]}) for i in range(n_intermediates))
+    edges = {}
+    auxgraphs = {}
+
+    def lookup_edge(subject, object):
+        edge_id = f"{subject}-{object}"
+        if edge_id not in edges:
+            edges[edge_id] = {"subject": subject, "object": object, "predicate": "biolink:related_to", "attributes": []}
+            # some lookup edges are themselves inferred from a subclass, with support of their own
+            if rng.random() < 0.2:
+                parent = f"NCBIGene:{rng.randrange(n_intermediates)}"
+                subclass_edge = f"{subject}-{parent}"
+                edges.setdefault(subclass_edge, {"subject": subject, "object": parent, "predicate": "biolink:subclass_of", "attributes": []})
+                auxgraph_id = f"subclass_{edge_id}"
+                auxgraphs[auxgraph_id] = {"edges": [subclass_edge], "attributes": []}
+                edges[edge_id]["attributes"].append(support_attribute([auxgraph_id]))
+        return edge_id
+
+    results = []
+    for r in range(n_results):
+        chemical = f"CHEBI:{r}"
+        nodes[chemical] = {"categories": ["biolink:ChemicalEntity"]}
+        support = []
+        for rule in rng.sample(range(n_rules), 3):
+            gene = f"NCBIGene:{rng.randrange(n_intermediates)}"
+            auxgraph_id = f"{chemical}_{rule}"
+            auxgraphs[auxgraph_id] = {"edges": [lookup_edge(chemical, gene), lookup_edge(gene, disease)], "attributes": []}
+            support.append(auxgraph_id)
+        creative_edge = f"creative_{r}"
+        edges[creative_edge] = {"subject": chemical, "object": disease, "predicate": "biolink:treats",
+                                "attributes": [support_attribute(support)]}
+        results.append({"node_bindings": {"chemical": [{"id": chemical}], "disease": [{"id": disease}]},
+                        "analyses": [{"resource_id": "infores:aragorn", "score": rng.random(),
+                                      "edge_bindings": {"treats": [{"id": creative_edge}]}}]})
+    return {"message": {"query_graph": {"nodes": {}, "edges": {}},
+                        "knowledge_graph": {"nodes": nodes, "edges": edges},
+                        "auxiliary_graphs": auxgraphs, "results": results}}
+
+
+def timed(label, func, content, repeat=5):
+    best = None
+    for _ in range(repeat):
+        message = json.loads(content)
+        message["message"]["results"] = message["message"]["results"][:TOP_N]
+        start = time.perf_counter()
+        result, status = func(message, "bench")
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    print(f"  {label:<40} {best * 1000:10.1f} ms")
+    return result
+
+
+def main(paths):
+    if paths:
+        contents = [(path, open(path, "rb").read()) for path in paths]
+    else:
+        contents = [("synthetic", json.dumps(synthetic_answer()).encode())]
+    for name, content in contents:
+        message = json.loads(content)["message"]
+        print(f"{name}: {len(message['results'])} results, {len(message['knowledge_graph']['edges'])} edges, "
+              f"{len(message['auxiliary_graphs'] or {})} aux graphs, keeping the first {TOP_N} results")
+        old = timed("recursive", old_remove_kgraph_orphans, content)
+        new = timed("remove_kgraph_orphans", remove_kgraph_orphans, content)
+        assert old == new
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,165 @@
+"""Benchmark merge_results_by_node against the version it replaced, which compared edge sets against a list,
+de-duplicated node bindings by their json, and gave every aux graph and inferred edge a uuid4.
+
+Usage:
+    python benchmarks/bench_merge_results.py
+
+A synthetic infer answer is used: 5,000 answers, each with 1-12 creative results through a shared pool of
+intermediate nodes, and about a third of them with direct lookup results too.  The two outputs are checked to be the
+same, up to the ids of the new aux graphs and inferred edges.
+"""
+import json
+import os
+import random
+import re
+import sys
+import time
+import uuid
+from collections import defaultdict
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from src.service_aggregator import get_edgeset, group_results_by_qnode, merge_results_by_node  # noqa: E402
+
+
+def old_create_aux_graph(analysis):
+    aux_graph_id = str(uuid.uuid4())
+    aux_graph = {"edges": [], "attributes": []}
+    for edgelist in analysis["edge_bindings"].values():
+        for edge in edgelist:
+            aux_graph["edges"].append(edge["id"])
+    return aux_graph_id, aux_graph
+
+
+def old_add_knowledge_edge(result_message, aux_graph_ids, answer, robokop):
+    query_graph = result_message["message"]["query_graph"]
+    qedge_id, qedge = next(iter(query_graph["edges"].items()))
+    if query_graph["nodes"][qedge["subject"]].get("ids") is not None:
+        qnode_subject, qnode_object = query_graph["nodes"][qedge["subject"]]["ids"][0], answer
+    else:
+        qnode_subject, qnode_object = answer, query_graph["nodes"][qedge["object"]]["ids"][0]
+    if qedge.get("qualifier_constraints"):
+        qualifiers = qedge["qualifier_constraints"][0]["qualifier_set"]
+    else:
+        qualifiers = None
+    new_edge_id = str(uuid.uuid4())
+    source = "infores:robokop" if robokop else "infores:aragorn"
+    new_edge = {
+        "subject": qnode_subject, "object": qnode_object, "predicate": qedge["predicates"][0],
+        "attributes": [
+            {"attribute_type_id": "biolink:support_graphs", "value": aux_graph_ids},
+            {"attribute_type_id": "biolink:agent_type", "value": "computational_model", "attribute_source": source},
+            {"attribute_type_id": "biolink:knowledge_level", "value": "prediction", "attribute_source": source},
+        ],
+        "sources": [{"resource_id": source, "resource_role": "primary_knowledge_source"}],
+    }
+    if qualifiers is not None:
+        new_edge["qualifiers"] = qualifiers
+    result_message["message"]["knowledge_graph"]["edges"][new_edge_id] = new_edge
+    return new_edge_id
+
+
+def old_merge_answer(result_message, answer, results, qnode_ids, robokop=False):
+    lookup_edgesets = [get_edgeset(result) for result in results["lookup"]]
+    creative_edgesets = set()
+    creative_results = []
+    for result in results["creative"]:
+        creative_edges = get_edgeset(result)
+        if creative_edges in lookup_edgesets or creative_edges in creative_edgesets:
+            continue
+        creative_edgesets.add(creative_edges)
+        creative_results.append(result)
+    results["creative"] = creative_results
+    mergedresult = {"node_bindings": {}, "analyses": []}
+    serkeys = defaultdict(set)
+    for q in qnode_ids:
+        mergedresult["node_bindings"][q] = []
+        for result in results["creative"] + results["lookup"]:
+            for nb in result["node_bindings"][q]:
+                serialized_binding = json.dumps(nb, sort_keys=True)
+                if serialized_binding not in serkeys[q]:
+                    mergedresult["node_bindings"][q].append(nb)
+                    serkeys[q].add(serialized_binding)
+    aux_graph_ids = []
+    if result_message["message"].get("auxiliary_graphs") is None:
+        result_message["message"]["auxiliary_graphs"] = {}
+    for result in results["creative"]:
+        for analysis in result["analyses"]:
+            aux_graph_id, aux_graph = old_create_aux_graph(analysis)
+            result_message["message"]["auxiliary_graphs"][aux_graph_id] = aux_graph
+            aux_graph_ids.append(aux_graph_id)
+    knowledge_edge_ids = []
+    if len(aux_graph_ids) > 0:
+        for nid in answer:
+            knowledge_edge_ids.append(old_add_knowledge_edge(result_message, aux_graph_ids, nid, robokop))
+    qedge_id = list(result_message["message"]["query_graph"]["edges"].keys())[0]
+    source = "infores:robokop" if robokop else "infores:aragorn"
+    analysis = {"resource_id": source, "edge_bindings": {qedge_id: [{"id": kid, "attributes": []} for kid in knowledge_edge_ids]}}
+    mergedresult["analyses"].append(analysis)
+    for result in results["lookup"]:
+        for analysis in result["analyses"]:
+            for qedge in analysis["edge_bindings"]:
+                mergedresult["analyses"][0]["edge_bindings"].setdefault(qedge, []).extend(analysis["edge_bindings"][qedge])
+    return mergedresult
+
+
+def old_merge_results_by_node(result_message, merge_qnode, lookup_results, robokop=False):
+    grouped_results = group_results_by_qnode(merge_qnode, result_message, lookup_results)
+    original_qnodes = result_message["message"]["query_graph"]["nodes"].keys()
+    result_message["message"]["results"] = [old_merge_answer(result_message, r, grouped_results[r], original_qnodes, robokop)
+                                            for r in grouped_results]
+    return result_message
+
+
+def synthetic_answer(n_answers=5000, n_intermediates=300, seed=0):
+    rng = random.Random(seed)
+    query_graph = {"nodes": {"input": {"ids": ["MONDO:1"]}, "output": {"categories": ["biolink:ChemicalEntity"]}},
+                   "edges": {"e": {"subject": "output", "object": "input", "predicates": ["biolink:treats"]}}}
+    results = []
+    lookup_results = []
+    for a in range(n_answers):
+        answer = f"CHEBI:{a}"
+        for _ in range(rng.randint(1, 12)):
+            gene = f"NCBIGene:{rng.randrange(n_intermediates)}"
+            results.append({"node_bindings": {"input": [{"id": "MONDO:1", "attributes": []}], "output": [{"id": answer, "attributes": []}],
+                                              "i": [{"id": gene, "attributes": []}]},
+                            "analyses": [{"resource_id": "infores:kp", "edge_bindings": {"e0": [{"id": f"{answer}-{gene}", "attributes": []}],
+                                                                                         "e1": [{"id": f"{gene}-MONDO:1", "attributes": []}]}}]})
+        if rng.random() < 0.3:
+            for n in range(rng.randint(1, 3)):
+                lookup_results.append({"node_bindings": {"input": [{"id": "MONDO:1", "attributes": []}], "output": [{"id": answer, "attributes": []}]},
+                                       "analyses": [{"resource_id": "infores:kp", "edge_bindings": {"e": [{"id": f"lookup-{answer}-{n}", "attributes": []}]}}]})
+    message = {"message": {"query_graph": query_graph, "knowledge_graph": {"nodes": {}, "edges": {}}, "results": results, "auxiliary_graphs": {}}}
+    return json.dumps(message), lookup_results
+
+
+def renumbered(message, new_ids):
+    """The message's json, with the new ids numbered in the order they first appear."""
+    content = json.dumps(message)
+    numbers = {}
+    return re.sub(new_ids, lambda match: f"new_{numbers.setdefault(match.group(0), len(numbers))}", content)
+
+
+def timed(label, func, content, lookup_results, repeat=3):
+    best = None
+    for _ in range(repeat):
+        message = json.loads(content)
+        lookups = json.loads(json.dumps(lookup_results))
+        start = time.perf_counter()
+        merged = func(message, "output", lookups)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    print(f"  {label:<40} {best * 1000:10.1f} ms")
+    return merged
+
+
+def main():
+    content, lookup_results = synthetic_answer()
+    print(f"synthetic: {len(json.loads(content)['message']['results'])} creative results, {len(lookup_results)} lookup results")
+    old = timed("merge_results_by_node (old)", old_merge_results_by_node, content, lookup_results)
+    new = timed("merge_results_by_node", merge_results_by_node, content, lookup_results)
+    uuid_ids = r"[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}"
+    assert renumbered(old, uuid_ids) == renumbered(new, r"[0-9a-f]{32}")
+
+
+if __name__ == "__main__":
+    main()
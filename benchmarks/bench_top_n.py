@@ -0,0 +1,53 @@
+"""Benchmark top_n_results against sorting every result and slicing, as sort_results_score + filter_results_top_n did.
+
+Usage:
+    python benchmarks/bench_top_n.py
+
+Synthetic result lists of infer answer sizes, each result with a few analyses, with many tied scores, cut to the
+infer workflow's max_results.
+"""
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from src.operations import top_n_results  # noqa: E402
+
+MAX_RESULTS = 500
+
+
+def synthetic_results(n_results, seed=0):
+    rng = random.Random(seed)
+    return [{"node_bindings": {"chemical": [{"id": f"CHEBI:{i}"}]},
+             # rounded, so that there are plenty of ties
+             "analyses": [{"resource_id": "infores:aragorn", "score": round(rng.random(), 3)} for _ in range(rng.randint(1, 4))]}
+            for i in range(n_results)]
+
+
+def sort_and_slice(results, n):
+    return sorted(results, key=lambda x: max([y.get('score', 0) for y in x['analyses']]), reverse=True)[:n]
+
+
+def timed(label, func, results, repeat=5):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        picked = func(results, MAX_RESULTS)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    print(f"  {label:<40} {best * 1000:10.1f} ms")
+    return picked
+
+
+def main():
+    for n_results in [5000, 20000, 50000]:
+        results = synthetic_results(n_results)
+        print(f"{n_results} results, keeping {MAX_RESULTS}")
+        old = timed("sorted()[:n]", sort_and_slice, results)
+        new = timed("top_n_results", top_n_results, results)
+        assert [id(r) for r in old] == [id(r) for r in new]
+
+
+if __name__ == "__main__":
+    main()
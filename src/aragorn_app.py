@@ -3,12 +3,10 @@ import os
 import logging.config
 import pkg_resources
 import yaml
-import aio_pika
-import random
-import string
 
 # from pamqp import specification as spec
 from enum import Enum
+from typing import Optional
 from reasoner_pydantic import Query as PDQuery, AsyncQuery as PDAsyncQuery, Response as PDResponse, AsyncQueryResponse, AsyncQueryStatusResponse
 from pydantic import BaseModel
 from fastapi import Body, FastAPI, BackgroundTasks, Path, HTTPException
@@ -17,10 +15,12 @@ from src.common import async_query, sync_query, status_query
 from src.default_queries import default_input_sync, default_input_async
 from src.otel_config import configure_otel
 from src.results_cache import ResultsCache
+from src.callback_transport import get_callback_transport
+from src.json_codec import TRAPIJSONResponse
 
 # declare the FastAPI details
 title = "ARAGORN"
-ARAGORN_APP = FastAPI(title=title)
+ARAGORN_APP = FastAPI(title=title, default_response_class=TRAPIJSONResponse)
 
 # configures open telemetry iff enabled.
 service_name = os.environ.get('OTEL_SERVICE_NAME', 'ARAGORN') + '-' + title
@@ -51,20 +51,8 @@ logging.config.dictConfig(config)
 # create a logger
 logger = logging.getLogger(__name__)
 
-# Get rabbitmq connection
-q_username = os.environ.get("QUEUE_USER", "guest")
-q_password = os.environ.get("QUEUE_PW", "guest")
-q_host = os.environ.get("QUEUE_HOST", "127.0.0.1")
-
 cache_password = os.environ.get("CACHE_PASSWORD", "supersecretpassword")
 
-# declare the directory where the async data files will exist
-queue_file_dir = "./queue-files"
-
-# make the directory if it does not exist
-if not os.path.exists(queue_file_dir):
-    os.makedirs(queue_file_dir)
-
 # declare the types of answer coalesce methods
 class MethodName(str, Enum):
     all = "all"
@@ -115,40 +103,23 @@ async def subservice_callback(response: PDResponse, guid: str) -> int:
     """
     # init the return html status code
     ret_val: int = 200
-    # init the rbtmq connection
-    connection = None
 
     logger.debug(f"{guid}: Receiving sub-service callback")
 
     try:
-        connection = await aio_pika.connect_robust(f"amqp://{q_username}:{q_password}@{q_host}/")
-        async with connection:
-            channel = await connection.channel()
-            await channel.get_queue(guid, ensure=True)
-            # create a file path/name
-            fname = "".join(random.choices(string.ascii_lowercase, k=12))
-            file_name = f"{queue_file_dir}/{guid}-{fname}-async-data.json"
-
-            # save the response data to a file
-            with open(file_name, "w") as data_file:
-                data_file.write(response.json())
-
-            # publish what was received for the sub-service. post the file name for the queue handler
-            publish_val = await channel.default_exchange.publish(aio_pika.Message(body=file_name.encode()), routing_key=guid)
-
-            if publish_val:
-                logger.debug(f"{guid}: Callback message published to queue.")
-            else:
-                logger.error(f"{guid}: Callback message publishing to queue failed, type: {type(publish_val)}")
+        # hand what was received for the sub-service over to whoever is waiting on the guid
+        published = await get_callback_transport().publish(guid, response)
+
+        if published:
+            logger.debug(f"{guid}: Callback message published to queue.")
+        else:
+            logger.error(f"{guid}: Callback message publishing to queue failed.")
+            ret_val = 500
 
     except Exception as e:
         logger.exception(f"Exception detected while handling sub-service callback using guid {guid}", e)
         # set the html status code
         ret_val = 500
-    finally:
-        # close rbtmq connection if it exists
-        if connection:
-            await connection.close()
 
     # return the response code
     return ret_val
@@ -184,37 +155,63 @@ async def status_query_handler(job_id: str = Path(
     return await status_query(job_id)
 
 
+class CacheName(str, Enum):
+    creative = "creative"
+    lookup = "lookup"
+
+
 class ClearCacheRequest(BaseModel):
     pswd: str
 
 
 @ARAGORN_APP.post("/clear_creative_cache", status_code=200, include_in_schema=False)
-def clear_redis_cache(request: ClearCacheRequest) -> dict:
+async def clear_redis_cache(request: ClearCacheRequest) -> dict:
     """Clear the redis cache."""
     if request.pswd == cache_password:
         cache = ResultsCache()
-        cache.clear_creative_cache()
+        await cache.clear_creative_cache()
         return {"status": "success"}
     else:
         raise HTTPException(status_code=401, detail="Invalid Password")
 
 
 @ARAGORN_APP.post("/clear_lookup_cache", status_code=200, include_in_schema=False)
-def clear_redis_cache(request: ClearCacheRequest) -> dict:
+async def clear_redis_cache(request: ClearCacheRequest) -> dict:
     """Clear the redis cache."""
     if request.pswd == cache_password:
         cache = ResultsCache()
-        cache.clear_lookup_cache()
+        await cache.clear_lookup_cache()
         return {"status": "success"}
     else:
         raise HTTPException(status_code=401, detail="Invalid Password")
 
 
+class FlushCacheRequest(BaseModel):
+    pswd: str
+    cache: CacheName = CacheName.creative
+    predicate: Optional[str] = None
+    curie: Optional[str] = None
+    version: Optional[str] = None
+
+
+@ARAGORN_APP.post("/flush_cache", status_code=200, include_in_schema=False)
+async def flush_redis_cache(request: FlushCacheRequest) -> dict:
+    """Remove the cache entries for a predicate, a curie and/or a rule set version, rather than the whole cache."""
+    if request.pswd != cache_password:
+        raise HTTPException(status_code=401, detail="Invalid Password")
+    if request.predicate is None and request.curie is None and request.version is None:
+        raise HTTPException(status_code=422, detail="Give a predicate, curie or version to flush")
+    cache = ResultsCache()
+    flush = cache.flush_creative_cache if request.cache == CacheName.creative else cache.flush_lookup_cache
+    removed = await flush(predicate=request.predicate, curie=request.curie, version=request.version)
+    return {"status": "success", "removed": removed}
+
+
 @ARAGORN_APP.post("/cache_ready", status_code=200, include_in_schema=False)
-def ping_cache() -> dict:
+async def ping_cache() -> dict:
     """Ping the redis cache."""
     cache = ResultsCache()
-    cache.ping_cache()
+    await cache.ping_cache()
     return 200
 
 
@@ -0,0 +1,127 @@
+"""Encoding of the values stored in the results cache.
+
+A value is a header byte followed by the serialized and compressed answer.  The header byte says how it was made:
+
+    1 0 c c c s s s
+    | | |     |
+    | | |     +-- serializer: 0 json, 1 msgpack
+    | | +-------- compression: 0 none, 1 gzip, 2 zstd, 3 lz4
+    | +---------- reserved for a future format (0)
+    +------------ set for this format
+
+Values written before the header existed are gzipped json, which always starts with the gzip magic bytes 1f 8b, so
+they can still be read.  New values are written with CACHE_COMPRESSION (zstd, lz4, gzip or none; zstd by default if
+zstandard is installed, otherwise gzip) and CACHE_SERIALIZER (json or msgpack; json by default), at
+CACHE_COMPRESSION_LEVEL if it is set.  zstandard, lz4 and msgpack are optional; anything that isn't installed
+can't be written, and values that need it can't be read.
+"""
+import gzip
+import os
+
+import pydantic.json
+
+from src import json_codec
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover - depends on the install
+    zstandard = None
+try:
+    import lz4.frame
+except ImportError:  # pragma: no cover - depends on the install
+    lz4 = None
+try:
+    import msgpack
+except ImportError:  # pragma: no cover - depends on the install
+    msgpack = None
+
+FORMAT_FLAG = 0x80
+FORMAT_MASK = 0xC0
+GZIP_MAGIC = b"\x1f\x8b"
+
+COMPRESSIONS = {"none": 0, "gzip": 1, "zstd": 2, "lz4": 3}
+SERIALIZERS = {"json": 0, "msgpack": 1}
+
+CACHE_COMPRESSION = os.environ.get("CACHE_COMPRESSION", "zstd" if zstandard is not None else "gzip")
+CACHE_SERIALIZER = os.environ.get("CACHE_SERIALIZER", "json")
+CACHE_COMPRESSION_LEVEL = os.environ.get("CACHE_COMPRESSION_LEVEL")
+
+
+class CacheFormatError(ValueError):
+    """A value that can't be decoded, or a format that can't be encoded, with what's installed."""
+
+
+def compress(data, compression, level=None):
+    if compression == "none":
+        return data
+    if compression == "gzip":
+        return gzip.compress(data, compresslevel=6 if level is None else level)
+    if compression == "zstd" and zstandard is not None:
+        return zstandard.ZstdCompressor(level=3 if level is None else level).compress(data)
+    if compression == "lz4" and lz4 is not None:
+        return lz4.frame.compress(data, compression_level=0 if level is None else level)
+    raise CacheFormatError(f"Compression {compression} is not available")
+
+
+def decompress(data, compression):
+    if compression == "none":
+        return data
+    if compression == "gzip":
+        return gzip.decompress(data)
+    if compression == "zstd" and zstandard is not None:
+        # values are written in one frame with the content size, but don't rely on it
+        return zstandard.ZstdDecompressor().decompressobj().decompress(data)
+    if compression == "lz4" and lz4 is not None:
+        return lz4.frame.decompress(data)
+    raise CacheFormatError(f"Compression {compression} is not available")
+
+
+def serialize(obj, serializer):
+    if serializer == "json":
+        return json_codec.dumps(obj)
+    if serializer == "msgpack" and msgpack is not None:
+        return msgpack.packb(obj, default=pydantic.json.pydantic_encoder)
+    raise CacheFormatError(f"Serializer {serializer} is not available")
+
+
+def deserialize(data, serializer):
+    if serializer == "json":
+        return json_codec.loads(data)
+    if serializer == "msgpack" and msgpack is not None:
+        return msgpack.unpackb(data, raw=False, strict_map_key=False)
+    raise CacheFormatError(f"Serializer {serializer} is not available")
+
+
+def make_header(compression, serializer):
+    if compression not in COMPRESSIONS or serializer not in SERIALIZERS:
+        raise CacheFormatError(f"Unknown cache value format {compression}/{serializer}")
+    return bytes([FORMAT_FLAG | COMPRESSIONS[compression] << 3 | SERIALIZERS[serializer]])
+
+
+def read_header(header):
+    """The (compression, serializer) names from a header byte."""
+    compression_id, serializer_id = (header >> 3) & 0x07, header & 0x07
+    try:
+        compression = next(name for name, i in COMPRESSIONS.items() if i == compression_id)
+        serializer = next(name for name, i in SERIALIZERS.items() if i == serializer_id)
+    except StopIteration:
+        raise CacheFormatError(f"Unknown cache value header {header:#04x}")
+    return compression, serializer
+
+
+def encode_value(obj, compression=None, serializer=None, level=None):
+    compression = compression or CACHE_COMPRESSION
+    serializer = serializer or CACHE_SERIALIZER
+    if level is None and CACHE_COMPRESSION_LEVEL is not None:
+        level = int(CACHE_COMPRESSION_LEVEL)
+    return make_header(compression, serializer) + compress(serialize(obj, serializer), compression, level)
+
+
+def decode_value(value):
+    if value[:2] == GZIP_MAGIC:
+        # written before the versioned format
+        return json_codec.loads(gzip.decompress(value))
+    if not value or value[0] & FORMAT_MASK != FORMAT_FLAG:
+        raise CacheFormatError("Unknown cache value format")
+    compression, serializer = read_header(value[0])
+    return deserialize(decompress(memoryview(value)[1:], compression), serializer)
@@ -0,0 +1,182 @@
+"""Fill the creative results cache ahead of the users, e.g. after a rule set or upstream KG update.
+
+Usage:
+    python -m src.cache_warmer --inputs inputs.tsv [--concurrency 4] [--force]
+    python -m src.cache_warmer --from-log logs/aragorn.log --top 500 [--url http://aragorn:8080]
+
+Inputs are (curie, predicate, qualifier constraints) triples, one per line, either tab separated
+(curie, predicate, and optionally the qualifier_constraints as json) or json objects with curie, predicate, and
+optionally qualifier_constraints and source_input (whether the curie is the subject; it's the object by default).
+--from-log instead takes the most frequent infer queries from the server's log (entry() logs each one).
+
+Each input is run as an infer query through the real workflow, so it's cached just as a user's query would be.  By
+default that's in this process, calling asyncexecute; strider's callbacks land on the server, so that needs
+CALLBACK_TRANSPORT=rabbitmq (the default), set the same as the server's.  With --url the queries are posted to that
+server's /aragorn/query (or /robokop/query) instead, and it does the work.  Inputs whose cache entry is fresh are
+skipped, unless --force.  Progress and throughput are logged as it goes.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import re
+import time
+from collections import Counter
+from uuid import uuid4
+
+from src.callback_transport import get_callback_transport
+from src.common import asyncexecute
+from src.http_clients import close_http_clients, get_http_client, init_http_clients
+from src.redis_pool import close_redis_pools
+from src.results_cache import ResultsCache, flush_cache_writes, init_results_cache
+from src.service_aggregator import AMIE_EXPANSIONS, DEFAULT_INFER_WORKFLOW, RULESET_VERSION, get_rule_key
+from src.worker_pool import shutdown_worker_pool, start_worker_pool
+
+logger = logging.getLogger(__name__)
+
+INFER_QUERY_LOG = re.compile(r"Infer query (\{.*\})\s*$")
+
+
+def parse_inputs(lines):
+    """The (curie, predicate, qualifier constraints, source_input) to warm, from an inputs file."""
+    inputs = []
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        if line.startswith("{"):
+            spec = json.loads(line)
+            inputs.append((spec["curie"], spec["predicate"], spec.get("qualifier_constraints") or [], spec.get("source_input", False)))
+        else:
+            fields = line.split("\t")
+            qualifier_constraints = json.loads(fields[2]) if len(fields) > 2 and fields[2] else []
+            inputs.append((fields[0], fields[1], qualifier_constraints, False))
+    return inputs
+
+
+def parse_log(lines, caller, top=None):
+    """The most frequent infer queries for caller in a server log, most frequent first."""
+    counts = Counter()
+    for line in lines:
+        match = INFER_QUERY_LOG.search(line)
+        if match is None:
+            continue
+        spec = json.loads(match.group(1))
+        if spec.get("caller") != caller:
+            continue
+        qualifier_constraints = json.dumps(spec.get("qualifier_constraints") or [], sort_keys=True)
+        counts[(spec["curie"], spec["predicate"], qualifier_constraints, spec.get("source_input", False))] += 1
+    return [(curie, predicate, json.loads(qc), source_input) for (curie, predicate, qc, source_input), _ in counts.most_common(top)]
+
+
+def build_query(curie, predicate, qualifier_constraints, source_input):
+    """An infer query for an input, with its node categories from the rules for the predicate."""
+    qualifiers = {"qualifier_constraints": qualifier_constraints} if qualifier_constraints else {}
+    rules = AMIE_EXPANSIONS.get(get_rule_key(predicate, qualifiers, False))
+    if not rules:
+        raise ValueError(f"No rules for {predicate} {qualifiers}")
+    template_nodes = rules[0]["template"]["query_graph"]["nodes"]
+    nodes = {
+        "source": {"categories": template_nodes["$source"]["categories"]},
+        "target": {"categories": template_nodes["$target"]["categories"]},
+    }
+    nodes["source" if source_input else "target"]["ids"] = [curie]
+    edge = {"subject": "source", "object": "target", "predicates": [predicate], "knowledge_type": "inferred"}
+    if qualifier_constraints:
+        edge["qualifier_constraints"] = qualifier_constraints
+    return {"message": {"query_graph": {"nodes": nodes, "edges": {"e0": edge}}}}
+
+
+class CacheWarmer:
+    def __init__(self, caller="ARAGORN", concurrency=4, force=False, url=None, timeout=60 * 60):
+        self.caller = caller
+        self.concurrency = concurrency
+        self.force = force
+        self.url = url
+        self.timeout = timeout
+        self.stats = Counter()
+
+    async def is_fresh(self, curie, predicate, qualifier_constraints, source_input, workflow):
+        qualifiers = {"qualifier_constraints": qualifier_constraints} if qualifier_constraints else {}
+        cache = ResultsCache(ruleset_version=RULESET_VERSION)
+        hit = await cache.get_result(curie, predicate, qualifiers, source_input, self.caller, workflow, False, [])
+        return hit is not None and not hit.stale
+
+    async def run_query(self, query):
+        """Run the query, writing over its cache entry.  Returns the status code."""
+        query["parameters"] = {"overwrite_cache": True}
+        if self.url is None:
+            guid = f"warm_{str(uuid4()).split('-')[-1]}"
+            _, status_code = await asyncexecute(query, "all", guid, logger, self.caller)
+            return status_code
+        response = await get_http_client("default").post(f"{self.url}/{self.caller.lower()}/query", json=query, timeout=self.timeout)
+        return response.status_code
+
+    async def warm_one(self, spec, limit, workflow):
+        curie, predicate, qualifier_constraints, source_input = spec
+        async with limit:
+            try:
+                if not self.force and await self.is_fresh(curie, predicate, qualifier_constraints, source_input, workflow):
+                    self.stats["fresh"] += 1
+                    return
+                status_code = await self.run_query(build_query(*spec))
+                self.stats["warmed" if status_code == 200 else "failed"] += 1
+                if status_code != 200:
+                    logger.warning(f"{curie} {predicate}: status {status_code}")
+            except Exception as e:
+                self.stats["failed"] += 1
+                logger.error(f"{curie} {predicate}: {e}")
+
+    async def warm(self, specs):
+        limit = asyncio.Semaphore(self.concurrency)
+        start = time.monotonic()
+        tasks = [asyncio.create_task(self.warm_one(spec, limit, DEFAULT_INFER_WORKFLOW)) for spec in specs]
+        for done, task in enumerate(asyncio.as_completed(tasks), start=1):
+            await task
+            elapsed = time.monotonic() - start
+            if done % 10 == 0 or done == len(tasks):
+                rate = self.stats["warmed"] / elapsed * 60 if elapsed else 0.0
+                remaining = (len(tasks) - done) * elapsed / done
+                logger.info(f"{done}/{len(tasks)} done ({dict(self.stats)}), {rate:.1f} queries/min, ~{remaining / 60:.0f} min to go")
+        await flush_cache_writes()
+        elapsed = time.monotonic() - start
+        logger.info(f"Warmed {self.stats['warmed']}, skipped {self.stats['fresh']} fresh, {self.stats['failed']} failed, in {elapsed:.0f}s")
+        return dict(self.stats, elapsed=elapsed)
+
+
+async def main(args):
+    if args.inputs:
+        with open(args.inputs) as f:
+            specs = parse_inputs(f)
+    else:
+        with open(args.from_log) as f:
+            specs = parse_log(f, args.caller, args.top)
+    logger.info(f"Warming {len(specs)} queries, {args.concurrency} at a time")
+    if args.url is None:
+        # the same process setup as the server's startup
+        start_worker_pool()
+        await init_http_clients()
+        await init_results_cache()
+        await get_callback_transport().start()
+    try:
+        await CacheWarmer(args.caller, args.concurrency, args.force, args.url).warm(specs)
+    finally:
+        if args.url is None:
+            await get_callback_transport().stop()
+            await close_redis_pools()
+            await close_http_clients()
+            shutdown_worker_pool()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s | %(levelname)s | %(message)s")
+    parser = argparse.ArgumentParser(description="Fill the creative results cache")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--inputs", help="file of curie, predicate, qualifier constraints to warm")
+    source.add_argument("--from-log", help="server log to take the most frequent infer queries from")
+    parser.add_argument("--top", type=int, help="with --from-log, how many of the most frequent queries to warm")
+    parser.add_argument("--caller", default="ARAGORN", choices=["ARAGORN", "ROBOKOP"])
+    parser.add_argument("--concurrency", type=int, default=4, help="queries to run at once")
+    parser.add_argument("--force", action="store_true", help="recompute entries that are still fresh")
+    parser.add_argument("--url", help="run the queries on this server rather than in this process")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,227 @@
+"""Transports used to hand sub-service (strider) callbacks over to the request that is waiting for them.
+
+The callback endpoint and the waiting request have to agree on a transport, so it is chosen once per process with
+the CALLBACK_TRANSPORT environment variable:
+
+rabbitmq: (default) the callback is published to a RabbitMQ queue named after the guid.  Works across gunicorn
+    workers.
+    By default the payload is written to a file in queue_file_dir and only the file name is published, which needs
+    a disk shared by the workers.  With CALLBACK_INLINE_PAYLOADS=True the (gzipped, unless
+    CALLBACK_COMPRESS_PAYLOADS=False) payload is the message body instead, so workers can run on separate nodes.
+    Payloads bigger than CALLBACK_MAX_INLINE_BYTES still spill to disk.
+local: (opt in) an asyncio.Queue per guid.  The parsed callback is handed straight to the waiting coroutine.
+    Only usable when the callback is guaranteed to land on the same worker that made the request (single worker or
+    sticky routing).
+"""
+import asyncio
+import gzip
+import logging
+import os
+import random
+import string
+
+import aio_pika
+
+from src import json_codec
+from src.pika_pool import get_pika_connection, pika_channel, init_pika_pool, close_pika_pool
+from src.worker_pool import run_cpu_bound, run_in_thread
+
+logger = logging.getLogger(__name__)
+
+CALLBACK_TRANSPORT = os.environ.get("CALLBACK_TRANSPORT", "rabbitmq")
+CALLBACK_INLINE_PAYLOADS = os.environ.get("CALLBACK_INLINE_PAYLOADS", "False") == "True"
+CALLBACK_COMPRESS_PAYLOADS = os.environ.get("CALLBACK_COMPRESS_PAYLOADS", "True") == "True"
+# RabbitMQ refuses messages over 128MB by default, stay well under that
+CALLBACK_MAX_INLINE_BYTES = int(os.environ.get("CALLBACK_MAX_INLINE_BYTES", 64 * 1024 * 1024))
+
+# content type marking a message whose body is the payload itself. Messages without it carry a file name.
+INLINE_CONTENT_TYPE = "application/json"
+
+# declare the directory where the async data files will exist
+queue_file_dir = "./queue-files"
+
+
+class CallbackFailure:
+    """Put on a guid's local queue in place of a callback that couldn't be read, so that receive raises its error
+    instead of waiting out the deadline."""
+
+    def __init__(self, error):
+        self.error = error
+
+
+class LocalTransport:
+    """In-process transport.  One asyncio.Queue per guid."""
+
+    def __init__(self):
+        self.queues = {}
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        self.queues.clear()
+
+    async def create_queue(self, guid):
+        self.queues[guid] = asyncio.Queue()
+
+    async def delete_queue(self, guid):
+        self.queues.pop(guid, None)
+
+    async def publish(self, guid, response) -> bool:
+        """Put the callback response on the guid's queue. False if nobody in this process is waiting for it."""
+        queue = self.queues.get(guid)
+        if queue is None:
+            return False
+        queue.put_nowait(response.dict(exclude_none=True))
+        return True
+
+    async def receive(self, guid, deadline):
+        """Yield callback responses as they arrive.  Raises TimeoutError once the event loop time passes deadline, or
+        the error of a callback that couldn't be read."""
+        queue = self.queues[guid]
+        loop = asyncio.get_running_loop()
+        while True:
+            response = await asyncio.wait_for(queue.get(), max(deadline - loop.time(), 0))
+            if isinstance(response, CallbackFailure):
+                raise response.error
+            yield response
+
+
+class RabbitMQTransport(LocalTransport):
+    """Multi-worker transport.  The payload, or the name of the file it spilled to, goes through RabbitMQ.
+
+    The worker that creates the queue keeps a consumer on it until it is deleted.  The consumer decodes each
+    message as it arrives and puts it on the same kind of in-process queue the local transport uses."""
+
+    def __init__(self):
+        super().__init__()
+        # guid -> (channel, queue, consumer tag)
+        self.consumers = {}
+        # make the directory if it does not exist
+        if not os.path.exists(queue_file_dir):
+            os.makedirs(queue_file_dir)
+
+    async def start(self):
+        await init_pika_pool()
+
+    async def stop(self):
+        for guid in list(self.consumers):
+            await self.delete_queue(guid)
+        await close_pika_pool()
+
+    async def create_queue(self, guid):
+        await super().create_queue(guid)
+        local_queue = self.queues[guid]
+
+        async def on_message(message):
+            async with message.process():
+                local_queue.put_nowait(await read_message(guid, message))
+
+        try:
+            # The consumer lives as long as the request, so it gets its own channel rather than holding one from the pool
+            connection = await get_pika_connection()
+            channel = await connection.channel()
+            # declare the queue using the guid as the key
+            queue = await channel.declare_queue(guid)
+            consumer_tag = await queue.consume(on_message)
+            self.consumers[guid] = (channel, queue, consumer_tag)
+        except Exception as e:
+            logger.error(f"{guid}: Failed to create queue.")
+            await super().delete_queue(guid)
+            raise e
+
+    async def delete_queue(self, guid):
+        await super().delete_queue(guid)
+        try:
+            channel, queue, consumer_tag = self.consumers.pop(guid)
+            await queue.cancel(consumer_tag)
+            # delete the queue using the guid as the key
+            await channel.queue_delete(guid)
+            await channel.close()
+        except Exception:
+            logger.error(f"{guid}: Failed to delete queue.")
+            # Deleting queue isn't essential, so we will continue
+
+    async def publish(self, guid, response) -> bool:
+        async with pika_channel() as channel:
+            await channel.get_queue(guid, ensure=True)
+            message = await make_message(guid, json_codec.dumps(response.dict(exclude_none=True)))
+            # publish what was received for the sub-service, or the file name that it was spilled to
+            publish_val = await channel.default_exchange.publish(message, routing_key=guid)
+        return bool(publish_val)
+
+
+async def make_message(guid, payload):
+    """Build the queue message for a callback payload (json bytes).  Payloads run to many MB, so the compression
+    and the spill file write are kept off the event loop."""
+    if CALLBACK_INLINE_PAYLOADS:
+        if CALLBACK_COMPRESS_PAYLOADS:
+            body = await run_cpu_bound(gzip.compress, payload, 1)
+            content_encoding = "gzip"
+        else:
+            body = payload
+            content_encoding = None
+        if len(body) <= CALLBACK_MAX_INLINE_BYTES:
+            return aio_pika.Message(body=body, content_type=INLINE_CONTENT_TYPE, content_encoding=content_encoding)
+        logger.info(f"{guid}: Callback payload of {len(body)} bytes is too big to inline, spilling to disk.")
+
+    # create a file path/name
+    fname = "".join(random.choices(string.ascii_lowercase, k=12))
+    file_name = f"{queue_file_dir}/{guid}-{fname}-async-data.json"
+
+    # save the response data to a file
+    await run_in_thread(write_file, file_name, payload)
+
+    # post the file name for the queue handler
+    return aio_pika.Message(body=file_name.encode())
+
+
+def write_file(file_name, payload):
+    with open(file_name, "wb") as data_file:
+        data_file.write(payload)
+
+
+async def read_message(guid, message):
+    """process_message, in the thread pool, or a CallbackFailure if the message can't be read (e.g. its spill
+    file is gone)."""
+    try:
+        return await run_in_thread(process_message, message)
+    except Exception as e:
+        logger.error(f"{guid}: Failed to read callback: {e}")
+        return CallbackFailure(e)
+
+
+def process_message(message):
+    if message.content_type == INLINE_CONTENT_TYPE:
+        # the payload came in the message itself
+        content = message.body
+        if message.content_encoding == "gzip":
+            content = gzip.decompress(content)
+        return json_codec.loads(content)
+    file_name = message.body.decode()
+    # open and save the file saved from the callback
+    with open(file_name, "rb") as f:
+        # load the contents of the data in the file
+        content = f.read()
+    os.remove(file_name)
+    jr = json_codec.loads(content)
+    return jr
+
+
+TRANSPORTS = {
+    "local": LocalTransport,
+    "rabbitmq": RabbitMQTransport,
+}
+
+_transport = None
+
+
+def get_callback_transport():
+    """Return this process's callback transport, as configured by CALLBACK_TRANSPORT."""
+    global _transport
+    if _transport is None:
+        try:
+            _transport = TRANSPORTS[CALLBACK_TRANSPORT]()
+        except KeyError:
+            raise ValueError(f"Unknown CALLBACK_TRANSPORT {CALLBACK_TRANSPORT}, expected one of {list(TRANSPORTS)}")
+    return _transport
@@ -1,8 +1,8 @@
-import httpx
 import requests
 from functools import wraps
 from uuid import uuid4
-from fastapi.responses import JSONResponse
+from src.http_clients import get_http_client
+from src.json_codec import TRAPIJSONResponse, JSON_HEADERS, dumps as json_dumps
 from src.service_aggregator import entry
 from src.util import create_log_entry
 from src.process_db import add_item, get_status
@@ -33,10 +33,10 @@ async def async_query(background_tasks, request, answer_coalesce_type, logger, c
 
     except KeyError as e:
         logger.error(f"{guid}: Async message call key error {e}, callback URL was not specified")
-        return JSONResponse(content={"status": "Failed", "description": "callback URL missing", "job_id": guid}, status_code=422)
+        return TRAPIJSONResponse(content={"status": "Failed", "description": "callback URL missing", "job_id": guid}, status_code=422)
     except ValueError as e:
         logger.error(f"{guid}: Async message call value error {e}, callback URL was empty")
-        return JSONResponse(content={"status": "Failed", "description": "callback URL empty", "job_id": guid}, status_code=422)
+        return TRAPIJSONResponse(content={"status": "Failed", "description": "callback URL empty", "job_id": guid}, status_code=422)
 
     # launch the process
     background_tasks.add_task(execute_with_callback, message, answer_coalesce_type, callback_url, guid, logger, caller)
@@ -45,7 +45,7 @@ async def async_query(background_tasks, request, answer_coalesce_type, logger, c
     add_item(guid, f"Query Commenced, callback url = {callback_url}", 200)
 
     # package up the response and return it
-    return JSONResponse(content={"status": "Accepted",
+    return TRAPIJSONResponse(content={"status": "Accepted",
                                  "description": f"Query commenced. Will send result to {callback_url}",
                                  "job_id": guid}, status_code=200)
 
@@ -66,7 +66,7 @@ async def sync_query(request, answer_coalesce_type, logger, caller="ARAGORN"):
 
     logger.info(f"{guid}: Sync query returning.")
 
-    return JSONResponse(content=final_msg, status_code=status_code)
+    return TRAPIJSONResponse(content=final_msg, status_code=status_code)
 
 
 async def execute_with_callback(request, answer_coalesce_type, callback_url, guid, logger, caller):
@@ -104,10 +104,9 @@ async def execute_with_callback(request, answer_coalesce_type, callback_url, gui
     else:
         try:
             # send back the result to the specified aragorn callback end point
-            async with httpx.AsyncClient(timeout=httpx.Timeout(timeout=600.0)) as client:
-                response = await client.post(callback_url, json=final_msg)
-                add_item(guid, f"Complete", 200)
-                logger.info(f"{guid}: Executed POST to callback URL {callback_url}, response: {response.status_code}")
+            response = await get_http_client("callback").post(callback_url, content=json_dumps(final_msg), headers=JSON_HEADERS)
+            add_item(guid, f"Complete", 200)
+            logger.info(f"{guid}: Executed POST to callback URL {callback_url}, response: {response.status_code}")
         except Exception as e:
             add_item(guid, f"Exception posting response to {callback_url}", 500)
             logger.exception(f"{guid}: Exception detected: POSTing to callback {callback_url}", e)
@@ -194,7 +193,7 @@ async def status_query(job_id: str):
             resp = {"status": "Running",
                     "description": "The job is still running.",
                     "logs": create_logs(rows)}
-    return JSONResponse(content=resp, status_code=200)
+    return TRAPIJSONResponse(content=resp, status_code=200)
 
 def create_logs(rows):
     logs = []
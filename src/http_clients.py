@@ -0,0 +1,128 @@
+"""Long-lived httpx clients, one per upstream service.
+
+Building an AsyncClient per call meant a new connection (and TLS handshake) to strider, nodenorm, the ranker, etc.
+for every request, and no limit on how many requests we had open against any of them.  Instead each upstream gets a
+client with its own connection limits and default timeout, created at app startup and closed on shutdown.
+
+The defaults in UPSTREAMS can be overridden per upstream with environment variables, e.g.
+STRIDER_HTTP_MAX_CONNECTIONS, STRIDER_HTTP_MAX_KEEPALIVE and STRIDER_HTTP_TIMEOUT.  HTTP/2 is used when the h2
+package is installed, unless HTTP2_ENABLED=False.
+"""
+import logging
+import os
+from collections import Counter
+
+import httpx
+
+from src.loop_bound import close_stale, running_loop
+
+logger = logging.getLogger(__name__)
+
+try:
+    import h2  # noqa: F401
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+HTTP2_ENABLED = HTTP2_AVAILABLE and os.environ.get("HTTP2_ENABLED", "True") == "True"
+
+# upstream: (default timeout seconds, max connections, max keepalive connections)
+UPSTREAMS = {
+    "strider": (60 * 60, 100, 20),
+    "nodenorm": (900, 50, 10),
+    "ranker": (60 * 60, 50, 10),
+    "answer_coalesce": (60 * 60, 20, 5),
+    "robokopkg": (60 * 60, 20, 10),
+    # Final results posted back to our callers.  These go to many different hosts.
+    "callback": (600, 100, 20),
+    # Anything else
+    "default": (60 * 60, 100, 20),
+}
+
+# subservice_post names that share an upstream
+SERVICE_UPSTREAMS = {
+    "omnicorp": "ranker",
+    "score": "ranker",
+}
+
+_clients = {}
+_request_counts = Counter()
+# The loop the clients were made on, see loop_bound
+_loop = None
+
+
+def upstream_settings(upstream):
+    timeout, max_connections, max_keepalive = UPSTREAMS[upstream]
+    prefix = upstream.upper()
+    return (
+        float(os.environ.get(f"{prefix}_HTTP_TIMEOUT", timeout)),
+        int(os.environ.get(f"{prefix}_HTTP_MAX_CONNECTIONS", max_connections)),
+        int(os.environ.get(f"{prefix}_HTTP_MAX_KEEPALIVE", max_keepalive)),
+    )
+
+
+def create_client(upstream):
+    timeout, max_connections, max_keepalive = upstream_settings(upstream)
+
+    async def count_request(request):
+        _request_counts[upstream] += 1
+
+    return httpx.AsyncClient(
+        timeout=httpx.Timeout(timeout),
+        limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_keepalive),
+        http2=HTTP2_ENABLED,
+        event_hooks={"request": [count_request]},
+    )
+
+
+def get_http_client(service) -> httpx.AsyncClient:
+    """Return the shared client for a service (an upstream name, or a subservice_post name)."""
+    global _clients, _loop
+    upstream = SERVICE_UPSTREAMS.get(service, service)
+    if upstream not in UPSTREAMS:
+        upstream = "default"
+    loop = running_loop()
+    if loop is not _loop:
+        close_stale(_loop, [client.aclose for client in _clients.values()])
+        _clients, _loop = {}, loop
+    client = _clients.get(upstream)
+    if client is None or client.is_closed:
+        client = _clients[upstream] = create_client(upstream)
+    return client
+
+
+async def init_http_clients():
+    """Create the clients at app startup."""
+    for upstream in UPSTREAMS:
+        get_http_client(upstream)
+    logger.info(f"Created http clients for {list(UPSTREAMS)}, http2={HTTP2_ENABLED}")
+
+
+async def close_http_clients():
+    """Close the clients, and their connections, at app shutdown."""
+    global _clients
+    clients, _clients = _clients, {}
+    for client in clients.values():
+        await client.aclose()
+
+
+async def http_pool_stats():
+    """Per upstream: the configured limits, the number of requests sent, and the open connections by origin."""
+    stats = {}
+    for upstream in UPSTREAMS:
+        timeout, max_connections, max_keepalive = upstream_settings(upstream)
+        client = _clients.get(upstream)
+        connections = {}
+        if client is not None:
+            # httpcore's pool describes each open connection (http version, state, request count), by origin
+            pool = getattr(client._transport, "_pool", None)
+            if pool is not None and hasattr(pool, "get_connection_info"):
+                connections = await pool.get_connection_info()
+        stats[upstream] = {
+            "timeout": timeout,
+            "max_connections": max_connections,
+            "max_keepalive_connections": max_keepalive,
+            "requests": _request_counts[upstream],
+            "open_connections": connections,
+        }
+    return stats
@@ -0,0 +1,55 @@
+"""JSON encoding and decoding for TRAPI messages.
+
+Every place that serializes a whole message (callbacks, sub-service posts, the results cache and our own responses)
+goes through here, so that they all use the fastest backend available: orjson if it is installed, otherwise the
+standard library.  The API is bytes in and bytes out, which is what the network, redis and gzip all want anyway.
+
+orjson handles datetimes, enums and dataclasses itself; anything else goes through pydantic's encoder, as it would
+with pydantic's .json().
+"""
+import json
+import logging
+
+import pydantic.json
+from starlette.responses import JSONResponse
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - depends on the install
+    orjson = None
+
+logger = logging.getLogger(__name__)
+
+BACKEND = "orjson" if orjson is not None else "json"
+
+# For posting already serialized json with httpx
+JSON_HEADERS = {"Content-Type": "application/json"}
+
+
+def dumps(obj) -> bytes:
+    """Serialize obj to compact utf-8 json."""
+    if orjson is not None:
+        try:
+            return orjson.dumps(obj, default=pydantic.json.pydantic_encoder)
+        except orjson.JSONEncodeError as e:
+            # orjson is stricter than json (e.g. ints over 64 bits, non-str keys).  Don't fail the query over that.
+            logger.debug(f"orjson could not encode, falling back to json: {e}")
+    return json.dumps(obj, default=pydantic.json.pydantic_encoder, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def loads(data):
+    """Deserialize json from bytes (or str).  Note that orjson reads integers over 64 bits as floats."""
+    if orjson is not None:
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError as e:
+            # orjson is stricter than json here too: Python upstreams send NaN and Infinity, which json reads
+            logger.debug(f"orjson could not decode, falling back to json: {e}")
+    return json.loads(data)
+
+
+class TRAPIJSONResponse(JSONResponse):
+    """JSONResponse rendered with this module's encoder."""
+
+    def render(self, content) -> bytes:
+        return dumps(content)
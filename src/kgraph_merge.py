@@ -0,0 +1,106 @@
+"""Knowledge graph merging on plain dicts.
+
+This gives the same merged graph as reasoner_pydantic's KnowledgeGraph.update, without validating every
+node and edge into pydantic models and dumping them back out:
+- nodes: the name is replaced by any later name; categories and attributes are unioned.
+- edges: sources are unioned by (resource_id, resource_role), with upstream_resource_ids unioned for
+  matching sources.  Attributes are unioned, except that knowledge_level/agent_type attributes are only taken
+  from the first edge that has attributes.  Qualifiers are those of the first edge.
+Unlike the pydantic sets, the unions keep the order in which things were first seen.
+"""
+
+# An edge only has one knowledge level and agent type, don't pick up a second one from a later copy of the edge.
+SINGLE_VALUED_EDGE_ATTRIBUTES = ("biolink:knowledge_level", "biolink:agent_type")
+
+
+def freeze(obj):
+    """A hashable version of a json value, so that it can be used to de-duplicate.  None valued keys are
+    ignored, as pydantic treats a missing field and a null field the same."""
+    if isinstance(obj, dict):
+        return tuple(sorted((k, freeze(v)) for k, v in obj.items() if v is not None))
+    if isinstance(obj, list):
+        return tuple(freeze(v) for v in obj)
+    return obj
+
+
+class KnowledgeGraphMerger:
+    """Accumulates knowledge graphs with update().  The merged graph is in knowledge_graph.
+    Nodes and edges are copied as they come in, so the input graphs are not modified."""
+
+    def __init__(self):
+        self.knowledge_graph = {"nodes": {}, "edges": {}}
+        # Indexes of what each merged node/edge already holds, so that merging is a hash lookup
+        self.node_categories = {}
+        self.node_attributes = {}
+        self.edge_attributes = {}
+        self.edge_sources = {}
+
+    def update(self, kgraph):
+        for node_id, node in (kgraph.get("nodes") or {}).items():
+            if node_id in self.knowledge_graph["nodes"]:
+                self.update_node(node_id, node)
+            else:
+                self.add_node(node_id, node)
+        for edge_id, edge in (kgraph.get("edges") or {}).items():
+            if edge_id in self.knowledge_graph["edges"]:
+                self.update_edge(edge_id, edge)
+            else:
+                self.add_edge(edge_id, edge)
+
+    def add_node(self, node_id, node):
+        # Start from an empty copy and merge into it, which also removes any duplicates within the node
+        self.knowledge_graph["nodes"][node_id] = dict(node, categories=[], attributes=[])
+        self.node_categories[node_id] = set()
+        self.node_attributes[node_id] = set()
+        self.update_node(node_id, node)
+
+    def update_node(self, node_id, other):
+        node = self.knowledge_graph["nodes"][node_id]
+        if other.get("name"):
+            node["name"] = other["name"]
+        categories = self.node_categories[node_id]
+        for category in other.get("categories") or []:
+            if category not in categories:
+                categories.add(category)
+                node["categories"].append(category)
+        add_attributes(node["attributes"], self.node_attributes[node_id], other.get("attributes") or [])
+
+    def add_edge(self, edge_id, edge):
+        self.knowledge_graph["edges"][edge_id] = dict(edge, attributes=[], sources=[])
+        self.edge_attributes[edge_id] = set()
+        self.edge_sources[edge_id] = {}
+        self.update_edge(edge_id, edge)
+
+    def update_edge(self, edge_id, other):
+        edge = self.knowledge_graph["edges"][edge_id]
+        other_attributes = other.get("attributes") or []
+        if edge["attributes"]:
+            other_attributes = [a for a in other_attributes if a.get("attribute_type_id") not in SINGLE_VALUED_EDGE_ATTRIBUTES]
+        add_attributes(edge["attributes"], self.edge_attributes[edge_id], other_attributes)
+        sources = self.edge_sources[edge_id]
+        for other_source in other.get("sources") or []:
+            key = (other_source["resource_id"], other_source["resource_role"])
+            source = sources.get(key)
+            if source is None:
+                source = copy_source(other_source)
+                sources[key] = source
+                edge["sources"].append(source)
+            elif other_source.get("upstream_resource_ids"):
+                upstream = source.get("upstream_resource_ids") or []
+                source["upstream_resource_ids"] = upstream + [u for u in other_source["upstream_resource_ids"] if u not in upstream]
+
+
+def add_attributes(attributes, seen, new_attributes):
+    """Append the new attributes that aren't already in attributes. seen holds the frozen attributes."""
+    for attribute in new_attributes:
+        key = freeze(attribute)
+        if key not in seen:
+            seen.add(key)
+            attributes.append(attribute)
+
+
+def copy_source(source):
+    source = dict(source)
+    if source.get("upstream_resource_ids"):
+        source["upstream_resource_ids"] = list(source["upstream_resource_ids"])
+    return source
@@ -0,0 +1,55 @@
+"""Process-wide clients that are bound to the event loop they were created on.
+
+Test clients spin up a new loop per request, so http_clients, redis_pool and pika_pool keep track of the loop their
+clients were made on and rebuild them when it changes.  The old clients are handed to close_stale rather than
+dropped, which would leak their connections (and warn about an unclosed client when they are collected).
+"""
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Don't wait forever on a client whose loop has gone away
+CLOSE_TIMEOUT = 5
+
+# Keep a reference to pending closes, the loop only holds weak references to tasks
+_closing = set()
+
+
+def running_loop():
+    """The running event loop, or None outside of one."""
+    try:
+        return asyncio.get_running_loop()
+    except RuntimeError:
+        return None
+
+
+async def _close(closers):
+    for close in closers:
+        try:
+            await asyncio.wait_for(close(), CLOSE_TIMEOUT)
+        except Exception as e:
+            # The old loop is usually closed by now, so its sockets can't be shut down cleanly.  That's fine.
+            logger.debug(f"Error closing client from a stale event loop: {e!r}")
+
+
+def close_stale(old_loop, closers):
+    """Close, in order, the clients made on old_loop, which is no longer the running loop.
+
+    closers are no argument callables returning an awaitable, e.g. client.aclose.  If old_loop is still running
+    (in another thread) they are closed on it, otherwise the close is scheduled on the running loop, or run to
+    completion when there isn't one.
+    """
+    closers = list(closers)
+    if not closers:
+        return
+    if old_loop is not None and old_loop.is_running() and not old_loop.is_closed():
+        asyncio.run_coroutine_threadsafe(_close(closers), old_loop)
+        return
+    loop = running_loop()
+    if loop is None:
+        asyncio.run(_close(closers))
+        return
+    task = loop.create_task(_close(closers))
+    _closing.add(task)
+    task.add_done_callback(_closing.discard)
@@ -0,0 +1,56 @@
+"""Move the creative results cache entries stored under the old, unhashed keys to their hashed keys.
+
+Usage:
+    python -m src.migrate_cache_keys [--dry-run]
+
+Uses the same CACHE_* environment variables as the server.  The old keys are the sorted json of the query, so
+anything in the cache that parses as a json object is an old entry.  Entries are moved with SCAN, in batches, so it
+can run against a live cache; anything it misses is moved the first time it's read (CACHE_READ_LEGACY_KEYS).
+
+The lookup cache isn't migrated: its keys are now built from the canonical query graph, so the old entries would
+never be read again.  Clear the lookup cache instead.
+"""
+import argparse
+import asyncio
+import json
+import logging
+
+from src.results_cache import ResultsCache, make_cache_key, move_legacy_entry
+
+logger = logging.getLogger(__name__)
+
+
+async def migrate_db(redis_client, kind, dry_run=False):
+    moved = 0
+    async for old_key in redis_client.scan_iter(match="{*", count=1000):
+        try:
+            keydict = json.loads(old_key)
+            key = make_cache_key(kind, keydict)
+        except (ValueError, KeyError, TypeError):
+            logger.warning(f"Skipping {old_key[:100]}, it isn't an old {kind} cache key")
+            continue
+        if key.canonical != old_key.decode():
+            # json.dumps(json.loads(x)) is x for anything we wrote, so this is someone else's
+            logger.warning(f"Skipping {old_key[:100]}, it isn't in canonical form")
+            continue
+        if not dry_run:
+            value = await redis_client.get(old_key)
+            if value is None:
+                continue
+            await move_legacy_entry(redis_client, key, value)
+        moved += 1
+    return moved
+
+
+async def migrate(dry_run=False):
+    cache = ResultsCache()
+    moved = await migrate_db(cache.creative_redis, "creative", dry_run)
+    logger.info(f"{'Would move' if dry_run else 'Moved'} {moved} creative cache entries")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Move results cache entries to hashed keys")
+    parser.add_argument("--dry-run", action="store_true", help="count the entries to move, but don't move them")
+    args = parser.parse_args()
+    asyncio.run(migrate(args.dry_run))
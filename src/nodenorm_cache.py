@@ -0,0 +1,181 @@
+"""Cached calls to the node normalizer's get_normalized_nodes.
+
+Every query normalizes the ids in its query graph, and pathfinder normalizes hundreds of co-occurring curies, with
+the same curies coming up over and over.  Normalizations are cached per curie in two tiers:
+
+- an in-process LRU (NODENORM_CACHE_SIZE entries) whose entries expire after NODENORM_CACHE_TTL seconds.
+- optionally, redis (when NODENORM_CACHE_HOST is set), shared by the workers, with the same TTL.
+
+A batch only sends the curies that neither tier has to the node normalizer, and merges the rest in locally.  Curies
+that the normalizer doesn't know (a null result) are cached too.  Hit and miss counts are in nodenorm_cache_stats().
+"""
+import logging
+import os
+import time
+from collections import Counter, OrderedDict
+
+from src import json_codec
+from src.http_clients import get_http_client
+from src.redis_pool import get_redis
+
+logger = logging.getLogger(__name__)
+
+NODENORM_CACHE_SIZE = int(os.environ.get("NODENORM_CACHE_SIZE", 100000))
+NODENORM_CACHE_TTL = int(os.environ.get("NODENORM_CACHE_TTL", 24 * 60 * 60))
+NODENORM_CACHE_HOST = os.environ.get("NODENORM_CACHE_HOST")
+NODENORM_CACHE_PORT = os.environ.get("NODENORM_CACHE_PORT", os.environ.get("CACHE_PORT", "6379"))
+NODENORM_CACHE_DB = os.environ.get("NODENORM_CACHE_DB", "2")
+NODENORM_CACHE_PASSWORD = os.environ.get("NODENORM_CACHE_PASSWORD", os.environ.get("CACHE_PASSWORD", ""))
+
+# Marks a cached "the normalizer doesn't know this curie", as opposed to a cache miss
+_UNKNOWN = object()
+
+
+class LRUCache:
+    """A size bounded LRU whose entries expire ttl seconds after they were set."""
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict()
+
+    def get(self, key, default=None):
+        entry = self.entries.get(key)
+        if entry is None:
+            return default
+        expires, value = entry
+        if expires < time.monotonic():
+            del self.entries[key]
+            return default
+        self.entries.move_to_end(key)
+        return value
+
+    def set(self, key, value):
+        self.entries[key] = (time.monotonic() + self.ttl, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class NodeNormCache:
+    def __init__(self, redis_client=None, maxsize=NODENORM_CACHE_SIZE, ttl=NODENORM_CACHE_TTL):
+        self.memory = LRUCache(maxsize, ttl)
+        self.redis = redis_client
+        self.ttl = ttl
+        self.stats = Counter()
+
+    @staticmethod
+    def cache_key(curie, options):
+        # The same curie normalizes differently with different conflation settings
+        flags = ",".join(f"{k}={options[k]}" for k in sorted(options))
+        return f"nodenorm:{flags}:{curie}"
+
+    async def get_normalized_nodes(self, curies, guid="", timeout=None, **options):
+        """Return {curie: normalized node or None} for curies, like get_normalized_nodes does, or None if the
+        normalizer couldn't be reached.  options are passed to the normalizer (conflate etc.)."""
+        curies = list(dict.fromkeys(curies))
+        found = {}
+        keys = {curie: self.cache_key(curie, options) for curie in curies}
+        misses = []
+        for curie in curies:
+            value = self.memory.get(keys[curie])
+            if value is None:
+                misses.append(curie)
+            else:
+                found[curie] = value
+        self.stats["memory_hits"] += len(found)
+
+        if misses and self.redis is not None:
+            redis_found = await self.get_from_redis([keys[curie] for curie in misses])
+            still_missing = []
+            for curie, value in zip(misses, redis_found):
+                if value is None:
+                    still_missing.append(curie)
+                else:
+                    found[curie] = value
+                    self.memory.set(keys[curie], value)
+            self.stats["redis_hits"] += len(misses) - len(still_missing)
+            misses = still_missing
+
+        self.stats["misses"] += len(misses)
+        if misses:
+            fetched = await self.fetch(misses, guid, timeout, options)
+            if fetched is None:
+                return None
+            to_store = {}
+            for curie in misses:
+                value = fetched.get(curie)
+                value = _UNKNOWN if value is None else value
+                found[curie] = value
+                self.memory.set(keys[curie], value)
+                to_store[keys[curie]] = value
+            if self.redis is not None:
+                await self.set_in_redis(to_store)
+
+        return {curie: (None if found[curie] is _UNKNOWN else found[curie]) for curie in curies}
+
+    async def fetch(self, curies, guid, timeout, options):
+        url = f'{os.environ.get("NODENORM_URL", "https://nodenormalization-sri.renci.org/")}get_normalized_nodes'
+        kwargs = {} if timeout is None else {"timeout": timeout}
+        try:
+            response = await get_http_client("nodenorm").post(url, json=dict(options, curies=curies), **kwargs)
+            response.raise_for_status()
+            return json_codec.loads(response.content)
+        except Exception as e:
+            self.stats["errors"] += 1
+            logger.error(f"{guid}: Error reaching node normalizer: {e}")
+            return None
+
+    async def get_from_redis(self, keys):
+        """Values for keys from redis, None where there isn't one.  Redis being down is just a miss."""
+        try:
+            values = await self.redis.mget(keys)
+        except Exception as e:
+            self.stats["redis_errors"] += 1
+            logger.warning(f"Failed to read node norm cache: {e}")
+            return [None] * len(keys)
+        return [None if v is None else (_UNKNOWN if v == b"null" else json_codec.loads(v)) for v in values]
+
+    async def set_in_redis(self, values):
+        try:
+            async with self.redis.pipeline(transaction=False) as pipeline:
+                for key, value in values.items():
+                    pipeline.setex(key, self.ttl, b"null" if value is _UNKNOWN else json_codec.dumps(value))
+                await pipeline.execute()
+        except Exception as e:
+            self.stats["redis_errors"] += 1
+            logger.warning(f"Failed to write node norm cache: {e}")
+
+    def get_stats(self):
+        lookups = self.stats["memory_hits"] + self.stats["redis_hits"] + self.stats["misses"]
+        hits = self.stats["memory_hits"] + self.stats["redis_hits"]
+        return dict(self.stats, lookups=lookups, hit_rate=hits / lookups if lookups else 0.0,
+                    memory_entries=len(self.memory), redis=self.redis is not None)
+
+
+_nodenorm_cache = None
+
+
+def get_nodenorm_cache():
+    global _nodenorm_cache
+    if _nodenorm_cache is None:
+        _nodenorm_cache = NodeNormCache()
+    if NODENORM_CACHE_HOST:
+        # The memory tier lives as long as the process, but the redis client has to be the one for the running loop
+        _nodenorm_cache.redis = get_redis(NODENORM_CACHE_HOST, NODENORM_CACHE_PORT, NODENORM_CACHE_DB, NODENORM_CACHE_PASSWORD)
+    return _nodenorm_cache
+
+
+async def get_normalized_nodes(curies, guid="", timeout=None, **options):
+    """Normalize curies through the process's node norm cache.  See NodeNormCache.get_normalized_nodes."""
+    return await get_nodenorm_cache().get_normalized_nodes(curies, guid, timeout, **options)
+
+
+def nodenorm_cache_stats():
+    return get_nodenorm_cache().get_stats()
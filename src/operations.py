@@ -1,7 +1,39 @@
+import heapq
 import logging
 
 logger = logging.getLogger(__name__)
 
+
+def result_score(result):
+    """A result's score: the best of its analyses' scores."""
+    best = None
+    for analysis in result['analyses']:
+        score = analysis.get('score',0)
+        if best is None or score > best:
+            best = score
+    return best
+
+
+def top_n_results(results, n, reverse=True):
+    """The n best results by result_score (the n worst if not reverse), in order, the same as
+    sorted(results, key=result_score, reverse=reverse)[:n] including the order of ties.  n=None sorts them all.
+    When n is much smaller than the number of results, rather than sorting them all, a heap finds the n-th best
+    score, and only the results at least that good are sorted."""
+    scores = [result_score(result) for result in results]
+    # n <= 0 goes the plain sort and slice way too, which is what it always did (e.g. max_results 0 keeps nothing)
+    if n is not None and 0 < n and n * 10 < len(results):
+        if reverse:
+            cutoff = heapq.nlargest(n, scores)[-1]
+            indices = [i for i, score in enumerate(scores) if score >= cutoff]
+        else:
+            cutoff = heapq.nsmallest(n, scores)[-1]
+            indices = [i for i, score in enumerate(scores) if score <= cutoff]
+    else:
+        indices = range(len(results))
+    # sorted is stable, and the indices are in their original order, so ties stay in their original order
+    return [results[i] for i in sorted(indices, key=scores.__getitem__, reverse=reverse)[:n]]
+
+
 # All these functions need to be async even though they don't await
 # because all operation workflows are expected to be async
 async def sort_results_score(message,params,guid):
@@ -10,7 +42,7 @@ async def sort_results_score(message,params,guid):
     aord = params.get('ascending_or_descending','descending')
     reverse = (aord=='descending')
     try:
-        message['message']['results'] = sorted(results,key=lambda x: max([y.get('score',0) for y in x['analyses']]),reverse=reverse)
+        message['message']['results'] = top_n_results(results, None, reverse)
     except KeyError:
         #can't find the right structure of message
         logger.error(f'{guid}: error sorting results.')
@@ -32,39 +64,79 @@ async def filter_results_top_n(message,params,guid):
     return message,200
 
 
-def recursive_get_edge_support_graphs(edge, edges, auxgraphs, message_edges, message_auxgraphs, nodes, guid):
-    """Recursive method to find auxiliary graphs to keep when filtering. Each auxiliary
-    graph then has its edges filterd."""
-    edges.add(edge)
-    nodes.add(message_edges[edge]["subject"])
-    nodes.add(message_edges[edge]["object"])
-    for attribute in message_edges.get(edge, {}).get('attributes', {}):
+def get_support_graphs(edge):
+    """The ids of the support graphs of a knowledge graph edge."""
+    support_graphs = []
+    for attribute in edge.get('attributes') or []:
         if attribute.get('attribute_type_id', None) == 'biolink:support_graphs':
-            for auxgraph in attribute.get('value', []):
+            support_graphs.extend(attribute.get('value') or [])
+    return support_graphs
+
+
+def mark_support_graphs(edge_ids, auxgraph_ids, edges, auxgraphs, nodes, message_edges, message_auxgraphs, guid,
+                        strict=True):
+    """Add to edges, auxgraphs and nodes everything reachable from edge_ids and auxgraph_ids: each edge's nodes and
+    support graphs, each support graph's edges, and so on down.  Anything already in edges or auxgraphs isn't walked
+    again, so support graphs shared by many edges are only walked once, and support that loops back on itself ends.
+    It's a worklist rather than recursion, so deep support chains don't hit the recursion limit.
+    A reference to a missing edge or aux graph raises KeyError if strict, otherwise it's logged and skipped."""
+    def missing(error):
+        if strict:
+            raise KeyError(error)
+        logger.warning(error)
+
+    edge_stack = list(edge_ids)
+    auxgraph_stack = list(auxgraph_ids)
+    while edge_stack or auxgraph_stack:
+        while edge_stack:
+            edge_id = edge_stack.pop()
+            if edge_id in edges:
+                continue
+            edge = message_edges.get(edge_id)
+            if edge is None:
+                missing(f"{guid}: edge {edge_id} not in knowledge_graph.edges")
+                continue
+            edges.add(edge_id)
+            # nodes get checked against the knowledge graph later, so a malformed edge's None does no harm
+            nodes.add(edge.get("subject"))
+            nodes.add(edge.get("object"))
+            for auxgraph in get_support_graphs(edge):
                 if auxgraph not in message_auxgraphs:
-                    raise KeyError(f"{guid}: auxgraph {auxgraph} not in auxiliary_graphs")
-                try:
-                    edges, auxgraphs, nodes = recursive_get_auxgraph_edges(auxgraph, edges, auxgraphs, message_edges, message_auxgraphs, nodes, guid)
-                except KeyError as e:
-                    raise e
+                    missing(f"{guid}: auxgraph {auxgraph} not in auxiliary_graphs")
+                    continue
+                if auxgraph not in auxgraphs:
+                    auxgraph_stack.append(auxgraph)
+        while auxgraph_stack:
+            auxgraph = auxgraph_stack.pop()
+            if auxgraph in auxgraphs:
+                continue
+            auxgraphs.add(auxgraph)
+            for aux_edge in message_auxgraphs.get(auxgraph, {}).get('edges', []):
+                if aux_edge not in message_edges:
+                    missing(f"{guid}: aux_edge {aux_edge} not in knowledge_graph.edges")
+                    continue
+                if aux_edge not in edges:
+                    edge_stack.append(aux_edge)
     return edges, auxgraphs, nodes
 
 
+def recursive_get_edge_support_graphs(edge, edges, auxgraphs, message_edges, message_auxgraphs, nodes, guid):
+    """Find the auxiliary graphs, edges and nodes supporting an edge, all the way down.  Raises KeyError on a
+    reference to a missing edge or aux graph."""
+    return mark_support_graphs([edge], [], edges, auxgraphs, nodes, message_edges, message_auxgraphs, guid)
+
+
 def recursive_get_auxgraph_edges(auxgraph, edges, auxgraphs, message_edges, message_auxgraphs, nodes, guid):
-    """Recursive method to find edges to keep when filtering. Each edge then
-    has support graphs filtered."""
-    auxgraphs.add(auxgraph)
-    aux_edges = message_auxgraphs.get(auxgraph, {}).get('edges', [])
-    for aux_edge in aux_edges:
-        if aux_edge not in message_edges:
-            raise KeyError(f"{guid}: aux_edge {aux_edge} not in knowledge_graph.edges")
-        try:
-            edges, auxgraphs, nodes = recursive_get_edge_support_graphs(aux_edge, edges, auxgraphs, message_edges, message_auxgraphs, nodes, guid)
-        except KeyError as e:
-            raise e
-    return edges, auxgraphs, nodes
+    """Find the edges, nodes and further auxiliary graphs supporting an auxiliary graph, all the way down.  Raises
+    KeyError on a reference to a missing edge or aux graph."""
+    return mark_support_graphs([], [auxgraph], edges, auxgraphs, nodes, message_edges, message_auxgraphs, guid)
 
 async def filter_kgraph_orphans(message,params,guid):
+    """Workflow operation around remove_kgraph_orphans"""
+    return remove_kgraph_orphans(message,guid)
+
+
+def remove_kgraph_orphans(message,guid):
     """Remove from the knowledge graph any nodes and edges not references by a result, as well as any aux_graphs.
     We do this by starting at results, marking reachable nodes & edges, then remove anything that isn't marked
     There are multiple sources:
@@ -73,51 +145,35 @@ async def filter_kgraph_orphans(message,params,guid):
     3. Result.Analysis support graphs
     4. support graphs from edges found in 2
     5. For all the auxgraphs collect their edges and nodes
-    Note that this will fail to find edges and nodes that are recursive.  So if an edge is supported by an edge,
-    and that edge is supported by a third edge, then that third edge won't get marked, and will be removed.
-    ATM, this is acceptable, but it'll need to be fixed.
+    4 and 5 are followed all the way down, so if an edge is supported by an edge that is itself supported by a
+    third edge, the third edge is kept too.  References to missing edges or aux graphs are logged and skipped.
     """
     #First, find all the result nodes and edges
     try:
         logger.info(f'{guid}: filtering kgraph.')
         kg_edges = message.get('message',{}).get('knowledge_graph',{}).get('edges',{})
-        message_auxgraphs = message["message"].get("auxiliary_graphs",{})
+        message_auxgraphs = message["message"].get("auxiliary_graphs") or {}
         results = message.get('message',{}).get('results',[])
         nodes = set()
         edges = set()
         auxgraphs = set()
         temp_auxgraphs = set()
         temp_edges = set()
-        # 1. Result node bindings
         for result in results:
+            # 1. Result node bindings
             for qnode,knodes in result.get('node_bindings',{}).items():
                 nodes.update([ k['id'] for k in knodes ])
-        # 2. Result.Analysis edge bindings and path bindings
-        for result in results:
             for analysis in result.get('analyses',[]):
+                # 2. Result.Analysis edge bindings and path bindings
                 for qedge, kedges in analysis.get('edge_bindings', {}).items():
                     temp_edges.update([k['id'] for k in kedges])
                 for qpath, path_graphs in analysis.get('path_bindings', {}).items():
                     temp_auxgraphs.update(a["id"] for a in path_graphs)
-        # 3. Result.Analysis support graphs
-        for result in results:
-            for analysis in result.get('analyses',[]):
-                for auxgraph in analysis.get('support_graphs',[]):
-                    temp_auxgraphs.add(auxgraph)
-        # 4. Recursively add support graphs from edges and edges from support_graphs
-        for edge in temp_edges:
-            try:
-                edges, auxgraphs, nodes = recursive_get_edge_support_graphs(edge, edges, auxgraphs, kg_edges, message_auxgraphs, nodes, guid)
-            except KeyError as e:
-                logger.warning(e)
-                continue
-        # 5. Recursively add edges from support_graphs and support graphs from edges
-        for auxgraph in temp_auxgraphs:
-            try:
-                edges, auxgraphs, nodes = recursive_get_auxgraph_edges(auxgraph, edges, auxgraphs, kg_edges, message_auxgraphs, nodes, guid)
-            except KeyError as e:
-                logger.warning(e)
-                continue
+                # 3. Result.Analysis support graphs
+                temp_auxgraphs.update(analysis.get('support_graphs') or [])
+        # 4 and 5. Add support graphs from edges and edges from support graphs, all the way down
+        mark_support_graphs(temp_edges, temp_auxgraphs, edges, auxgraphs, nodes, kg_edges, message_auxgraphs, guid,
+                            strict=False)
         #now remove all knowledge_graph nodes and edges that are not in our nodes and edges sets.
         kg_nodes = message.get('message',{}).get('knowledge_graph',{}).get('nodes',{})
         message['message']['knowledge_graph']['nodes'] = { nid: ndata for nid, ndata in kg_nodes.items() if nid in nodes }
@@ -133,17 +189,21 @@ async def filter_kgraph_orphans(message,params,guid):
 async def filter_message_top_n(message,params,guid):
     """Aggregator for sort_results_score, filter_results_top_n, filter_kgraph_orphans.
     Aggregating these allows us to skip (potentially expensive) filter_kgraph_orphans if no
-    filtering is done on the results."""
+    filtering is done on the results, and to pick out the top n results without sorting the rest."""
     logger.info(f'{guid}: filtering message top n.')
     n = params.get('max_results', 20000)
-    sortedmessage, status = await sort_results_score(message,params,guid)
-    num_results = len(sortedmessage.get('message',{}).get('results',[]))
+    num_results = len(message.get('message',{}).get('results',[]))
     if num_results > n:
-        fmessage, status = await filter_results_top_n(sortedmessage,params,guid)
-        rmessage, status = await filter_kgraph_orphans(fmessage,params,guid)
+        reverse = params.get('ascending_or_descending','descending') == 'descending'
+        try:
+            message['message']['results'] = top_n_results(message['message']['results'], n, reverse)
+        except KeyError:
+            logger.error(f'{guid}: error sorting results.')
+            return message,400
+        rmessage, status = await filter_kgraph_orphans(message,params,guid)
         logger.info(f'{guid}: Returning filtered message ({n}).')
         return rmessage,status
     else:
+        sortedmessage, status = await sort_results_score(message,params,guid)
         logger.info(f'{guid}: returning. No filtering needed')
         return sortedmessage,status
-
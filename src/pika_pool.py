@@ -0,0 +1,78 @@
+"""Process-wide RabbitMQ connection and channel pool.
+
+The callback path used to open a new connection for every queue create/delete, every consume cycle and every
+strider callback.  Instead, each worker process keeps a single robust connection (which reconnects on its own
+after a broker failure) and a small pool of channels multiplexed over it.
+"""
+import asyncio
+import logging
+import os
+from contextlib import asynccontextmanager
+
+import aio_pika
+from aio_pika.pool import Pool
+
+from src.loop_bound import close_stale
+
+logger = logging.getLogger(__name__)
+
+Q_USERNAME = os.environ.get("QUEUE_USER", "guest")
+Q_PASSWORD = os.environ.get("QUEUE_PW", "guest")
+Q_HOST = os.environ.get("QUEUE_HOST", "127.0.0.1")
+CHANNEL_POOL_SIZE = int(os.environ.get("QUEUE_CHANNEL_POOL_SIZE", 10))
+
+_connection = None
+_channel_pool = None
+# The loop the connection and pool were made on, see loop_bound
+_loop = None
+_lock = None
+
+
+async def _new_channel():
+    connection = await get_pika_connection()
+    return await connection.channel()
+
+
+async def get_pika_connection():
+    """Return the shared robust connection, opening it if it does not exist yet."""
+    global _connection, _channel_pool, _loop, _lock
+    loop = asyncio.get_running_loop()
+    if _loop is not loop:
+        close_stale(_loop, [stale.close for stale in (_channel_pool, _connection) if stale is not None])
+        _connection, _channel_pool, _loop, _lock = None, None, loop, asyncio.Lock()
+    async with _lock:
+        if _connection is None or _connection.is_closed:
+            logger.info(f"Opening shared rabbitmq connection to {Q_HOST}")
+            _connection = await aio_pika.connect_robust(host=Q_HOST, login=Q_USERNAME, password=Q_PASSWORD)
+            _channel_pool = Pool(_new_channel, max_size=CHANNEL_POOL_SIZE)
+    return _connection
+
+
+@asynccontextmanager
+async def pika_channel():
+    """Borrow a channel from the pool for the duration of the context."""
+    await get_pika_connection()
+    pool = _channel_pool
+    async with pool.acquire() as channel:
+        # A channel is closed by the broker on a channel level error (e.g. a missing queue), so revive it before use
+        if channel.is_closed:
+            await channel.reopen()
+        yield channel
+
+
+async def init_pika_pool():
+    """Open the shared connection at app startup.  Failure is not fatal; we'll retry on first use."""
+    try:
+        await get_pika_connection()
+    except Exception as e:
+        logger.error(f"Unable to connect to rabbitmq at startup: {e}")
+
+
+async def close_pika_pool():
+    """Close the channel pool and the shared connection at app shutdown."""
+    global _connection, _channel_pool
+    if _channel_pool is not None:
+        await _channel_pool.close()
+    if _connection is not None:
+        await _connection.close()
+    _connection, _channel_pool = None, None
@@ -0,0 +1,160 @@
+"""Canonical forms of TRAPI query graphs, for keying the lookup cache.
+
+The same question can come in with different qnode and qedge ids, with optional fields set to their defaults or left
+out, and with ids, categories and predicates in any order.  canonicalize_query_graph drops the default valued
+fields, sorts those lists, and renames the qnodes n0, n1, ... and the qedges e0, e1, ... in an order that depends only
+on the shape of the graph, so all of those spellings of a question get the same canonical query graph.
+
+The nodes are ordered by colour refinement: a node starts out labelled by its own contents, and is relabelled by its
+label plus the labels of its edges and neighbours until the labelling stops changing.  Nodes that are still tied
+(which, for real queries, means they're interchangeable) are ordered by trying each order and keeping the one that
+serializes smallest, up to MAX_TIE_ORDERS orders; past that, ties are broken by the caller's ids.  That can only
+cost cache hits, never give a wrong one, since any labelling of the graph describes the same query.
+
+relabel_message renames the bindings in a message's results between the caller's ids and the canonical ones.
+canonicalize_workflow renames the qnodes that workflow operations refer to, so that a workflow is keyed along with the
+canonical query graph.
+"""
+import itertools
+import json
+from math import factorial
+from typing import Dict, NamedTuple
+
+MAX_TIE_ORDERS = 720
+
+# Fields that mean the same thing whether they're given their default value or left out
+QNODE_DEFAULTS = {"is_set": False, "set_interpretation": "BATCH", "constraints": [], "member_ids": []}
+QEDGE_DEFAULTS = {"knowledge_type": "lookup", "attribute_constraints": [], "qualifier_constraints": [], "exclude": False}
+# Lists whose order doesn't matter
+UNORDERED_FIELDS = ("ids", "categories", "predicates", "member_ids")
+# Workflow operation parameters that name a qnode
+QNODE_PARAMETERS = ("merge_qnode",)
+
+
+class CanonicalQueryGraph(NamedTuple):
+    """The canonical query graph, and the caller's qnode and qedge ids mapped to the canonical ones."""
+    query_graph: dict
+    node_ids: Dict[str, str]
+    edge_ids: Dict[str, str]
+
+
+def normalize_element(element, defaults):
+    normalized = {}
+    for key, value in element.items():
+        if value is None or (key in defaults and value == defaults[key]):
+            continue
+        if key in UNORDERED_FIELDS and isinstance(value, list):
+            value = sorted(value, key=str)
+        normalized[key] = value
+    return normalized
+
+
+def normalize_query_graph(query_graph):
+    """A copy of query_graph without default valued fields and with the unordered lists sorted.  Ids are unchanged."""
+    return {
+        "nodes": {qnode_id: normalize_element(qnode, QNODE_DEFAULTS) for qnode_id, qnode in query_graph["nodes"].items()},
+        "edges": {qedge_id: normalize_element(qedge, QEDGE_DEFAULTS) for qedge_id, qedge in query_graph["edges"].items()},
+    }
+
+
+def signature(element):
+    return json.dumps(element, sort_keys=True)
+
+
+def rank(labels):
+    """Replace labels by their position among the distinct labels, to keep them short."""
+    order = {label: i for i, label in enumerate(sorted(set(labels.values())))}
+    return {key: order[label] for key, label in labels.items()}
+
+
+def refine_node_labels(nodes, edges):
+    edge_signatures = {
+        qedge_id: signature({k: v for k, v in qedge.items() if k not in ("subject", "object")}) for qedge_id, qedge in edges.items()
+    }
+    labels = rank({qnode_id: signature(qnode) for qnode_id, qnode in nodes.items()})
+    while True:
+        neighbourhoods = {qnode_id: [] for qnode_id in nodes}
+        for qedge_id, qedge in edges.items():
+            subject, object = qedge["subject"], qedge["object"]
+            neighbourhoods[subject].append(("out", edge_signatures[qedge_id], labels[object]))
+            neighbourhoods[object].append(("in", edge_signatures[qedge_id], labels[subject]))
+        refined = rank({qnode_id: json.dumps([labels[qnode_id], sorted(neighbourhoods[qnode_id])]) for qnode_id in nodes})
+        if len(set(refined.values())) == len(set(labels.values())):
+            return refined, edge_signatures
+        labels = refined
+
+
+def relabel_query_graph(nodes, edges, node_order, edge_signatures):
+    node_ids = {qnode_id: f"n{i}" for i, qnode_id in enumerate(node_order)}
+    position = {qnode_id: i for i, qnode_id in enumerate(node_order)}
+    edge_order = sorted(edges, key=lambda e: (position[edges[e]["subject"]], position[edges[e]["object"]], edge_signatures[e]))
+    edge_ids = {qedge_id: f"e{i}" for i, qedge_id in enumerate(edge_order)}
+    query_graph = {
+        "nodes": {node_ids[qnode_id]: nodes[qnode_id] for qnode_id in node_order},
+        "edges": {
+            edge_ids[qedge_id]: dict(edges[qedge_id], subject=node_ids[edges[qedge_id]["subject"]], object=node_ids[edges[qedge_id]["object"]])
+            for qedge_id in edge_order
+        },
+    }
+    return CanonicalQueryGraph(query_graph, node_ids, edge_ids)
+
+
+def canonicalize_query_graph(query_graph) -> CanonicalQueryGraph:
+    normalized = normalize_query_graph(query_graph)
+    nodes, edges = normalized["nodes"], normalized["edges"]
+    labels, edge_signatures = refine_node_labels(nodes, edges)
+    tied = [sorted(qnode_id for qnode_id in nodes if labels[qnode_id] == label) for label in sorted(set(labels.values()))]
+    n_orders = 1
+    for group in tied:
+        n_orders *= factorial(len(group))
+    if n_orders == 1 or n_orders > MAX_TIE_ORDERS:
+        return relabel_query_graph(nodes, edges, [qnode_id for group in tied for qnode_id in group], edge_signatures)
+    best, best_signature = None, None
+    for orders in itertools.product(*(itertools.permutations(group) for group in tied)):
+        candidate = relabel_query_graph(nodes, edges, [qnode_id for group in orders for qnode_id in group], edge_signatures)
+        candidate_signature = signature(candidate.query_graph)
+        if best is None or candidate_signature < best_signature:
+            best, best_signature = candidate, candidate_signature
+    return best
+
+
+def canonicalize_workflow(workflow, node_ids):
+    """A copy of workflow with the qnode ids in its operations' parameters (QNODE_PARAMETERS) renamed with
+    node_ids.  Without this, merging on different nodes of the same canonical query graph would share a cache key."""
+    canonical = []
+    for op in workflow:
+        parameters = op.get("parameters") or {}
+        if any(name in parameters for name in QNODE_PARAMETERS):
+            parameters = {
+                name: node_ids.get(value, value) if name in QNODE_PARAMETERS and isinstance(value, str) else value
+                for name, value in parameters.items()
+            }
+            op = dict(op, parameters=parameters)
+        canonical.append(op)
+    return canonical
+
+
+def invert(mapping):
+    return {value: key for key, value in mapping.items()}
+
+
+def relabel_analysis(analysis, edge_ids):
+    if "edge_bindings" not in analysis:
+        return analysis
+    return dict(analysis, edge_bindings={edge_ids.get(qedge_id, qedge_id): b for qedge_id, b in analysis["edge_bindings"].items()})
+
+
+def relabel_message(message, query_graph, node_ids, edge_ids):
+    """A copy of message with query_graph as its query graph, and its result bindings renamed with node_ids and
+    edge_ids.  The results and analyses are copied as far as the renamed bindings, the rest is shared."""
+    results = []
+    for result in message.get("results") or []:
+        result = dict(result)
+        result["node_bindings"] = {node_ids.get(qnode_id, qnode_id): b for qnode_id, b in result.get("node_bindings", {}).items()}
+        if "analyses" in result:
+            result["analyses"] = [relabel_analysis(analysis, edge_ids) for analysis in result["analyses"]]
+        results.append(result)
+    relabelled = dict(message, query_graph=query_graph)
+    if message.get("results") is not None:
+        relabelled["results"] = results
+    return relabelled
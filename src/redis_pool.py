@@ -0,0 +1,52 @@
+"""Process-wide asyncio redis clients.
+
+Each (host, port, db) gets one client, and so one connection pool, for the life of the process, rather than a new
+pair of pools on every request.  The clients are created at app startup (or on first use) and closed at shutdown.
+CACHE_MAX_CONNECTIONS caps the connections in each pool.
+"""
+import logging
+import os
+from functools import partial
+
+import redis.asyncio
+
+from src.loop_bound import close_stale, running_loop
+
+logger = logging.getLogger(__name__)
+
+CACHE_MAX_CONNECTIONS = int(os.environ.get("CACHE_MAX_CONNECTIONS", 50))
+
+_clients = {}
+# The loop the clients were made on, see loop_bound
+_loop = None
+
+
+def get_redis(host, port, db, password=None):
+    """Return the shared client for a redis db."""
+    global _clients, _loop
+    loop = running_loop()
+    if loop is not _loop:
+        close_stale(_loop, [partial(client.close, close_connection_pool=True) for client in _clients.values()])
+        _clients, _loop = {}, loop
+    key = (host, str(port), str(db), password)
+    client = _clients.get(key)
+    if client is None:
+        client = _clients[key] = redis.asyncio.StrictRedis(
+            host=host,
+            port=port,
+            db=db,
+            password=password,
+            max_connections=CACHE_MAX_CONNECTIONS,
+        )
+    return client
+
+
+async def close_redis_pools():
+    """Close every client and its connection pool at app shutdown."""
+    global _clients
+    clients, _clients = _clients, {}
+    for client in clients.values():
+        try:
+            await client.close(close_connection_pool=True)
+        except Exception as e:
+            logger.warning(f"Error closing redis connection: {e}")
@@ -1,8 +1,16 @@
+import asyncio
+import hashlib
+import logging
 import os
-import redis
+import time
 import json
-import gzip
+from typing import NamedTuple
 from fastapi import HTTPException, status
+from src.cache_format import decode_value, encode_value
+from src.redis_pool import get_redis
+from src.worker_pool import run_cpu_bound
+
+logger = logging.getLogger(__name__)
 
 CACHE_HOST = os.environ.get("CACHE_HOST", "localhost")
 CACHE_PORT = os.environ.get("CACHE_PORT", "6379")
@@ -10,6 +18,80 @@ CREATIVE_CACHE_DB = os.environ.get("CREATIVE_CACHE_DB", "0")
 LOOKUP_CACHE_DB = os.environ.get("LOOKUP_CACHE_DB", "1")
 CACHE_PASSWORD = os.environ.get("CACHE_PASSWORD", "")
 
+# Entries are fresh for the cache's TTL, and then stale for CACHE_STALE_TTL more: stale entries are still returned,
+# but the caller should recompute them (see entry()).  After that they're gone.  A TTL of 0 means forever.
+CREATIVE_CACHE_TTL = int(os.environ.get("CREATIVE_CACHE_TTL", 7 * 24 * 60 * 60))
+LOOKUP_CACHE_TTL = int(os.environ.get("LOOKUP_CACHE_TTL", 24 * 60 * 60))
+CACHE_STALE_TTL = int(os.environ.get("CACHE_STALE_TTL", 7 * 24 * 60 * 60))
+
+# Look for creative entries under the old, unhashed keys when the hashed key misses.  Turn this off once the cache
+# has been migrated (python -m src.migrate_cache_keys).  Lookup keys are built from the canonical query graph, which
+# the old keys weren't, so an old lookup entry can never be found again and isn't looked for.
+CACHE_READ_LEGACY_KEYS = os.environ.get("CACHE_READ_LEGACY_KEYS", "True") == "True"
+
+# Cache writes still in flight.  Holding them here keeps them from being garbage collected before they finish.
+_pending_writes = set()
+
+
+class CacheHit(NamedTuple):
+    """A cached answer.  stale means it's past its TTL, or was computed by another version of the rules."""
+    value: dict
+    stale: bool
+
+
+class CacheKey(NamedTuple):
+    """key is what the entry is stored under, canonical is the full description of the query that it hashes."""
+    key: str
+    canonical: str
+
+
+def short_hash(text, digest_size):
+    return hashlib.blake2b(text.encode(), digest_size=digest_size).hexdigest()
+
+
+def make_cache_key(kind, keydict):
+    """Keys look like creative:ARAGORN:1f2e3d4c:biolink:treats:<hash of the canonical key>, or
+    lookup:1f2e3d4c:<hash>, where 1f2e3d4c is a hash of the workflow, or rule:strider:<hash>.  The readable part is
+    there so that the cache can be scanned by caller, service, workflow or predicate.  The canonical key is the sorted
+    json of keydict, which is also what the entries were stored under before the keys were hashed."""
+    canonical = json.dumps(keydict, sort_keys=True)
+    parts = [kind]
+    for field in ("caller", "service"):
+        if field in keydict:
+            parts.append(str(keydict[field]))
+    if "workflow" in keydict:
+        parts.append(short_hash(json.dumps(keydict["workflow"], sort_keys=True), 4))
+    if "predicate" in keydict:
+        parts.append(str(keydict["predicate"]))
+    parts.append(short_hash(canonical, 16))
+    return CacheKey(":".join(parts), canonical)
+
+
+async def move_legacy_entry(redis_client, key, value):
+    """Store an entry that was under its canonical key under its hashed key instead."""
+    async with redis_client.pipeline(transaction=True) as pipeline:
+        pipeline.hset(key.key, mapping={"key": key.canonical, "value": value})
+        pipeline.delete(key.canonical)
+        await pipeline.execute()
+
+
+async def store_value(redis_client, key, value, ttl=None, fields=None):
+    """Store an encoded value, with its canonical key and any other fields, expiring after ttl seconds if given."""
+    async with redis_client.pipeline(transaction=True) as pipeline:
+        pipeline.hset(key.key, mapping=dict(fields or {}, key=key.canonical, value=value))
+        if ttl:
+            pipeline.expire(key.key, ttl)
+        await pipeline.execute()
+
+
+def track_write(coroutine):
+    """Run a cache write in the background, and keep hold of it until it's done.  Returns the task."""
+    task = asyncio.create_task(coroutine)
+    _pending_writes.add(task)
+    task.add_done_callback(_pending_writes.discard)
+    return task
+
+
 class ResultsCache:
     def __init__(
         self,
@@ -18,88 +100,152 @@ class ResultsCache:
         creative_redis_db=CREATIVE_CACHE_DB,
         lookup_redis_db=LOOKUP_CACHE_DB,
         redis_password=CACHE_PASSWORD,
+        ruleset_version="",
     ):
-        """Connect to cache."""
-        self.creative_redis = redis.StrictRedis(
-            host=redis_host,
-            port=redis_port,
-            db=creative_redis_db,
-            password=redis_password,
-        )
-        self.lookup_redis = redis.StrictRedis(
-            host=redis_host,
-            port=redis_port,
-            db=lookup_redis_db,
-            password=redis_password,
-        )
+        """Connect to cache.  The connection pools are shared by every ResultsCache in the process.
+        Creative entries are tagged with ruleset_version, and ones with another version are stale."""
+        self.creative_redis = get_redis(redis_host, redis_port, creative_redis_db, redis_password)
+        self.lookup_redis = get_redis(redis_host, redis_port, lookup_redis_db, redis_password)
+        self.ruleset_version = ruleset_version
 
     def get_query_key(self, input_id, predicate, qualifiers, source_input, caller, workflow, mcq, member_ids):
         keydict = {'predicate': predicate, 'source_input': source_input, 'input_id': input_id, 'caller': caller, 'workflow': workflow}
         keydict.update(qualifiers)
         if mcq:
             #because we already have a bunch of keys without mcq, we only want to add these if we are doing the new mcq.
-            member_ids.sort()
             keydict['mcq'] = True
-            keydict['member_ids'] = member_ids
-        return json.dumps(keydict, sort_keys=True)
+            keydict['member_ids'] = sorted(member_ids)
+        return make_cache_key("creative", keydict)
 
-    def get_result(self, input_id, predicate, qualifiers, source_input, caller, workflow, mcq, member_ids):
+    async def get_result(self, input_id, predicate, qualifiers, source_input, caller, workflow, mcq, member_ids):
         key = self.get_query_key(input_id, predicate, qualifiers, source_input, caller, workflow, mcq, member_ids)
-        try:
-            result = self.creative_redis.get(key)
-            if result is not None:
-                result = json.loads(gzip.decompress(result))
-        except Exception:
-            # failed to get result from cache
-            result = None
-            pass
-        return result
-
+        return await self.get_value(self.creative_redis, key, CREATIVE_CACHE_TTL, self.ruleset_version, CACHE_READ_LEGACY_KEYS)
 
-    def set_result(self, input_id, predicate, qualifiers, source_input, caller, workflow, mcq, member_ids, final_answer):
+    async def set_result(self, input_id, predicate, qualifiers, source_input, caller, workflow, mcq, member_ids, final_answer):
         key = self.get_query_key(input_id, predicate, qualifiers, source_input, caller, workflow, mcq, member_ids)
-
-        try:
-            self.creative_redis.set(key, gzip.compress(json.dumps(final_answer).encode()))
-        except Exception:
-            # failed to save result to cache
-            pass
+        return self.set_value_in_background(self.creative_redis, key, final_answer, CREATIVE_CACHE_TTL, self.ruleset_version)
 
     def get_lookup_query_key(self, workflow, query_graph):
         keydict = {'workflow': workflow, 'query_graph': query_graph}
-        return json.dumps(keydict, sort_keys=True)
+        return make_cache_key("lookup", keydict)
+
+    async def get_lookup_result(self, workflow, query_graph):
+        key = self.get_lookup_query_key(workflow, query_graph)
+        return await self.get_value(self.lookup_redis, key, LOOKUP_CACHE_TTL)
 
-    def get_lookup_result(self, workflow, query_graph):
+    async def set_lookup_result(self, workflow, query_graph, final_answer):
         key = self.get_lookup_query_key(workflow, query_graph)
+        return self.set_value_in_background(self.lookup_redis, key, final_answer, LOOKUP_CACHE_TTL)
+
+    async def get_value(self, redis_client, key, ttl=0, version="", read_legacy=False):
+        """A CacheHit for key, or None.  With read_legacy, an entry still under its old key is found (and moved) too."""
         try:
-            result = self.lookup_redis.get(key)
-            if result is not None:
-                result = json.loads(gzip.decompress(result))
+            canonical, result, written, written_version = await redis_client.hmget(key.key, "key", "value", "written", "version")
+            if result is not None and canonical.decode() != key.canonical:
+                # two queries hashed to the same key.  Vanishingly unlikely, but don't hand back the wrong answer.
+                logger.warning(f"Results cache key collision on {key.key}")
+                result = None
+            elif result is None and read_legacy:
+                result = await self.get_legacy_value(redis_client, key)
+            if result is None:
+                return None
+            # Entries from before there were TTLs have no written time, and are stale
+            stale = written is None or (written_version or b"").decode() != version or (
+                ttl and time.time() - float(written) > ttl
+            )
+            # decompressing and parsing a big answer is slow, keep it off the event loop
+            return CacheHit(await run_cpu_bound(decode_value, result), bool(stale))
         except Exception:
-            # failed to get lookup result
-            result = None
-            pass
-        return result
+            # failed to get result from cache
+            return None
 
+    async def get_legacy_value(self, redis_client, key):
+        """Entries written before the keys were hashed are stored under the canonical key itself.  Move one to its
+        hashed key when it's read."""
+        result = await redis_client.get(key.canonical)
+        if result is not None:
+            await move_legacy_entry(redis_client, key, result)
+        return result
 
-    def set_lookup_result(self, workflow, query_graph, final_answer):
-        key = self.get_lookup_query_key(workflow, query_graph)
+    def set_value_in_background(self, redis_client, key, final_answer, ttl=0, version=""):
+        """Write final_answer to the cache without holding up the response.  Returns the write's task.
+        The caller goes on to add things (status, pid) to the top level of the answer, so the write takes a
+        shallow copy of it now."""
+        return track_write(self.set_value(redis_client, key, dict(final_answer), ttl, version))
 
+    async def set_value(self, redis_client, key, final_answer, ttl=0, version=""):
         try:
-            self.lookup_redis.set(key, gzip.compress(json.dumps(final_answer).encode()))
-        except Exception:
-            # failed to save lookup result
-            pass
+            value = await run_cpu_bound(encode_value, final_answer)
+            # Keep the entry through its stale period, unless it's kept forever
+            expire = ttl + CACHE_STALE_TTL if ttl else None
+            await store_value(redis_client, key, value, expire, {"written": time.time(), "version": version})
+        except Exception as e:
+            # failed to save result to cache
+            logger.warning(f"Failed to write to the results cache: {e}")
+
+    async def clear_creative_cache(self):
+        await self.creative_redis.flushdb()
+
+    async def clear_lookup_cache(self):
+        await self.lookup_redis.flushdb()
 
-    
-    def clear_creative_cache(self):
-        self.creative_redis.flushdb()
+    async def flush_creative_cache(self, predicate=None, curie=None, version=None):
+        """Remove the creative entries for a predicate, a curie and/or a rule set version.  Returns the number
+        removed."""
+        # The predicate is in the readable part of the creative keys, so only those keys need looking at
+        pattern = f"creative:*:*:{predicate}:*" if predicate else "creative:*"
+        return await flush_entries(self.creative_redis, pattern, curie=curie, version=version)
 
-    def clear_lookup_cache(self):
-        self.lookup_redis.flushdb()
+    async def flush_lookup_cache(self, predicate=None, curie=None, version=None):
+        """Remove the lookup entries for a predicate, a curie and/or a rule set version.  Returns the number
+        removed."""
+        return await flush_entries(self.lookup_redis, "lookup:*", predicate=predicate, curie=curie, version=version)
 
-    def ping_cache(self):
+    async def ping_cache(self):
         try:
-            self.creative_redis.ping()
+            await self.creative_redis.ping()
         except Exception:
             raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE)
+
+
+async def flush_entries(redis_client, pattern, predicate=None, curie=None, version=None, batch_size=500):
+    """Remove the entries matching pattern whose canonical key mentions predicate and curie, and that were written
+    by version, whichever of them are given.  Scans in batches, so it can run against a live cache."""
+    needles = [json.dumps(s) for s in (predicate, curie) if s is not None]
+    removed = 0
+    keys = []
+
+    async def flush_batch():
+        async with redis_client.pipeline(transaction=False) as pipeline:
+            for key in keys:
+                pipeline.hmget(key, "key", "version")
+            entries = await pipeline.execute()
+        doomed = [
+            key for key, (canonical, written_version) in zip(keys, entries)
+            if canonical is not None
+            and all(needle in canonical.decode() for needle in needles)
+            and (version is None or (written_version or b"").decode() == version)
+        ]
+        if doomed:
+            await redis_client.unlink(*doomed)
+        return len(doomed)
+
+    async for key in redis_client.scan_iter(match=pattern, count=batch_size):
+        keys.append(key)
+        if len(keys) >= batch_size:
+            removed += await flush_batch()
+            keys = []
+    if keys:
+        removed += await flush_batch()
+    return removed
+
+
+async def init_results_cache():
+    """Create the connection pools at app startup."""
+    ResultsCache()
+
+
+async def flush_cache_writes():
+    """Wait for the cache writes that are still in flight, e.g. at shutdown."""
+    if _pending_writes:
+        await asyncio.gather(*_pending_writes, return_exceptions=True)
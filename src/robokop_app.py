@@ -15,10 +15,11 @@ from src.common import sync_query, async_query, status_query
 from src.default_queries import default_input_sync, default_input_async
 # import open telemetery configuration
 from src.otel_config import configure_otel
+from src.json_codec import TRAPIJSONResponse
 
 # declare the FastAPI details
 title = "ROBOKOP"
-ROBOKOP_APP = FastAPI(title=title)
+ROBOKOP_APP = FastAPI(title=title, default_response_class=TRAPIJSONResponse)
 service_name = os.environ.get('OTEL_SERVICE_NAME', 'ARAGORN') + '-' + title
 configure_otel(service_name=service_name, APP=ROBOKOP_APP)
 # Set up default logger.
@@ -0,0 +1,105 @@
+"""Cache of the responses to individual rule queries.
+
+An infer query is expanded into ~100 rule queries (expand_query), and the creative cache only holds the merged
+answer, so a change to the workflow or an expired entry meant sending all of them again, even though many rule
+instantiations are shared between predicates and repeated across requests.  This caches each rule query's cleaned
+response, keyed by the service it went to and the canonical form of the filled in query (and, for MCQ, the member_of
+knowledge graph that goes with it), so that only the rules that miss are sent.
+
+Responses are stored with their bindings relabelled to the canonical query graph, and relabelled back to the ids of
+the query that asked for them on a hit.  Only usable responses are cached, so a rule that failed or timed out is
+sent again next time.  Entries expire after RULE_CACHE_TTL seconds, and live in RULE_CACHE_DB.
+"""
+import logging
+import os
+from collections import Counter
+from typing import NamedTuple
+
+from src.cache_format import decode_value, encode_value
+from src.query_canonicalizer import CanonicalQueryGraph, canonicalize_query_graph, invert, relabel_message
+from src.redis_pool import get_redis
+from src.results_cache import CACHE_HOST, CACHE_PASSWORD, CACHE_PORT, CacheKey, make_cache_key, store_value, track_write
+from src.worker_pool import run_cpu_bound
+
+logger = logging.getLogger(__name__)
+
+RULE_CACHE_DB = os.environ.get("RULE_CACHE_DB", "3")
+RULE_CACHE_TTL = int(os.environ.get("RULE_CACHE_TTL", 24 * 60 * 60))
+
+_stats = Counter()
+
+
+class RuleKey(NamedTuple):
+    key: CacheKey
+    canonical: CanonicalQueryGraph
+
+
+def encode_rule_response(rmessage, rule_key):
+    """Encode a cleaned rule response for the cache, bound to the canonical query graph.  Runs in the worker pool."""
+    canonical = rule_key.canonical
+    message = relabel_message(rmessage["message"], canonical.query_graph, canonical.node_ids, canonical.edge_ids)
+    return encode_value(dict(rmessage, message=message))
+
+
+def decode_rule_response(value, rule_key, query_graph):
+    """Decode a cached rule response, bound to query_graph.  Runs in the worker pool."""
+    rmessage = decode_value(value)
+    canonical = rule_key.canonical
+    rmessage["message"] = relabel_message(rmessage["message"], query_graph, invert(canonical.node_ids), invert(canonical.edge_ids))
+    return rmessage
+
+
+class RuleCache:
+    def __init__(self, service, redis_host=CACHE_HOST, redis_port=CACHE_PORT, redis_db=RULE_CACHE_DB,
+                 redis_password=CACHE_PASSWORD, ttl=RULE_CACHE_TTL):
+        self.service = service
+        self.redis = get_redis(redis_host, redis_port, redis_db, redis_password)
+        self.ttl = ttl
+
+    def get_key(self, query) -> RuleKey:
+        canonical = canonicalize_query_graph(query["message"]["query_graph"])
+        keydict = {"service": self.service, "query_graph": canonical.query_graph}
+        if query["message"].get("knowledge_graph"):
+            keydict["knowledge_graph"] = query["message"]["knowledge_graph"]
+        return RuleKey(make_cache_key("rule", keydict), canonical)
+
+    async def get_responses(self, queries, guid=""):
+        """The cached response to each query, or None where there isn't one."""
+        rule_keys = [self.get_key(query) for query in queries]
+        try:
+            async with self.redis.pipeline(transaction=False) as pipeline:
+                for rule_key in rule_keys:
+                    pipeline.hmget(rule_key.key.key, "key", "value")
+                entries = await pipeline.execute()
+        except Exception as e:
+            logger.warning(f"{guid}: Failed to read rule cache: {e}")
+            entries = [(None, None)] * len(queries)
+        responses = []
+        for query, rule_key, (canonical, value) in zip(queries, rule_keys, entries):
+            response = None
+            if value is not None and canonical.decode() == rule_key.key.canonical:
+                try:
+                    response = await run_cpu_bound(decode_rule_response, value, rule_key, query["message"]["query_graph"])
+                except Exception as e:
+                    logger.warning(f"{guid}: Failed to decode rule cache entry {rule_key.key.key}: {e}")
+            responses.append(response)
+        hits = sum(response is not None for response in responses)
+        _stats["hits"] += hits
+        _stats["misses"] += len(responses) - hits
+        logger.info(f"{guid}: {hits} of {len(queries)} {self.service} rule queries found in the rule cache")
+        return responses
+
+    def set_response_in_background(self, rule_key, value):
+        """Store a response that encode_rule_response has already encoded.  Returns the write's task."""
+        return track_write(self.set_response(rule_key, value))
+
+    async def set_response(self, rule_key, value):
+        try:
+            await store_value(self.redis, rule_key.key, value, self.ttl)
+        except Exception as e:
+            logger.warning(f"Failed to write to the rule cache: {e}")
+
+
+def rule_cache_stats():
+    lookups = _stats["hits"] + _stats["misses"]
+    return dict(_stats, lookups=lookups, hit_rate=_stats["hits"] / lookups if lookups else 0.0)
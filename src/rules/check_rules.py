@@ -13,7 +13,9 @@ def get_nres(m):
     return len(results)
 
 r = get_redis()
-ks = r.keys()
+# gather_robokop_results.py writes plain json under the disease ids.  Skip the results cache's lookup entries, which
+# are hashes under lookup:* keys when the lookup cache shares the db.
+ks = [ k for k in r.keys() if not k.startswith(b'lookup:') ]
 print(f'{len(ks)} results')
 
 identifiers = [ k.decode() for k in ks ]
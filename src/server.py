@@ -7,13 +7,21 @@ from fastapi.middleware.cors import CORSMiddleware
 from src.aragorn_app import ARAGORN_APP
 from src.robokop_app import ROBOKOP_APP
 from src.openapi_constructor import construct_open_api_schema
+from src.callback_transport import get_callback_transport
+from src.worker_pool import start_worker_pool, shutdown_worker_pool
+from src.json_codec import TRAPIJSONResponse
+from src.http_clients import init_http_clients, close_http_clients, http_pool_stats
+from src.nodenorm_cache import nodenorm_cache_stats
+from src.rule_cache import rule_cache_stats
+from src.results_cache import init_results_cache, flush_cache_writes
+from src.redis_pool import close_redis_pools
 
 #The app version is now going to be set in ../openapi-config.yaml
 #if you want to bump it, do it there.
 #Note that it's set once and applies to both robokop and aragorn (b/c they share much of their implementation)
 #APP_VERSION = '2.0.24'
 
-APP = FastAPI(title="ARAGORN/ROBOKOP")
+APP = FastAPI(title="ARAGORN/ROBOKOP", default_response_class=TRAPIJSONResponse)
 
 # Mount aragorn app at /aragorn
 APP.mount('/aragorn',  ARAGORN_APP, 'ARAGORN')
@@ -34,3 +42,38 @@ APP.add_middleware(
     allow_headers=["*"],
 )
 
+# Mounted apps don't get lifespan events, so shared resources are managed here.
+@APP.on_event("startup")
+async def startup():
+    start_worker_pool()
+    await init_http_clients()
+    await init_results_cache()
+    await get_callback_transport().start()
+
+
+@APP.on_event("shutdown")
+async def shutdown():
+    await get_callback_transport().stop()
+    await flush_cache_writes()
+    await close_redis_pools()
+    await close_http_clients()
+    shutdown_worker_pool()
+
+
+@APP.get("/http_pool_stats", include_in_schema=False)
+async def get_http_pool_stats():
+    """Connection pool statistics for each upstream service."""
+    return await http_pool_stats()
+
+
+
+@APP.get("/nodenorm_cache_stats", include_in_schema=False)
+async def get_nodenorm_cache_stats():
+    """Hit and miss counts for the node normalizer cache."""
+    return nodenorm_cache_stats()
+
+
+@APP.get("/rule_cache_stats", include_in_schema=False)
+async def get_rule_cache_stats():
+    """Hit and miss counts for the rule query cache."""
+    return rule_cache_stats()
@@ -1,38 +1,42 @@
 """Literature co-occurrence support."""
 from itertools import combinations
 
-import aio_pika
 import json
 import logging
 import asyncio
 import httpx
 import os
 from collections import defaultdict
+from contextlib import aclosing
 from copy import deepcopy
-from datetime import datetime as dt, timedelta
+from dataclasses import dataclass
 from string import Template
 
-from functools import partial
+from functools import lru_cache, partial
 from src.util import create_log_entry
-from src.operations import sort_results_score, filter_results_top_n, filter_kgraph_orphans, filter_message_top_n
-from src.results_cache import ResultsCache
+from src.operations import sort_results_score, filter_results_top_n, filter_kgraph_orphans, filter_message_top_n, remove_kgraph_orphans
+from src.results_cache import ResultsCache, short_hash
+from src.query_canonicalizer import canonicalize_query_graph, canonicalize_workflow, invert, normalize_query_graph, relabel_message, signature
+from src.rule_cache import RuleCache, encode_rule_response
+from src.single_flight import SINGLE_FLIGHT, run_once
 from src.process_db import add_item
 from datetime import datetime
-from requests.models import Response
 from requests.exceptions import ConnectionError
 from asyncio.exceptions import TimeoutError
-from reasoner_pydantic import Query, KnowledgeGraph, QueryGraph
+from reasoner_pydantic import Query, QueryGraph
 from reasoner_pydantic import Response as PDResponse
 from src.shadowfax import shadowfax
-import uuid
+from src.callback_transport import get_callback_transport
+from src.kgraph_merge import KnowledgeGraphMerger, freeze
+from src.worker_pool import run_cpu_bound, run_in_thread
+from src import json_codec
+from src.http_clients import get_http_client
+from src.nodenorm_cache import get_normalized_nodes
 
 DUMPTRUCK = False
 
 logger = logging.getLogger(__name__)
 
-# declare the directory where the async data files will exist
-queue_file_dir = "./queue-files"
-
 #Load in the AMIE rules.
 thisdir = os.path.dirname(__file__)
 rulefiles = [os.path.join(thisdir,"rules","kara_typed_rules","rules_with_types_cleaned_finalized.json")]
@@ -41,6 +45,18 @@ AMIE_EXPANSIONS = {}
 for rulefile in rulefiles:
     with open(rulefile,'r') as inf:
         AMIE_EXPANSIONS.update(json.load(inf))
+# Creative answers cached with other rules are stale
+RULESET_VERSION = short_hash(json.dumps(AMIE_EXPANSIONS, sort_keys=True), 4)
+
+DEFAULT_INFER_WORKFLOW = [
+    {"id": "lookup"},
+    {"id": "overlay_connect_knodes"},
+    {"id": "score"},
+    {"id": "filter_message_top_n", "parameters": {"max_results": 500}},
+]
+
+# Cache refreshes running in the background
+_refreshes = set()
 
 def examine_query(message):
     """Decides whether the input is an infer. Returns the grouping node"""
@@ -141,7 +157,7 @@ async def entry(message, guid, coalesce_type, caller) -> (dict, int):
     #  e.g. our score operation will include both weighting and scoring for now.
     # Also gives us a place to handle function specific logic
     known_operations = {
-        "lookup": partial(lookup, caller=caller, infer=infer, pathfinder=pathfinder, answer_qnode=answer_qnode, question_qnode=question_qnode, bypass_cache=bypass_cache),
+        "lookup": partial(lookup, caller=caller, infer=infer, pathfinder=pathfinder, answer_qnode=answer_qnode, question_qnode=question_qnode, bypass_cache=bypass_cache, overwrite_cache=overwrite_cache),
         "enrich_results": partial(answercoalesce, coalesce_type=coalesce_type),
         "overlay_connect_knodes": omnicorp,
         "score": score,
@@ -162,12 +178,7 @@ async def entry(message, guid, coalesce_type, caller) -> (dict, int):
         del message["workflow"]
     else:
         if infer:
-            workflow_def = [
-                {"id": "lookup"},
-                {"id": "overlay_connect_knodes"},
-                {"id": "score"},
-                {"id": "filter_message_top_n", "parameters": {"max_results": 500}},
-            ]
+            workflow_def = deepcopy(DEFAULT_INFER_WORKFLOW)
         elif pathfinder: 
             # ignoring scoring for now, will have to work on this
             workflow_def = [
@@ -199,30 +210,47 @@ async def entry(message, guid, coalesce_type, caller) -> (dict, int):
         query_graph = message["message"]["query_graph"]
     except KeyError:
         return f"No query graph", 422
-    results_cache = ResultsCache()
+    results_cache = ResultsCache(ruleset_version=RULESET_VERSION)
     results = None
     if infer:
         # We're going to cache infer queries, and we need to do that even if we're overriding the cache
         # because we need these values to post to the cache at the end.
         input_id, predicate, qualifiers, source, source_input, target, qedge_id, mcq, member_ids = get_infer_parameters(message)
-        if read_from_cache:
-            results = results_cache.get_result(input_id, predicate, qualifiers, source_input, caller, workflow_def, mcq, member_ids)
-            if results is not None:
-                logger.info(f"{guid}: Returning results cache lookup")
-                # The results can't go verbatim.  While the essense of the query is the same as the cached result,
-                # the details may differ. In particular the names of the query nodes and edges may be different.
-                results = match_results_to_query(results, message, source, target, qedge_id)
-                return results, 200
-            else:
-                logger.info(f"{guid}: Results cache miss")
-    else:
+        # One line per infer query, which the cache warmer can mine for popular queries
+        logger.info(f"{guid}: Infer query " + json.dumps({"caller": caller, "curie": input_id, "predicate": predicate,
+                                                          "source_input": source_input, **qualifiers}))
+        cache_key = results_cache.get_query_key(input_id, predicate, qualifiers, source_input, caller, workflow_def, mcq, member_ids)
+        cache_redis = results_cache.creative_redis
+
+        async def read_cache():
+            return await results_cache.get_result(input_id, predicate, qualifiers, source_input, caller, workflow_def, mcq, member_ids)
+
+        def from_cache(results):
+            # The results can't go verbatim.  While the essense of the query is the same as the cached result,
+            # the details may differ. In particular the names of the query nodes and edges may be different.
+            return match_results_to_query(results, message, source, target, qedge_id)
+    elif not pathfinder:
         mcq = False
         member_ids = []
-        if read_from_cache:
-            results = results_cache.get_lookup_result(workflow_def, query_graph)
-            if results is not None:
-                logger.info(f"{guid}: Returning results cache lookup")
-                return results, 200
+        # Key the lookup cache on the canonical form of the query graph, so that the same question asked with
+        # different qnode/qedge ids or optional fields still hits.  The workflow's references to qnodes are
+        # renamed to match.
+        canonical_query = canonicalize_query_graph(query_graph)
+        canonical_workflow = canonicalize_workflow(workflow_def, canonical_query.node_ids)
+        cache_key = results_cache.get_lookup_query_key(canonical_workflow, canonical_query.query_graph)
+        cache_redis = results_cache.lookup_redis
+
+        async def read_cache():
+            return await results_cache.get_lookup_result(canonical_workflow, canonical_query.query_graph)
+
+        def from_cache(results):
+            # The cached results are bound to the canonical qnode and qedge ids, put them back to the caller's
+            results["message"] = relabel_message(
+                results["message"], query_graph, invert(canonical_query.node_ids), invert(canonical_query.edge_ids)
+            )
+            # and the workflow that was cached is in the ids of whoever asked first
+            results["workflow"] = workflow_def
+            return results
 
     workflow = []
 
@@ -233,24 +261,102 @@ async def entry(message, guid, coalesce_type, caller) -> (dict, int):
         except KeyError:
             return f"Unknown Operation: {op}", 422
 
-    final_answer, status_code = await run_workflow(message, workflow, guid)
+    cached_workflow = infer or ({"id": "lookup"} in workflow_def and not pathfinder)
+    # the cache write that compute started, if any
+    cache_writes = []
+
+    async def compute(message=message, guid=guid, workflow=workflow):
+        """Run the workflow and cache the answer.  Returns the answer, its status, and the answer as it is cached,
+        which is what identical queries that come in while this one is running get."""
+        final_answer, status_code = await run_workflow(message, workflow, guid)
 
-    # return the workflow def so that the caller can see what we did
-    final_answer["workflow"] = workflow_def
+        # return the workflow def so that the caller can see what we did
+        final_answer["workflow"] = workflow_def
 
-    # If we got here, we recalculated (otherwise we would have returned already).
-    # so we want to write to the cache if bypass cache is false or overwrite_cache is true
-    if overwrite_cache or (not bypass_cache):
+        # If we got here, we recalculated (otherwise we would have returned already).
+        # so we want to write to the cache if bypass cache is false or overwrite_cache is true
+        # The writes finish in the background, after the answer has been returned.
+        cached_answer = None
         if infer:
-            results_cache.set_result(input_id, predicate, qualifiers, source_input, caller, workflow_def, mcq, member_ids, final_answer)
-        elif {"id": "lookup"} in workflow_def and not pathfinder:
+            # the caller goes on to add to the top level of the answer, so share a snapshot
+            cached_answer = dict(final_answer)
+            if overwrite_cache or (not bypass_cache):
+                cache_writes.append(
+                    await results_cache.set_result(input_id, predicate, qualifiers, source_input, caller, workflow_def, mcq, member_ids, final_answer)
+                )
+        elif cached_workflow:
             # We won't cache pathfinder results for now
-            results_cache.set_lookup_result(workflow_def, query_graph, final_answer)
+            cached_answer = dict(final_answer)
+            cached_answer["message"] = relabel_message(
+                final_answer["message"], canonical_query.query_graph, canonical_query.node_ids, canonical_query.edge_ids
+            )
+            if overwrite_cache or (not bypass_cache):
+                cache_writes.append(await results_cache.set_lookup_result(canonical_workflow, canonical_query.query_graph, cached_answer))
+        return final_answer, status_code, cached_answer
+
+    async def wait_for_cache_write():
+        """Wait for this query's own cache write, not every write in the process."""
+        await asyncio.gather(*cache_writes, return_exceptions=True)
+
+    async def read_shared():
+        hit = await read_cache()
+        return None if hit is None else (None, 200, hit.value)
+
+    if read_from_cache:
+        hit = await read_cache()
+        if hit is not None:
+            if hit.stale and cached_workflow:
+                # Serve the stale answer now, and recompute it for next time.  The refresh gets its own copy of the
+                # query, since the answer we return shares parts of this one.
+                logger.info(f"{guid}: Results cache entry is stale, refreshing it in the background")
+                # It's recomputed because it's old, so it isn't built from cached rule responses either.
+                refresh_workflow = [
+                    (partial(op, overwrite_cache=True) if op_id == "lookup" else op, op_params, op_id) for op, op_params, op_id in workflow
+                ]
+                refresh = partial(compute, deepcopy(message), f"{guid}_refresh", refresh_workflow)
+                refresh_in_background(cache_key.key, refresh, cache_redis, read_shared, wait_for_cache_write, guid)
+            logger.info(f"{guid}: Returning results cache lookup")
+            return from_cache(hit.value), 200
+        logger.info(f"{guid}: Results cache miss")
+
+    if read_from_cache and cached_workflow and SINGLE_FLIGHT:
+        # If the same query is already running, here or in another worker, wait for its answer rather than running
+        # it again.
+        # The other workers read the answer from the cache, so hold the lock until it's been written
+        flight = await run_once(cache_key.key, compute, cache_redis, read_shared, wait_for_cache_write)
+        if not flight.leader:
+            logger.info(f"{guid}: Returning the answer to an identical query that was already running")
+            _, status_code, shared = flight.result
+            # Everyone waiting on the query gets the same answer, so take a copy before rewriting it
+            results = await run_in_thread(deepcopy, shared)
+            return from_cache(results), status_code
+        final_answer, status_code, _ = flight.result
+    else:
+        final_answer, status_code, _ = await compute()
 
     # return the answer
     return final_answer, status_code
 
 
+def refresh_in_background(key, refresh, redis_client, read_result, wait_for_write, guid):
+    """Recompute a stale cache entry without holding anyone up.  A refresh of the same key that's already running,
+    here or in another worker, is joined rather than repeated."""
+
+    async def run_refresh():
+        try:
+            if SINGLE_FLIGHT:
+                await run_once(key, refresh, redis_client, read_result, wait_for_write)
+            else:
+                await refresh()
+        except Exception as e:
+            logger.error(f"{guid}: Failed to refresh cache entry: {e}")
+
+    task = asyncio.create_task(run_refresh())
+    _refreshes.add(task)
+    task.add_done_callback(_refreshes.discard)
+    return task
+
+
 def is_end_message(message):
     if message.get("status_communication", {}).get("strider_multiquery_status", "running") == "complete":
         return True
@@ -264,7 +370,7 @@ async def post_with_callback(host_url, query, guid, params={}, bypass_cache=Fals
     Put the callback inthe right place, fire the message, and collect and return all the
     async returns with no further processing.
 
-    Note: this method can return either a "request.models.Response " or a "reasoner-pydantic.message.response"
+    Note: this method can return either a "httpx.Response" or a list of callback responses
 
     :param host_url:
     :param query:
@@ -272,6 +378,34 @@ async def post_with_callback(host_url, query, guid, params={}, bypass_cache=Fals
     :param params:
     :return:
     """
+    num_queries, post_response = await send_with_callback(host_url, query, guid, bypass_cache)
+    if post_response is not None:
+        # if there is an error this will return a <httpx.Response> type
+        return post_response
+
+    # async wait for callbacks to come on queue
+    responses = await collect_callback_responses(guid, num_queries, params)
+    return responses
+
+
+async def stream_with_callback(host_url, query, guid, params={}, bypass_cache=False):
+    """
+    Post an asynchronous message, and yield each async return as soon as it arrives.
+    If the service doesn't accept the query, nothing is yielded.
+    """
+    num_queries, post_response = await send_with_callback(host_url, query, guid, bypass_cache)
+    if post_response is not None:
+        return
+    async with aclosing(stream_callback_responses(guid, num_queries, params)) as responses:
+        async for response in responses:
+            yield response
+
+
+async def send_with_callback(host_url, query, guid, bypass_cache=False):
+    """
+    Put the callback in the right place, create the callback queue, and fire the message.
+    Returns the number of queries sent, and the service's response if it did not accept the query.
+    """
     # get the server root path
     callback_host = os.environ.get("CALLBACK_HOST", "/")
 
@@ -298,112 +432,81 @@ async def post_with_callback(host_url, query, guid, params={}, bypass_cache=Fals
         num_queries = len(query)
 
     # Create the callback queue
-    await create_queue(guid)
+    transport = get_callback_transport()
+    await transport.create_queue(guid)
 
     # Send the query, using the pid for the callback
     try:
         # these requests should be very quick, if the external service is responsive, they should send back a quick
         # response and then we watch the queue. We give a short 1 min timeout.
-        async with httpx.AsyncClient(timeout=httpx.Timeout(timeout=60)) as client:
-            post_response = await client.post(
-                host_url,
-                json=query,
-            )
+        post_response = await get_http_client("strider").post(
+            host_url,
+            content=json_codec.dumps(query),
+            headers=json_codec.JSON_HEADERS,
+            timeout=60,
+        )
         # check the response status.
         if post_response.status_code != 200:
             # queue isn't needed for failed service call
             logger.warning(f"{guid} POST status: {post_response.status_code}. Deleting unneeded queue.")
-            await delete_queue(guid)
-            # if there is an error this will return a <requests.models.Response> type
-            return post_response
+            await transport.delete_queue(guid)
+            return num_queries, post_response
     except httpx.RequestError as e:
         logger.error(f"Failed to contact {host_url}")
-        await delete_queue(guid)
+        await transport.delete_queue(guid)
         # exception handled in subservice_post
         raise e
 
-    # async wait for callbacks to come on queue
-    responses = await collect_callback_responses(guid, num_queries, params)
-    return responses
+    return num_queries, None
 
 
 async def collect_callback_responses(guid, num_queries, params={}):
     """Collect all callback responses.  No parsing"""
-    # create the response object
-    # response = Response()
+    return [response async for response in stream_callback_responses(guid, num_queries, params)]
 
-    # pydantic_message = Message()
-    #pydantic_kgraph = KnowledgeGraph.parse_obj({"nodes": {}, "edges": {}})
-    #accumulated_results = []
 
+async def stream_callback_responses(guid, num_queries, params={}):
+    """Yield callback responses as they arrive.  No parsing.  This does not care if these
+    are TRAPI or anything else.  It does need to know whether to expect more than 1 query.
+    Mostly the num_queries is there for logging."""
     # Don't spend any more time than this assembling messages
-    #OVERALL_TIMEOUT = timedelta(hours=1)  # 1 hour
     logger.info(f"{guid}: params: {params}")
-    OVERALL_TIMEOUT = timedelta(seconds=params.get("timeout_seconds") or 3 * 60)
-
-    done = False
-    start = dt.now()
-
-    responses = []
-    while not done:
-        new_responses, done = await check_for_messages(guid, num_queries, len(responses) )
-        responses.extend(new_responses)
-        time_spent = dt.now() - start
-        if time_spent > OVERALL_TIMEOUT:
-            logger.info(f"{guid}: Timing out receiving callbacks")
-            done = True
-
-    await delete_queue(guid)
-
-    # set the status to indicate success
-    #response.status_code = 200
-    # save the data to the Response object
-    #query = Query.parse_obj({"message": {}})
-    #query.message.knowledge_graph = pydantic_kgraph
-    #json_query = query.dict()
-    #json_query["message"]["results"] = accumulated_results
-    #response._content = bytes(json.dumps(json_query), "utf-8")
+    overall_timeout = params.get("timeout_seconds") or 3 * 60
+    deadline = asyncio.get_running_loop().time() + overall_timeout
 
-    return responses
-
-async def get_pika_connection():
-    q_username = os.environ.get("QUEUE_USER", "guest")
-    q_password = os.environ.get("QUEUE_PW", "guest")
-    q_host = os.environ.get("QUEUE_HOST", "127.0.0.1")
-    connection = await aio_pika.connect_robust(host=q_host, login=q_username, password=q_password)
-    return connection
-
-
-async def create_queue(guid):
-    connection = None
+    transport = get_callback_transport()
+    num_responses = 0
     try:
-        connection = await get_pika_connection()
-        async with connection:
-            channel = await connection.channel()
-            # declare the queue using the guid as the key
-            queue = await channel.declare_queue(guid)
+        async with aclosing(transport.receive(guid, deadline)) as messages:
+            async for jr in messages:
+                num_responses += 1
+                logger.info(f"{guid}: Strider returned {num_responses} out of {num_queries}.")
+                if DUMPTRUCK:
+                    with open(f"{guid}_{num_responses}.json","w") as outf:
+                        json.dump(jr,outf,indent=2)
+                if is_end_message(jr):
+                    logger.info(f"{guid}: Received complete message from multistrider")
+                    break
+
+                # The responses are cleaned by whoever consumes them, in the worker pool
+                if jr["message"].get("query_graph") is None:
+                    logger.warning(f"{guid}: No query graph in message")
+                else:
+                    logger.info(f"{guid}: {len(jr['message'].get('results') or [])} results from {jr['message']['query_graph']}")
+                    logger.info(f"{guid}: {len(jr['message'].get('auxiliary_graphs') or [])} auxgraphs")
+                    yield jr
+
+                # this is a little messy because this is trying to handle multiquery (returns an end message)
+                # and single query (no end message; single query)
+                if num_queries == 1:
+                    logger.info(f"{guid}: Single message returned from strider; continuing")
+                    break
+    except TimeoutError:
+        logger.info(f"{guid}: Timing out receiving callbacks")
     except Exception as e:
-        logger.error(f"{guid}: Failed to create queue.")
-        raise e
-    finally:
-        if connection:
-            await connection.close()
-
-
-async def delete_queue(guid):
-    connection = None
-    try:
-        connection = await get_pika_connection()
-        async with connection:
-            channel = await connection.channel()
-            # delete the queue using the guid as the key
-            queue = await channel.queue_delete(guid)
-    except Exception:
-        logger.error(f"{guid}: Failed to delete queue.")
-        # Deleting queue isn't essential, so we will continue
+        logger.error(f"{guid}: Exception {e}. Returning {num_responses} results we have so far.")
     finally:
-        if connection:
-            await connection.close()
+        await transport.delete_queue(guid)
 
 
 def has_unique_nodes(result):
@@ -416,7 +519,7 @@ def has_unique_nodes(result):
         seen.add(knode_ids)
     return True
 
-async def filter_promiscuous_results(response,guid):
+def filter_promiscuous_results(response,guid):
     """We have some rules like A<-treats-B-part_of->C<-part_of-D.   This is saying B treats A, and D is like
     B (because they are both part of C).  This isn't the worst rule in the world, we find it statistically
     useful.  But, there are Cs that contain lllllooooootttttssss of stuff, and it creates a lot of bad results.
@@ -431,75 +534,83 @@ async def filter_promiscuous_results(response,guid):
     MAX_C = 10
     if len(response["message"]["results"]) < MAX_C:
         return
-    prom_qnodes = await get_promiscuous_qnodes(response)
-    #This is a dictionary from bound knodes to the index of their result
-    #There should only be one such node
+    prom_qnodes = get_promiscuous_qnodes(response)
     for qnode in prom_qnodes:
-        # It's possible that there are multiple knodes that could be filtered.  But when we filter out the first one
-        # then the indices of the rest will change.  So we need to do this one at a time.
-        await remove_promiscuous_knode_results(MAX_C, qnode, response)
+        remove_promiscuous_knode_results(MAX_C, qnode, response)
 
 
-async def remove_promiscuous_knode_results(MAX_C, qnode, response):
+def remove_promiscuous_knode_results(MAX_C, qnode, response):
     """Given a response and a qnode, look at all the results and count how many of the results have the
     same knode bound to that qnode.   If that number is greater than MAX_C, remove those results."""
-    still_going = True
-    #This is written as a loop with the idea that once we've removed one promiscuous node, it might require
-    # recalculating everything since the results change.  In retrospect, that might not be true because we are
-    # specifiying the qnode.  I'm still think it's possible (but perhaps unlikely) if there are multiple knodes
-    # bound to the same qnode.
-    while still_going:
-        still_going = False
-        # How many distinct results have the same bozo in this spot?
-        prom_counter = defaultdict(list)
-        for result_i, result in enumerate(response["message"]["results"]):
-            for binding in result["node_bindings"][qnode]:
-                knode = binding["id"]
-                prom_counter[knode].append(result_i)
-        # now figure out the most common knode
-        max_knode = None
-        max_count = 0
-        for knode, mapped_result_indices in prom_counter.items():
-            if len(mapped_result_indices) > max_count:
-                max_knode = knode
-                max_count = len(mapped_result_indices)
-        # Now remove all the results with that knode (if it occurs in more than MAX_C results)
-        if max_count > MAX_C:
-            still_going = True
-            #These are the indices of the results that we want to remove
-            mapped_result_indices = prom_counter[max_knode]
-            #Remove them from right to left, otherwise the indices change on you
-            for index in reversed(mapped_result_indices):
-                del response["message"]["results"][index]
-
-
-async def get_promiscuous_qnodes(response):
+    results = response["message"]["results"]
+    # One pass over the results: which results each knode is bound in, and which knodes each result binds
+    knode_results = defaultdict(list)
+    result_knodes = []
+    for result_i, result in enumerate(results):
+        knodes = [binding["id"] for binding in result["node_bindings"][qnode]]
+        for knode in knodes:
+            knode_results[knode].append(result_i)
+        result_knodes.append(knodes)
+    counts = {knode: len(indices) for knode, indices in knode_results.items()}
+    kept = [True] * len(results)
+    # Remove the results of the most common knode, as long as it's in more than MAX_C results.  Removing them can
+    # bring down the counts of other knodes when results have more than one knode bound to the qnode, so this goes
+    # one knode at a time, most common first, keeping the counts up to date.
+    while True:
+        max_count = max(counts.values(), default=0)
+        if max_count <= MAX_C:
+            break
+        # Of the knodes tied for the most, take the one that comes first in the results still there
+        def first_binding(knode):
+            first_i = next(i for i in knode_results[knode] if kept[i])
+            return first_i, result_knodes[first_i].index(knode)
+        max_knode = min((knode for knode, count in counts.items() if count == max_count), key=first_binding)
+        for result_i in knode_results[max_knode]:
+            if kept[result_i]:
+                kept[result_i] = False
+                for knode in result_knodes[result_i]:
+                    counts[knode] -= 1
+        del counts[max_knode]
+    if not all(kept):
+        response["message"]["results"] = [result for result, keep in zip(results, kept) if keep]
+
+
+def get_promiscuous_qnodes(response):
     """We have some rules like A<-treats-B-part_of->C<-part_of-D.  Figure out if this qgraph is like that and return
     C if it is"""
     qgraph = response["message"]["query_graph"]
     if len(qgraph["edges"]) < 3:
         return []
+    # The same rule templates come back on every request, so the answer is remembered for each query graph shape
+    shape = json.dumps([[qedge["subject"], qedge["object"], qedge["predicates"], qedge.get("qualifiers",[])]
+                        for qedge in qgraph["edges"].values()], sort_keys=True)
+    return list(find_promiscuous_qnodes(shape))
+
+
+@lru_cache(maxsize=1024)
+def find_promiscuous_qnodes(shape):
+    """get_promiscuous_qnodes for a query graph shape: the json list of its edges' [subject, object, predicates,
+    qualifiers], in order."""
+    qedges = json.loads(shape)
     #for this to be a problem, we need 2 edges that share a subject or an object, and have the same predicates and qualifiers.
     subjects = defaultdict(list)
     objects = defaultdict(list)
-    for qedge_id, qedge in qgraph["edges"].items():
-        subjects[qedge["subject"]].append(qedge_id)
-        objects[qedge["object"]].append(qedge_id)
+    for qedge_i, (subject, object, predicates, qualifiers) in enumerate(qedges):
+        subjects[subject].append(qedge_i)
+        objects[object].append(qedge_i)
     center_nodes=[]
     for nodelist in (subjects,objects):
         for node, edges in nodelist.items():
             if len(edges) < 2:
                 continue
             for eid1,eid2 in combinations(edges, 2):
-                e1 = qgraph["edges"][eid1]
-                e2 = qgraph["edges"][eid2]
-                if e1["predicates"] == e2["predicates"]:
-                    if e1.get("qualifiers",[]) == e2.get("qualifiers",[]):
-                        center_nodes.append(node)
-    return center_nodes
+                # predicates and qualifiers
+                if qedges[eid1][2:] == qedges[eid2][2:]:
+                    center_nodes.append(node)
+    return tuple(center_nodes)
 
 
-async def filter_repeated_nodes(response,guid):
+def filter_repeated_nodes(response,guid):
     """We have some rules that include e.g. 2 chemicals.   We don't want responses in which those two
     are the same.   If you have A-B-A-C then what shows up in the ui is B-A-C which makes no sense."""
     original_result_count = len(response["message"].get("results",[]))
@@ -508,99 +619,101 @@ async def filter_repeated_nodes(response,guid):
     results = list(filter( lambda x: has_unique_nodes(x), response["message"]["results"] ))
     response["message"]["results"] = results
     if len(results) != original_result_count:
-        await filter_kgraph_orphans(response,{},guid)
-
-
-
-async def check_for_messages(guid, num_queries, num_previously_received=0):
-    """Check for messages on the queue.  Return a list of responses.  This does not care if these
-    are TRAPI or anything else.  It does need to know whether to expect more than 1 query.
-    Mostly the num_queries and num_received are there for logging."""
-    complete = False
-    # We want to reset the connection to rabbit every once in a while
-    # The timeout is how long to wait for a next message after processing.  So when there are many messages
-    # coming in, the connection will stay open for longer than this time
-    responses = []
-    CONNECTION_TIMEOUT = 1 * 60  # 1 minutes
-    num_responses = num_previously_received
-    connection = None
-    try:
-        connection = await get_pika_connection()
-        async with connection:
-            channel = await connection.channel()
-            queue = await channel.get_queue(guid, ensure=True)
-            # wait for the response.  Timeout after
-            async with queue.iterator(timeout=CONNECTION_TIMEOUT) as queue_iter:
-                async for message in queue_iter:
-                    async with message.process():
-                        num_responses += 1
-                        logger.info(f"{guid}: Strider returned {num_responses} out of {num_queries}.")
-                        jr = process_message(message)
-                        if DUMPTRUCK:
-                            with open(f"{guid}_{num_responses}.json","w") as outf:
-                                json.dump(jr,outf,indent=2)
-                        if is_end_message(jr):
-                            logger.info(f"{guid}: Received complete message from multistrider")
-                            complete = True
-                            break
-
-                        await de_noneify(jr)
-                        if "query_graph" not in jr["message"]:
-                            logger.warning(f"{guid}: No query graph in message")
-                        else:
-                            logger.info(f"{guid}: {len(jr.get('message',{}).get('results',[]))} results from {jr['message']['query_graph']}")
-                            logger.info(f"{guid}: {len(jr.get('message',{}).get('auxiliary_graphs',[]))} auxgraphs")
-                            responses.append(jr)
-
-                        # this is a little messy because this is trying to handle multiquery (returns an end message)
-                        # and single query (no end message; single query)
-                        if num_queries == 1:
-                            logger.info(f"{guid}: Single message returned from strider; continuing")
-                            complete = True
-                            break
-
-    except TimeoutError as e:
-        logger.debug(f"{guid}: cycling aio_pika connection")
-    except Exception as e:
-        logger.error(f"{guid}: Exception {e}. Returning {num_responses} results we have so far.")
-        return responses, True
-    finally:
-        if connection:
-            await connection.close()
-
-    return responses, complete
+        remove_kgraph_orphans(response,guid)
 
 
-def process_message(message):
-    file_name = message.body.decode()
-    # open and save the file saved from the callback
-    with open(file_name, "r") as f:
-        # load the contents of the data in the file
-        content = bytes(f.read(), "utf-8")
-    os.remove(file_name)
-    jr = json.loads(content)
-    return jr
 
 #There's a problem where our pydantic model includes a datetime.  But that doesn't serialize to json.
 # So when we pass a response through pydantic to remove nulls, it converts log datetimes into python
 # datetimes, which then barf when we try to json serialize them.
 # This is a frequent complain re: pydantic. See https://github.com/pydantic/pydantic/issues/1409
-# Apparently it will be handled in v2, real soon now.  But for the time being, the following code
-# from that thread takes the output from .dict() and makes it serializable.
+# Apparently it will be handled in v2, real soon now.  But for the time being, clean_message uses pydantic's
+# encoder to turn anything that isn't json into something that is.
 import pydantic.json
 # https://github.com/python/cpython/blob/7b21108445969398f6d1db9234fc0fe727565d2e/Lib/json/encoder.py#L78
-JSONABLE_TYPES = (dict, list, tuple, str, int, float, bool, type(None))
-async def to_jsonable_dict(obj):
-    if isinstance(obj, dict):
-        return {key: await to_jsonable_dict(value) for key, value in obj.items()}
-    elif isinstance(obj, list):
-        return [await to_jsonable_dict(value) for value in obj]
-    elif isinstance(obj, tuple):
-        return tuple(await to_jsonable_dict(value) for value in obj)
-    elif isinstance(obj, JSONABLE_TYPES):
-        return obj
-    return pydantic.json.pydantic_encoder(obj)
-####
+JSON_SCALAR_TYPES = (str, int, float, bool)
+# Exact types, for the fast path.  Subclasses (e.g. str enums) go through isinstance.
+_JSON_SCALARS = frozenset(JSON_SCALAR_TYPES)
+
+
+def clean_message(message):
+    """Remove the None values from the dicts of message, and convert anything that isn't json (datetimes, enums,
+    sets, tuples, ...) to json.  The message is cleaned in place, and returned.  Runs in the worker pool.
+    This is a single iterative pass, so deep messages don't hit the recursion limit.  Cleaning in place rather
+    than building a copy is most of the speed: the messages are large, and almost everything in them is already
+    json."""
+    if type(message) is not dict and type(message) is not list:
+        message = to_json_value(message)
+        if type(message) is not dict and type(message) is not list:
+            return message
+    stack = [message]
+    while stack:
+        obj = stack.pop()
+        if type(obj) is dict:
+            nones = None
+            for key, value in obj.items():
+                vtype = type(value)
+                if vtype is dict or vtype is list:
+                    stack.append(value)
+                elif value is None:
+                    if nones is None:
+                        nones = []
+                    nones.append(key)
+                elif vtype not in _JSON_SCALARS:
+                    obj[key] = value = to_json_value(value)
+                    if type(value) is dict or type(value) is list:
+                        stack.append(value)
+            if nones:
+                for key in nones:
+                    del obj[key]
+        else:
+            convert = False
+            for value in obj:
+                vtype = type(value)
+                if vtype is dict or vtype is list:
+                    stack.append(value)
+                elif value is not None and vtype not in _JSON_SCALARS:
+                    convert = True
+            if convert:
+                for i, value in enumerate(obj):
+                    if value is not None and type(value) not in _JSON_SCALARS and type(value) is not dict and type(value) is not list:
+                        obj[i] = value = to_json_value(value)
+                        if type(value) is dict or type(value) is list:
+                            stack.append(value)
+    return message
+
+
+def to_json_value(value):
+    """Convert a value that isn't a plain dict, list, or json scalar into one."""
+    while True:
+        if value is None or type(value) is dict or type(value) is list or isinstance(value, JSON_SCALAR_TYPES):
+            return value
+        if isinstance(value, dict):
+            value = dict(value)
+        elif isinstance(value, (list, tuple)):
+            value = list(value)
+        else:
+            value = pydantic.json.pydantic_encoder(value)
+
+
+@dataclass
+class SubserviceResponse:
+    """What a sub-service sent back.  A reply that came over http keeps its raw body until json() is called;
+    a callback was already decoded by the callback transport, so it comes with its payload."""
+    status_code: int
+    body: bytes = b""
+    payload: object = None
+
+    @classmethod
+    def from_http(cls, response):
+        return cls(status_code=response.status_code, body=response.content)
+
+    def json(self):
+        """The decoded json.  The body is only decoded once."""
+        if self.payload is None:
+            self.payload = json_codec.loads(self.body)
+        return self.payload
+
 
 async def subservice_post(name, url, message, guid, asyncquery=False, params={}) -> (dict, int):
     """
@@ -638,25 +751,30 @@ async def subservice_post(name, url, message, guid, asyncquery=False, params={})
         if asyncquery:
             # handle the response
             responses = await post_with_callback(url, message, guid, params)
-            #post_with_callback is returning the json dict, not a response, but the stuff below expects
-            # response object
-            response = Response()
-            response.status_code = 200
-            response._content = bytes(json.dumps(responses[0]), "utf-8")
+            if isinstance(responses, list):
+                if len(responses) == 0:
+                    raise TimeoutError(f"No callback received from {name}")
+                response = SubserviceResponse(status_code=200, payload=responses[0])
+            else:
+                # the service didn't accept the query
+                response = SubserviceResponse.from_http(responses)
         else:
-            # async call to external services with hour timeout
-            async with httpx.AsyncClient(timeout=httpx.Timeout(timeout=60 * 60)) as client:
-                if params is None:
-                    response = await client.post(
-                        url,
-                        json=message,
-                    )
-                else:
-                    response = await client.post(
-                        url,
-                        json=message,
-                        params=params,
-                    )
+            # async call to external services, with the service's timeout (an hour for most of them)
+            client = get_http_client(name)
+            if params is None:
+                response = await client.post(
+                    url,
+                    content=json_codec.dumps(message),
+                    headers=json_codec.JSON_HEADERS,
+                )
+            else:
+                response = await client.post(
+                    url,
+                    content=json_codec.dumps(message),
+                    headers=json_codec.JSON_HEADERS,
+                    params=params,
+                )
+            response = SubserviceResponse.from_http(response)
 
         # save the response code
         status_code = response.status_code
@@ -665,11 +783,10 @@ async def subservice_post(name, url, message, guid, asyncquery=False, params={})
 
         if status_code == 200:
             try:
-                # if there is a response return it as a dict
-                if len(response.json()):
-                    result = response.json()
-                    await de_noneify(result)
-                    ret_val = await to_jsonable_dict(result)
+                # if there is a response return it as a dict, cleaned in place
+                result = response.json()
+                if len(result):
+                    ret_val = await run_cpu_bound(clean_message, result)
             except Exception as e:
                 status_code = 500
                 logger.exception(f"{guid}: ARAGORN Exception {e} translating json from post to {name}")
@@ -731,7 +848,7 @@ async def subservice_post(name, url, message, guid, asyncquery=False, params={})
     return ret_val, status_code
 
 
-async def lookup(message, params, guid, infer=False, pathfinder=False, caller="ARAGORN", answer_qnode=None, question_qnode=None, bypass_cache=False) -> (dict, int):
+async def lookup(message, params, guid, infer=False, pathfinder=False, caller="ARAGORN", answer_qnode=None, question_qnode=None, bypass_cache=False, overwrite_cache=False) -> (dict, int):
     """
     Performs lookup, parameterized by ARAGORN/ROBOKOP and whether the query is an infer type query
 
@@ -743,9 +860,9 @@ async def lookup(message, params, guid, infer=False, pathfinder=False, caller="A
     """
     message = await normalize_qgraph_ids(message)
     if caller == "ARAGORN":
-        return await aragorn_lookup(message, params, guid, infer, pathfinder, answer_qnode, bypass_cache)
+        return await aragorn_lookup(message, params, guid, infer, pathfinder, answer_qnode, bypass_cache, overwrite_cache)
     elif caller == "ROBOKOP":
-        robo_results, robo_status = await robokop_lookup(message, params, guid, infer, question_qnode, answer_qnode)
+        robo_results, robo_status = await robokop_lookup(message, params, guid, infer, question_qnode, answer_qnode, bypass_cache, overwrite_cache)
         return await add_provenance(robo_results), robo_status
     return f"Illegal caller {caller}", 400
 
@@ -762,23 +879,15 @@ def chunk(input, n):
     for i in range(0, len(input), n):
         yield input[i : i + n]
 
-async def de_noneify(message):
-    """Remove all the None values from a message"""
-    if isinstance(message, dict):
-        keys_to_remove = []
-        for key, value in message.items():
-            if value is None:
-                keys_to_remove.append(key)
-            else:
-                await de_noneify(value)
-        for key in keys_to_remove:
-            del message[key]
-    elif isinstance(message, list):
-        for item in message:
-            await de_noneify(item)
+async def read_rule_cache(rule_cache, rules, guid, bypass_cache, overwrite_cache):
+    """The cached response for each rule, or None.  Nothing is read when the query bypasses or overwrites the
+    cache; the responses it gets are still written."""
+    if bypass_cache or overwrite_cache:
+        return [None] * len(rules)
+    return await rule_cache.get_responses(rules, guid)
 
 
-async def aragorn_lookup(input_message, params, guid, infer, pathfinder, answer_qnode, bypass_cache):
+async def aragorn_lookup(input_message, params, guid, infer, pathfinder, answer_qnode, bypass_cache, overwrite_cache=False):
     timeout_seconds = (input_message.get("parameters") or {}).get("timeout_seconds")
     if timeout_seconds:
         params["timeout_seconds"] = timeout_seconds if type(timeout_seconds) is int else 3 * 60
@@ -794,44 +903,73 @@ async def aragorn_lookup(input_message, params, guid, infer, pathfinder, answer_
     #nrules_per_batch = int(os.environ.get("MULTISTRIDER_BATCH_SIZE", 1))
     # nrules = int(os.environ.get("MAXIMUM_MULTISTRIDER_RULES",len(messages)))
     nrules = int(os.environ.get("MAXIMUM_MULTISTRIDER_RULES", 101))
-    result_messages = []
+    merger = ResponseMerger(answer_qnode, input_message["message"]["query_graph"], lookup_query_graph)
+    # Rules whose responses are in the rule cache don't need to go to strider, unless the caller wants new answers
+    rule_cache = RuleCache("strider")
+    rules = messages[:nrules]
+    cached = await read_rule_cache(rule_cache, rules, guid, bypass_cache, overwrite_cache)
+    for rmessage in cached:
+        if rmessage is not None:
+            await run_in_thread(merger.add, rmessage)
+    rules = [rule for rule, rmessage in zip(rules, cached) if rmessage is None]
+    # strider echoes each query graph, which is how a response is matched up with its rule
+    rule_keys = {}
+    for rule in rules:
+        rule_key = rule_cache.get_key(rule)
+        rule_keys[signature(rule_key.canonical.query_graph)] = rule_key
     num = 0
     num_batches_returned = 0
-    for to_run in chunk(messages[:nrules], nrules_per_batch):
+    for to_run in chunk(rules, nrules_per_batch):
         message = {}
         for q in to_run:
             num += 1
             message[f"query_{num}"] = q
         logger.info(f"Sending {len(message)} messages to strider")
-        batch_result_messages = await multi_strider(message, params, guid, bypass_cache)
+        # Each rule's response is cleaned, filtered and merged as soon as it comes back, while strider is still
+        # working on the rest of the batch.
+        async with aclosing(multi_strider(message, params, guid, bypass_cache)) as batch_result_messages:
+            async for result in batch_result_messages:
+                rule_key = rule_keys.get(signature(canonicalize_query_graph(result["message"]["query_graph"]).query_graph))
+                # The clean, filters and cache encoding are one trip to the worker pool, so the message is only
+                # handed over once
+                rmessage, value = await run_cpu_bound(clean_and_encode_rule_response, result, guid, rule_key)
+                if rmessage is None:
+                    continue
+                if value is not None:
+                    rule_cache.set_response_in_background(rule_key, value)
+                await run_in_thread(merger.add, rmessage)
         num_batches_returned += 1
         logger.info(f"{guid}: {num_batches_returned} batches returned")
-        for result in batch_result_messages:
-            #this clean is dog slow with big messages
-            #rmessage = await to_jsonable_dict(PDResponse.parse_obj(result).dict(exclude_none=True))
-            await de_noneify(result)
-            rmessage = await to_jsonable_dict(result)
-            if "knowledge_graph" not in rmessage["message"] or "results" not in rmessage["message"]:
-                continue
-            await filter_repeated_nodes(rmessage, guid)
-            await filter_promiscuous_results(rmessage, guid)
-            result_messages.append(rmessage)
     logger.info(f"{guid}: strider complete")
-    #Clean out the repeat node stuff
-    # We have to stitch stuff together again
-    #with open(f"{guid}_individual_multistrider.json", "w") as f:
-    #    json.dump(result_messages, f, indent=2)
-    mergedresults = await combine_messages(answer_qnode, input_message["message"]["query_graph"],
-                                           lookup_query_graph, result_messages)
+    mergedresults = await run_in_thread(merger.finish)
     #with open(f"{guid}_merged_multistrider.json", "w") as f:
     #    json.dump(mergedresults, f, indent=2)
     logger.info(f"{guid}: results merged")
     return mergedresults, 200
 
 
-def merge_results_by_node_op(message, params, guid) -> (dict, int):
+def clean_rule_response(result, guid):
+    """Clean and filter one rule's response from multistrider.  Returns None if it isn't usable.
+    This runs in the worker pool, so it takes and returns plain json."""
+    rmessage = clean_message(result)
+    if "knowledge_graph" not in rmessage["message"] or "results" not in rmessage["message"]:
+        return None
+    filter_repeated_nodes(rmessage, guid)
+    filter_promiscuous_results(rmessage, guid)
+    return rmessage
+
+
+def clean_and_encode_rule_response(result, guid, rule_key):
+    """clean_rule_response, and the cleaned response encoded for the rule cache if there's a rule_key for it."""
+    rmessage = clean_rule_response(result, guid)
+    if rmessage is None or rule_key is None:
+        return rmessage, None
+    return rmessage, encode_rule_response(rmessage, rule_key)
+
+
+async def merge_results_by_node_op(message, params, guid) -> (dict, int):
     qn = params["merge_qnode"]
-    merged_results = merge_results_by_node(message, qn, False)
+    merged_results = await run_in_thread(merge_results_by_node, message, qn, False)
     return merged_results, 200
 
 
@@ -854,37 +992,29 @@ async def strider(message, params, guid, bypass_cache) -> (dict, int):
 
 
 async def normalize_qgraph_ids(m):
-    """Normalizes qgraph so ids are the ones referred to by node norm."""
-    url = f'{os.environ.get("NODENORM_URL", "https://nodenormalization-sri.renci.org/")}get_normalized_nodes'
+    """Normalizes qgraph so ids are the ones referred to by node norm.  Normalizations are cached, so hot curies
+    don't cost a call to node norm."""
     qnodes = m["message"]["query_graph"]["nodes"]
     qnode_ids = set()
     for qid, qnode in qnodes.items():
         if ("ids" in qnode) and (qnode["ids"] is not None):
             qnode_ids.update(qnode["ids"])
-    nnp = { "curies": list(qnode_ids), "conflate": True, "drug_chemical_conflate": True }
-    async with httpx.AsyncClient(timeout=httpx.Timeout(timeout=120)) as client:
-        nnresult = await client.post(
-            url,
-            json=nnp,
-        )
-    if nnresult.status_code == 200:
-        nnresult = nnresult.json()
+    nnresult = await get_normalized_nodes(qnode_ids, timeout=120, conflate=True, drug_chemical_conflate=True)
+    if nnresult is not None:
         for qid, qnode in qnodes.items():
             if 'ids' in qnode and qnode['ids'] is not None:
                 normalized_ids = [nnresult[i]["id"]["identifier"] if nnresult[i] else i for i in qnode["ids"]]
                 qnode["ids"] = normalized_ids
-    else:
-        logger.error(f"Error reaching node normalizer: {nnresult.status_code}")
     return m
 
 
-async def robokop_lookup(message, params, guid, infer, question_qnode, answer_qnode) -> (dict, int):
+async def robokop_lookup(message, params, guid, infer, question_qnode, answer_qnode, bypass_cache=False, overwrite_cache=False) -> (dict, int):
     if not infer:
         kg_url = os.environ.get("ROBOKOPKG_URL", "https://automat.renci.org/robokopkg/")
         return await subservice_post("robokopkg", f"{kg_url}query", message, guid)
 
     # It's an infer, just look it up
-    rokres = await robokop_infer(message, guid, question_qnode, answer_qnode)
+    rokres = await robokop_infer(message, guid, question_qnode, answer_qnode, bypass_cache, overwrite_cache)
     return rokres
 
 def get_infer_parameters(input_message):
@@ -978,64 +1108,81 @@ def expand_query(input_message, params, guid):
 
 
 async def multi_strider(messages, params, guid, bypass_cache):
-    """Runs multi strider"""
+    """Runs multi strider, yielding each response as it arrives"""
     strider_url = os.environ.get("STRIDER_URL", "https://strider.renci.org/")
 
     strider_url += "multiquery"
     # We don't want to do subservice_post, because that assumes TRAPI in and out.
     # it leads to confusion.
     # response, status_code = await subservice_post("strider", strider_url, messages, guid, asyncquery=True)
-    responses = await post_with_callback(strider_url,messages,guid,params,bypass_cache)
-
-    return responses
+    async with aclosing(stream_with_callback(strider_url,messages,guid,params,bypass_cache)) as responses:
+        async for response in responses:
+            yield response
 
 
 def create_aux_graph(analysis):
     """Given an analysis, create an auxiliary graph.
     Look through the analysis edge bindings, get all the knowledge edges, and put them in an aux graph.
-    Give it a random uuid as an id."""
-    aux_graph_id = str(uuid.uuid4())
+    Its id is a hash of its set of edges, so the same support graph gets the same id in every answer and every run."""
     aux_graph = { "edges": [] , "attributes": []}
     for edge_id, edgelist in analysis["edge_bindings"].items():
         for edge in edgelist:
             aux_graph["edges"].append(edge["id"])
+    aux_graph_id = short_hash(json.dumps(sorted(set(aux_graph["edges"]))), 16)
     return aux_graph_id, aux_graph
 
 
-def add_knowledge_edge(result_message, aux_graph_ids, answer, robokop):
-    """Create a new knowledge edge in the result message, with the aux graph ids as support."""
-    # Find the subject, object, and predicate of the original query
-    query_graph = result_message["message"]["query_graph"]
-    # get the first key and value from the edges
-    qedge_id, qedge = next(iter(query_graph["edges"].items()))
-    # For the nodes, if there is an id, then use it in the knowledge edge. If there is not, then use the answer
-    qnode_subject_id = qedge["subject"]
-    qnode_object_id = qedge["object"]
-    if "ids" in query_graph["nodes"][qnode_subject_id] and query_graph["nodes"][qnode_subject_id]["ids"] is not None:
-        qnode_subject = query_graph["nodes"][qnode_subject_id]["ids"][0]
-        qnode_object = answer
-    else:
-        qnode_subject = answer
-        qnode_object = query_graph["nodes"][qnode_object_id]["ids"][0]
-    predicate = qedge["predicates"][0]
-    if "qualifier_constraints" in qedge and qedge["qualifier_constraints"] is not None and len(qedge["qualifier_constraints"]) > 0:
-        qualifiers = qedge["qualifier_constraints"][0]["qualifier_set"]
-    else:
-        qualifiers = None
+@dataclass
+class InferredEdgeTemplate:
+    """What the inferred knowledge edges for a creative query share.  The answer goes on whichever end has no curie."""
+    subject: str
+    object: str
+    predicate: str
+    qualifiers: list
+    source: str
+
+    @classmethod
+    def from_query_graph(cls, query_graph, robokop):
+        # get the first value from the edges
+        qedge = next(iter(query_graph["edges"].values()))
+        # For the nodes, if there is an id, then use it in the knowledge edge. If there is not, then use the answer
+        qnode_subject_id = qedge["subject"]
+        qnode_object_id = qedge["object"]
+        if "ids" in query_graph["nodes"][qnode_subject_id] and query_graph["nodes"][qnode_subject_id]["ids"] is not None:
+            subject, object = query_graph["nodes"][qnode_subject_id]["ids"][0], None
+        else:
+            subject, object = None, query_graph["nodes"][qnode_object_id]["ids"][0]
+        if "qualifier_constraints" in qedge and qedge["qualifier_constraints"] is not None and len(qedge["qualifier_constraints"]) > 0:
+            qualifiers = qedge["qualifier_constraints"][0]["qualifier_set"]
+        else:
+            qualifiers = None
+        source = "infores:robokop" if robokop else "infores:aragorn"
+        return cls(subject, object, qedge["predicates"][0], qualifiers, source)
+
+
+def inferred_edge_id(edge):
+    """An id for an inferred edge from what it asserts: its subject, predicate, object, qualifiers and source.  The
+    same inferred edge gets the same id in every run."""
+    return short_hash(json.dumps([edge["subject"], edge["predicate"], edge["object"], edge.get("qualifiers"),
+                                  edge["sources"][0]["resource_id"]], sort_keys=True), 16)
+
+
+def add_knowledge_edge(result_message, aux_graph_ids, answer, robokop, template=None):
+    """Create a new knowledge edge in the result message, with the aux graph ids as support.  If the same edge is
+    already there (from another answer group binding the same node), the aux graph ids are added to its support.
+    template is the message's InferredEdgeTemplate, when it's already been made."""
+    if template is None:
+        template = InferredEdgeTemplate.from_query_graph(result_message["message"]["query_graph"], robokop)
     # Create a new knowledge edge
-    new_edge_id = str(uuid.uuid4())
-    if robokop:
-        source = "infores:robokop"
-    else:
-        source = "infores:aragorn"
+    source = template.source
     new_edge = {
-        "subject": qnode_subject,
-        "object": qnode_object,
-        "predicate": predicate,
+        "subject": template.subject if template.subject is not None else answer,
+        "object": template.object if template.object is not None else answer,
+        "predicate": template.predicate,
         "attributes": [
             {
                 "attribute_type_id": "biolink:support_graphs",
-                "value": aux_graph_ids
+                "value": list(aux_graph_ids)
             },
             {
                 "attribute_type_id": "biolink:agent_type",
@@ -1051,9 +1198,21 @@ def add_knowledge_edge(result_message, aux_graph_ids, answer, robokop):
         # Aragorn is the primary ks because aragorn inferred the existence of this edge.
         "sources": [{"resource_id":source, "resource_role":"primary_knowledge_source"}]
     }
-    if qualifiers is not None:
-        new_edge["qualifiers"] = qualifiers
-    result_message["message"]["knowledge_graph"]["edges"][new_edge_id] = new_edge
+    if template.qualifiers is not None:
+        new_edge["qualifiers"] = template.qualifiers
+    new_edge_id = inferred_edge_id(new_edge)
+    kg_edges = result_message["message"]["knowledge_graph"]["edges"]
+    existing_edge = kg_edges.get(new_edge_id)
+    if existing_edge is None:
+        kg_edges[new_edge_id] = new_edge
+        return new_edge_id
+    for attribute in existing_edge["attributes"]:
+        if attribute["attribute_type_id"] == "biolink:support_graphs":
+            support_graphs = attribute["value"]
+            attribute["value"] = support_graphs + [aux_graph_id for aux_graph_id in aux_graph_ids if aux_graph_id not in support_graphs]
+            break
+    else:
+        existing_edge["attributes"].insert(0, new_edge["attributes"][0])
     return new_edge_id
 
 def get_edgeset(result):
@@ -1064,7 +1223,18 @@ def get_edgeset(result):
             edgeset.update([e["id"] for e in edgelist])
     return frozenset(edgeset)
 
-def merge_answer(result_message, answer, results, qnode_ids, robokop=False):
+
+def binding_key(binding):
+    """A hashable key for a node binding, the same for bindings that are the same (null fields are ignored, as in
+    the knowledge graph merge).  Nearly all of them are just an id, with no attributes, and those are keyed on the
+    id alone."""
+    if len(binding) == 2 and binding.get("attributes") == []:
+        return binding["id"]
+    key = freeze(binding)
+    return binding["id"] if key == (("attributes", ()), ("id", binding["id"])) else key
+
+
+def merge_answer(result_message, answer, results, qnode_ids, robokop=False, template=None):
     """Given a set of results and the node identifiers of the original qgraph,
     create a single message.
     result_message has to contain the original query graph
@@ -1084,6 +1254,9 @@ def merge_answer(result_message, answer, results, qnode_ids, robokop=False):
     4) add the aux graphs as support for this knowledge edge
     5) create an analysis with an edge binding from the original creative query edge to the new knowledge edge
     6) add any lookup edges to the analysis directly
+    template is the message's InferredEdgeTemplate, which merge_grouped_results makes once for all the answers.
+    The aux graphs' and knowledge edges' ids are hashes of their content, so analyses with the same edges share an
+    aux graph, and the same answer gets the same ids every time.
     """
     # 0. Filter out any creative results that exactly replicate a lookup result
     # How does this happen?   Suppose it's an inferred treats.  Lookup will find a direct treats
@@ -1093,52 +1266,56 @@ def merge_answer(result_message, answer, results, qnode_ids, robokop=False):
     # There are also cases where subpredicates in rules can lead to the same answer.  So here we
     # also unify that.   If we decide to pass rules along with the answers, we'll have to be a bit
     # more careful.
-    lookup_edgesets = [get_edgeset(result) for result in results["lookup"]]
-    creative_edgesets = set()
+    seen_edgesets = {get_edgeset(result) for result in results["lookup"]}
     creative_results = []
     for result in results["creative"]:
         creative_edges = get_edgeset(result)
-        if creative_edges in lookup_edgesets:
-            continue
-        elif creative_edges in creative_edgesets:
+        if creative_edges in seen_edgesets:
             continue
-        else:
-            creative_edgesets.add(creative_edges)
-            creative_results.append(result)
+        seen_edgesets.add(creative_edges)
+        creative_results.append(result)
     results["creative"] = creative_results
     # 1. Create node bindings for the original creative qnodes and lookup qnodes
     mergedresult = {"node_bindings": {}, "analyses": []}
-    serkeys = defaultdict(set)
     for q in qnode_ids:
-        mergedresult["node_bindings"][q] = []
-        for result in results["creative"] + results["lookup"]:
-            for nb in result["node_bindings"][q]:
-                serialized_binding = json.dumps(nb,sort_keys=True)
-                if serialized_binding not in serkeys[q]:
-                    mergedresult["node_bindings"][q].append(nb)
-                    serkeys[q].add(serialized_binding)
+        bindings = mergedresult["node_bindings"][q] = []
+        seen_bindings = set()
+        for result_list in (results["creative"], results["lookup"]):
+            for result in result_list:
+                for nb in result["node_bindings"][q]:
+                    key = binding_key(nb)
+                    if key not in seen_bindings:
+                        bindings.append(nb)
+                        seen_bindings.add(key)
 
     # 2. convert the analysis of each input result into an auxiliary graph
     aux_graph_ids = []
+    seen_aux_graph_ids = set()
     if "auxiliary_graphs" not in result_message["message"] or result_message["message"]["auxiliary_graphs"] is None:
         result_message["message"]["auxiliary_graphs"] = {}
+    auxiliary_graphs = result_message["message"]["auxiliary_graphs"]
     for result in results["creative"]:
         for analysis in result["analyses"]:
             aux_graph_id, aux_graph = create_aux_graph(analysis)
-            result_message["message"]["auxiliary_graphs"][aux_graph_id] = aux_graph
-            aux_graph_ids.append(aux_graph_id)
+            if aux_graph_id not in auxiliary_graphs:
+                auxiliary_graphs[aux_graph_id] = aux_graph
+            if aux_graph_id not in seen_aux_graph_ids:
+                aux_graph_ids.append(aux_graph_id)
+                seen_aux_graph_ids.add(aux_graph_id)
 
     # 3. Create a knowledge edge corresponding to the original creative query edge
     # 4. and add the aux graphs as support for this knowledge edge
     knowledge_edge_ids = []
     if len(aux_graph_ids) > 0:
         #only do this if there are creative results.  There could just be a lookup
+        if template is None:
+            template = InferredEdgeTemplate.from_query_graph(result_message["message"]["query_graph"], robokop)
         for nid in answer:
-            knowledge_edge_id = add_knowledge_edge(result_message, aux_graph_ids, nid, robokop)
+            knowledge_edge_id = add_knowledge_edge(result_message, aux_graph_ids, nid, robokop, template)
             knowledge_edge_ids.append(knowledge_edge_id)
 
     # 5. create an analysis with an edge binding from the original creative query edge to the new knowledge edge
-    qedge_id = list(result_message["message"]["query_graph"]["edges"].keys())[0]
+    qedge_id = next(iter(result_message["message"]["query_graph"]["edges"]))
     if robokop:
         source = "infores:robokop"
     else:
@@ -1167,11 +1344,19 @@ def merge_results_by_node(result_message, merge_qnode, lookup_results, robokop=F
     binding for merge_qnode and combine them into a single result.
     Assumes that the results are not scored."""
     grouped_results = group_results_by_qnode(merge_qnode, result_message, lookup_results)
+    return merge_grouped_results(result_message, grouped_results, robokop)
+
+
+def merge_grouped_results(result_message, grouped_results, robokop=False):
+    """Replace the results of result_message with one merged result per group of grouped_results."""
     original_qnodes = result_message["message"]["query_graph"]["nodes"].keys()
-    # TODO : I'm sure there's a better way to handle this with asyncio
+    # What's the same for every answer is worked out once
+    template = None
+    if any(group["creative"] for group in grouped_results.values()):
+        template = InferredEdgeTemplate.from_query_graph(result_message["message"]["query_graph"], robokop)
     new_results = []
     for r in grouped_results:
-        new_result = merge_answer(result_message, r, grouped_results[r], original_qnodes, robokop)
+        new_result = merge_answer(result_message, r, grouped_results[r], original_qnodes, robokop, template)
         new_results.append(new_result)
     result_message["message"]["results"] = new_results
     return result_message
@@ -1187,19 +1372,36 @@ def group_results_by_qnode(merge_qnode, result_message, lookup_results):
     grouped_results = defaultdict( lambda: {"creative": [], "lookup": []})
     # Group results by the merge_qnode
     for result_set, result_key in [(original_results, "creative"), (lookup_results, "lookup")]:
-        for result in result_set:
-            answer = result["node_bindings"][merge_qnode]
-            bound = frozenset([x["id"] for x in answer])
-            grouped_results[bound][result_key].append(result)
+        group_results(grouped_results, merge_qnode, result_set, result_key)
     return grouped_results
 
 
+def group_results(grouped_results, merge_qnode, result_set, result_key):
+    """Add each result in result_set to the result_key list of the group for its merge_qnode binding."""
+    for result in result_set:
+        answer = result["node_bindings"][merge_qnode]
+        bound = frozenset([x["id"] for x in answer])
+        grouped_results[bound][result_key].append(result)
+
+
 async def make_one_request(client, automat_url, message, sem):
     async with sem:
-        r = await client.post(f"{automat_url}query", json=message)
+        # async timeout in 5 minutes
+        r = await client.post(f"{automat_url}query", content=json_codec.dumps(message), headers=json_codec.JSON_HEADERS, timeout=5 * 60)
     return r
 
-async def robokop_infer(input_message, guid, question_qnode, answer_qnode):
+def validate_robokop_response(content, guid):
+    """Validate and clean one rule's response from automat. Runs in the worker pool."""
+    rmessage = PDResponse.parse_obj(json_codec.loads(content)).dict(exclude_none=True)
+    filter_repeated_nodes(rmessage, guid)
+    return rmessage
+
+def validate_and_encode_robokop_response(content, guid, rule_key):
+    """validate_robokop_response, and the response encoded for the rule cache."""
+    rmessage = validate_robokop_response(content, guid)
+    return rmessage, encode_rule_response(rmessage, rule_key)
+
+async def robokop_infer(input_message, guid, question_qnode, answer_qnode, bypass_cache=False, overwrite_cache=False):
     automat_url = os.environ.get("ROBOKOPKG_URL", "https://automat.transltr.io/robokopkg/")
     max_conns = os.environ.get("MAX_CONNECTIONS", 5)
     nrules = int(os.environ.get("MAXIMUM_ROBOKOPKG_RULES", 101))
@@ -1211,31 +1413,40 @@ async def robokop_infer(input_message, guid, question_qnode, answer_qnode):
     lookup_query_graph = messages[0]["message"]["query_graph"]
     logger.info(f"{guid}: {len(messages)} to send to {automat_url}")
     result_messages = []
+    # Rules whose responses are in the rule cache don't need to go to automat, unless the caller wants new answers
+    rule_cache = RuleCache("robokopkg")
+    rules = messages[:nrules]
+    cached = await read_rule_cache(rule_cache, rules, guid, bypass_cache, overwrite_cache)
+    rmessages = [rmessage for rmessage in cached if rmessage is not None]
+    rules = [rule for rule, rmessage in zip(rules, cached) if rmessage is None]
     #limits = httpx.Limits(max_keepalive_connections=None, max_connections=max_conns)
     limit = asyncio.Semaphore(max_conns)
-    # async timeout in 1 hour
-    async with httpx.AsyncClient(timeout=httpx.Timeout(timeout=5 * 60)) as client:
-        tasks = []
-        for message in messages[:nrules]:
-            tasks.append(asyncio.create_task( make_one_request(client, automat_url, message, limit) ))
+    client = get_http_client("robokopkg")
+    tasks = []
+    for message in rules:
+        tasks.append(asyncio.create_task( make_one_request(client, automat_url, message, limit) ))
 
-        responses = await asyncio.gather(*tasks)
+    responses = await asyncio.gather(*tasks)
 
-    nr = 0
-    for response in responses:
+    for rule, response in zip(rules, responses):
         if response.status_code == 200:
-            #Validate and clean
-            rmessage = PDResponse(**response.json()).dict(exclude_none=True)
-            await filter_repeated_nodes(rmessage,guid)
-            num_results = len(rmessage["message"].get("results",[]))
-            logger.info(f"Returned {num_results} results")
-            if num_results > 0 and num_results < 10000: #more than this number of results and you're into noise.
-                #with (open(f"{guid}_r_{nr}.json", 'w')) as outf:
-                #    json.dump(rmessage, outf, indent=2)
-                #    nr += 1
-                result_messages.append(rmessage)
+            #Validate and clean.  The worker gets the raw bytes, which are cheaper to hand over than the parsed json
+            rule_key = rule_cache.get_key(rule)
+            rmessage, value = await run_cpu_bound(validate_and_encode_robokop_response, response.content, guid, rule_key)
+            rule_cache.set_response_in_background(rule_key, value)
+            rmessages.append(rmessage)
         else:
             logger.error(f"{guid}: {response.status_code} returned.")
+
+    nr = 0
+    for rmessage in rmessages:
+        num_results = len(rmessage["message"].get("results",[]))
+        logger.info(f"Returned {num_results} results")
+        if num_results > 0 and num_results < 10000: #more than this number of results and you're into noise.
+            #with (open(f"{guid}_r_{nr}.json", 'w')) as outf:
+            #    json.dump(rmessage, outf, indent=2)
+            #    nr += 1
+            result_messages.append(rmessage)
     if len(result_messages) > 0:
         # We have to stitch stuff together again
         mergedresults = await combine_messages(answer_qnode, input_message["message"]["query_graph"],
@@ -1250,48 +1461,54 @@ def queries_equivalent(query1,query2):
     """Compare 2 query graphs.  The nuisance is that there is flexiblity in e.g. whether there is a qualifier constraint
     as none or it's not in there or its an empty list.  And similar for is_set and is_set is False.
     """
-    q1 = query1.copy()
-    q2 = query2.copy()
-    for q in [q1,q2]:
-        for node in q["nodes"].values():
-            if "is_set" in node and node["is_set"] is False:
-                del node["is_set"]
-            if "constraints" in node and len(node["constraints"]) == 0:
-                del node["constraints"]
-        for edge in q["edges"].values():
-            if "attribute_constraints" in edge and len(edge["attribute_constraints"]) == 0:
-                del edge["attribute_constraints"]
-            if "qualifier_constraints" in edge and len(edge["qualifier_constraints"]) == 0:
-                del edge["qualifier_constraints"]
-    return q1 == q2
+    return normalize_query_graph(query1) == normalize_query_graph(query2)
+
+class ResponseMerger:
+    """Folds rule responses, one at a time, into a single merged knowledge graph and the per-answer result
+    groups, so that the raw responses don't all have to be held until the end.  finish() merges each group
+    into a single result, giving the same message as merging all of the responses at once."""
+
+    def __init__(self, answer_qnode, original_query_graph, lookup_query_graph, robokop=False):
+        self.answer_qnode = answer_qnode
+        self.original_query_graph = original_query_graph
+        self.lookup_query_graph = lookup_query_graph
+        self.robokop = robokop
+        self.kgraph = KnowledgeGraphMerger()
+        self.auxiliary_graphs = {}
+        # The result with the direct lookup needs to be handled specially.   It's the one with the lookup query graph
+        self.lookup_results = []  # in case we don't have any
+        self.grouped_results = defaultdict(lambda: {"creative": [], "lookup": []})
+
+    def add(self, rm):
+        self.kgraph.update(rm["message"]["knowledge_graph"])
+        self.auxiliary_graphs.update(rm["message"].get("auxiliary_graphs", {}))
+        if queries_equivalent(rm["message"]["query_graph"], self.lookup_query_graph):
+            self.lookup_results = rm["message"]["results"]
+        else:
+            group_results(self.grouped_results, self.answer_qnode, rm["message"]["results"], "creative")
+
+    def finish(self):
+        # Construct the final result message, currently empty
+        result = PDResponse(**{
+            "message": {
+                "query_graph": {"nodes": {}, "edges": {}},
+                "knowledge_graph": {"nodes": {}, "edges": {}},
+                "results": [],
+                "auxiliary_graphs": {},
+            },
+            "logs": [] }).dict(exclude_none=True)
+        result["message"]["query_graph"] = self.original_query_graph
+        result["message"]["knowledge_graph"] = self.kgraph.knowledge_graph
+        result["message"]["auxiliary_graphs"].update(self.auxiliary_graphs)
+        group_results(self.grouped_results, self.answer_qnode, self.lookup_results, "lookup")
+        return merge_grouped_results(result, self.grouped_results, self.robokop)
+
 
 async def combine_messages(answer_qnode, original_query_graph, lookup_query_graph, result_messages, robokop=False):
-    pydantic_kgraph = KnowledgeGraph.parse_obj({"nodes": {}, "edges": {}})
-    for rm in result_messages:
-        pydantic_kgraph.update(KnowledgeGraph.parse_obj(rm["message"]["knowledge_graph"]))
-    # Construct the final result message, currently empty
-    result = PDResponse(**{
-        "message": {
-            "query_graph": {"nodes": {}, "edges": {}},
-            "knowledge_graph": {"nodes": {}, "edges": {}},
-            "results": [],
-            "auxiliary_graphs": {},
-        },
-        "logs": [] }).dict(exclude_none=True)
-    result["message"]["query_graph"] = original_query_graph
-    result["message"]["knowledge_graph"] = pydantic_kgraph.dict()
+    merger = ResponseMerger(answer_qnode, original_query_graph, lookup_query_graph, robokop)
     for rm in result_messages:
-        if "auxiliary_graphs" in result["message"]:
-            result["message"]["auxiliary_graphs"].update(rm["message"].get("auxiliary_graphs", {}))
-    # The result with the direct lookup needs to be handled specially.   It's the one with the lookup query graph
-    lookup_results = []  # in case we don't have any
-    for result_message in result_messages:
-        if queries_equivalent(result_message["message"]["query_graph"],lookup_query_graph):
-            lookup_results = result_message["message"]["results"]
-        else:
-            result["message"]["results"].extend(result_message["message"]["results"])
-    mergedresults = merge_results_by_node(result, answer_qnode, lookup_results, robokop)
-    return mergedresults
+        await run_in_thread(merger.add, rm)
+    return await run_in_thread(merger.finish)
 
 
 async def answercoalesce(message, params, guid, coalesce_type="all") -> (dict, int):
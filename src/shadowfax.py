@@ -6,14 +6,15 @@ import hashlib
 import os
 import json
 
-import httpx
 import networkx
 from reasoner_pydantic import Message
 
+from src import json_codec
 from src.pathfinder.get_cooccurrence import get_the_curies, get_the_pmids
 from src.operations import recursive_get_edge_support_graphs
+from src.http_clients import get_http_client
+from src.nodenorm_cache import get_normalized_nodes
 
-node_norm_url = os.environ.get("NODENORM_URL", "https://nodenormalization-sri.renci.org/")
 strider_url = os.environ.get("STRIDER_URL", "https://strider.renci.org/")
 NUM_TOTAL_HOPS = 4
 TOTAL_PUBS = 27840000
@@ -28,13 +29,14 @@ with open("blocklist.json", "r") as f:
 async def generate_from_strider(message):
     """Generates knowledge graphs from strider."""
     try:
-        async with httpx.AsyncClient(timeout=3600) as client:
-            lookup_response = await client.post(
-                url=strider_url + "query",
-                json=message,
-            )
-            lookup_response.raise_for_status()
-            lookup_response = lookup_response.json()
+        lookup_response = await get_http_client("strider").post(
+            url=strider_url + "query",
+            content=json_codec.dumps(message),
+            headers=json_codec.JSON_HEADERS,
+            timeout=3600,
+        )
+        lookup_response.raise_for_status()
+        lookup_response = json_codec.loads(lookup_response.content)
     except Exception:
         lookup_response = {}
     return lookup_response.get("message", {})
@@ -43,16 +45,10 @@ async def generate_from_strider(message):
 async def get_normalized_curies(curies, guid, logger):
     """Gives us normalized curies that we can look up in our database, assuming
     the database is also properly normalized."""
-    async with httpx.AsyncClient(timeout=900) as client:
-        try:
-            normalizer_response = await client.post(
-                url=node_norm_url + "get_normalized_nodes",
-                json={"curies": list(curies), "conflate": True, "description": False, "drug_chemical_conflate": True},
-            )
-            normalizer_response.raise_for_status()
-            return normalizer_response.json()
-        except Exception:
-            logger.info(f"{guid}: Failed to get a response from node norm")
+    normalizer_response = await get_normalized_nodes(curies, guid, timeout=900, conflate=True, description=False, drug_chemical_conflate=True)
+    if normalizer_response is None:
+        logger.info(f"{guid}: Failed to get a response from node norm")
+    return normalizer_response
 
 
 async def shadowfax(message, guid, logger):
@@ -311,7 +307,8 @@ async def shadowfax(message, guid, logger):
             continue
         
         sha256 = hashlib.sha256()
-        for x in set(aux_edges):
+        # sorted, so that the key doesn't depend on the set's (per process) order
+        for x in sorted(set(aux_edges)):
             sha256.update(bytes(x, encoding="utf-8"))
         aux_graph_key = sha256.hexdigest()
         if aux_graph_key not in aux_edges_keys:
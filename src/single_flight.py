@@ -0,0 +1,131 @@
+"""Run identical queries once, however many copies of them come in at the same time.
+
+When the same query comes in several times before the first copy has finished (a UI retrying, a test harness, a
+popular disease), each copy misses the cache and runs the whole workflow.  run_once lets the first one run, and
+makes the rest wait for its answer:
+
+- within a worker, the later copies wait on the first one's future.
+- across workers, the first one takes a redis lock on the key.  A worker that finds the key locked waits until the
+  lock is released (the holder publishes on the lock's channel when it's done) and then reads the answer from the
+  cache, which the holder has written by then.
+
+If the first copy fails, one of the copies waiting on it runs the query in its place; if the lock holder's answer
+isn't in the cache, the waiting worker runs it itself.  The lock expires after SINGLE_FLIGHT_LOCK_TTL seconds, in case its holder dies, and nobody waits
+longer than SINGLE_FLIGHT_WAIT seconds.  SINGLE_FLIGHT=False turns all of this off.
+"""
+import asyncio
+import logging
+import os
+import uuid
+from typing import Any, NamedTuple
+
+logger = logging.getLogger(__name__)
+
+SINGLE_FLIGHT = os.environ.get("SINGLE_FLIGHT", "True") == "True"
+SINGLE_FLIGHT_LOCK_TTL = int(os.environ.get("SINGLE_FLIGHT_LOCK_TTL", 15 * 60))
+SINGLE_FLIGHT_WAIT = int(os.environ.get("SINGLE_FLIGHT_WAIT", 15 * 60))
+
+# key: the future that the in-flight computation's result will be set on
+_flights = {}
+# Lock releases still in flight
+_releases = set()
+
+
+class Flight(NamedTuple):
+    """What run_once got.  leader is False when result came from another copy of the query, and so is shared."""
+    result: Any
+    leader: bool
+
+
+def lock_name(key):
+    return f"singleflight:{key}"
+
+
+async def acquire_lock(redis_client, key, token):
+    try:
+        return bool(await redis_client.set(lock_name(key), token, nx=True, ex=SINGLE_FLIGHT_LOCK_TTL))
+    except Exception as e:
+        # No redis, no coordination between workers, but the query can still run
+        logger.warning(f"Failed to take single flight lock: {e}")
+        return True
+
+
+async def release_lock(redis_client, key, token):
+    try:
+        # Only release our own lock; if it expired someone else may hold it now.  The get and delete aren't atomic,
+        # but the window is small and the worst case is an extra run of the query.
+        if await redis_client.get(lock_name(key)) == token.encode():
+            await redis_client.delete(lock_name(key))
+        await redis_client.publish(lock_name(key), "done")
+    except Exception as e:
+        logger.warning(f"Failed to release single flight lock: {e}")
+
+
+async def wait_for_lock(redis_client, key, timeout=SINGLE_FLIGHT_WAIT):
+    """Wait until the lock on key is released, or timeout."""
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    try:
+        pubsub = redis_client.pubsub()
+        await pubsub.subscribe(lock_name(key))
+        try:
+            # Check the lock after subscribing, so that a release in between isn't missed.  The release message only
+            # wakes us up early; the lock itself is what we go by, which also covers a holder that died.
+            while await redis_client.exists(lock_name(key)) and loop.time() < deadline:
+                await pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+        finally:
+            await pubsub.unsubscribe(lock_name(key))
+            await pubsub.close()
+    except Exception as e:
+        logger.warning(f"Failed waiting on single flight lock: {e}")
+
+
+async def release_lock_after(before_release, redis_client, key, token):
+    try:
+        if before_release is not None:
+            await before_release()
+    finally:
+        await release_lock(redis_client, key, token)
+
+
+async def run_once(key, compute, redis_client=None, read_result=None, before_release=None):
+    """Return a Flight with the result of compute(), or of the copy of it already running for key.
+
+    compute, read_result and before_release are coroutine functions.  read_result returns the result that another
+    worker's compute() left behind (from the cache), or None.  The redis lock is released after before_release()
+    finishes (e.g. the cache write), in the background.  Results that are shared must not be modified by the
+    callers."""
+    flight = _flights.get(key)
+    while flight is not None:
+        result = await asyncio.shield(flight)
+        if result is not None:
+            return Flight(result, False)
+        # The copy we waited on failed.  The first waiter to wake up runs it again, and the rest wait on that one.
+        flight = _flights.get(key)
+
+    future = _flights[key] = asyncio.get_running_loop().create_future()
+    token = str(uuid.uuid4())
+    locked = False
+    result = None
+    try:
+        if redis_client is not None:
+            locked = await acquire_lock(redis_client, key, token)
+            if not locked:
+                logger.info(f"Waiting for another worker running {key}")
+                await wait_for_lock(redis_client, key)
+                if read_result is not None:
+                    result = await read_result()
+                if result is not None:
+                    return Flight(result, False)
+                locked = await acquire_lock(redis_client, key, token)
+        result = await compute()
+        return Flight(result, True)
+    finally:
+        # Wake up everyone waiting here; None tells them to run it themselves
+        future.set_result(result)
+        if _flights.get(key) is future:
+            del _flights[key]
+        if locked:
+            release = asyncio.create_task(release_lock_after(before_release, redis_client, key, token))
+            _releases.add(release)
+            release.add_done_callback(_releases.discard)
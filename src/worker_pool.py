@@ -0,0 +1,88 @@
+"""Executors for the CPU-bound stages of a query (cleaning, filtering and merging rule responses).
+
+Those stages used to run on the event loop, so while a big infer query was being merged every other request on
+the worker stalled.  They now run in an executor, chosen with the WORKER_POOL environment variable:
+
+thread: (default) a thread pool.  Nothing is copied, but the stages still share the GIL with the event loop; the
+    loop gets a turn every sys.getswitchinterval() instead of waiting for the whole stage to finish.
+process: a process pool.  The stages get their own interpreters, at the cost of pickling the arguments and return
+    value of every call, so only stateless functions go to it (see run_cpu_bound), and each call should do as much
+    work as possible on as little data as possible.
+none: run inline on the event loop, as before.
+
+WORKER_POOL_SIZE sets the number of workers.  Stages that update shared state (e.g. the ResponseMerger) can't be
+sent to another process, so run_in_thread always uses a thread pool, even in process mode.
+"""
+import asyncio
+import logging
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+
+logger = logging.getLogger(__name__)
+
+WORKER_POOL = os.environ.get("WORKER_POOL", "thread")
+WORKER_POOL_SIZE = int(os.environ.get("WORKER_POOL_SIZE", min(4, os.cpu_count() or 1)))
+
+_process_pool = None
+_thread_pool = None
+
+
+def get_thread_pool():
+    global _thread_pool
+    if _thread_pool is None:
+        _thread_pool = ThreadPoolExecutor(max_workers=WORKER_POOL_SIZE, thread_name_prefix="cpu-worker")
+    return _thread_pool
+
+
+def get_process_pool():
+    global _process_pool
+    if _process_pool is None:
+        # Don't fork a process that's running an event loop and rabbitmq/redis connections
+        _process_pool = ProcessPoolExecutor(max_workers=WORKER_POOL_SIZE, mp_context=multiprocessing.get_context("spawn"))
+    return _process_pool
+
+
+def get_executor():
+    """The executor for stateless CPU-bound work, or None if it should run inline."""
+    if WORKER_POOL == "process":
+        return get_process_pool()
+    if WORKER_POOL == "thread":
+        return get_thread_pool()
+    if WORKER_POOL == "none":
+        return None
+    raise ValueError(f"Unknown WORKER_POOL {WORKER_POOL}, expected one of ['thread', 'process', 'none']")
+
+
+async def run_cpu_bound(func, *args):
+    """Run func(*args) in the configured pool.  func must be a module level function, and its arguments and
+    return value must be picklable, since in process mode they are sent between processes."""
+    executor = get_executor()
+    if executor is None:
+        return func(*args)
+    return await asyncio.get_running_loop().run_in_executor(executor, partial(func, *args))
+
+
+async def run_in_thread(func, *args):
+    """Run func(*args) in the thread pool.  For work that mutates objects owned by the calling process."""
+    if WORKER_POOL == "none":
+        return func(*args)
+    return await asyncio.get_running_loop().run_in_executor(get_thread_pool(), partial(func, *args))
+
+
+def start_worker_pool():
+    """Create the pool at app startup, so that the first query doesn't pay for spawning the workers."""
+    try:
+        get_executor()
+    except ValueError as e:
+        logger.error(e)
+        raise
+
+
+def shutdown_worker_pool():
+    global _process_pool, _thread_pool
+    for pool in (_process_pool, _thread_pool):
+        if pool is not None:
+            pool.shutdown(wait=False, cancel_futures=True)
+    _process_pool, _thread_pool = None, None
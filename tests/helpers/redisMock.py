@@ -1,10 +1,11 @@
 import fakeredis
+import fakeredis.aioredis
 import gzip
 import json
 
-def redisMock(host=None, port=None, db=None, password=None):
+def redisMock(host=None, port=None, db=None, password=None, **kwargs):
     # Here's where I got documentation for how to do async fakeredis:
     # https://github.com/cunla/fakeredis-py/issues/66#issuecomment-1316045893
-    redis = fakeredis.FakeStrictRedis()
+    redis = fakeredis.aioredis.FakeRedis()
     # set up mock function
-    return redis
\ No newline at end of file
+    return redis
@@ -1,6 +1,6 @@
 import pytest
 from fastapi.testclient import TestClient
-import redis
+import redis.asyncio
 from src.server import APP
 import os
 import json
@@ -49,7 +49,7 @@ def xtest_async(mock_callback):
 
 
 def test_aragorn_wf(monkeypatch):
-    monkeypatch.setattr(redis, "StrictRedis", redisMock)
+    monkeypatch.setattr(redis.asyncio, "StrictRedis", redisMock)
     init_db()
     workflow_A1("aragorn")
 
@@ -300,7 +300,7 @@ def x_test_standup_2():
     assert found
 
 def test_null_results(monkeypatch):
-    monkeypatch.setattr(redis, "StrictRedis", redisMock)
+    monkeypatch.setattr(redis.asyncio, "StrictRedis", redisMock)
     init_db()
     #make sure that aragorn can handle cases where results is null (as opposed to missing)
     query= {
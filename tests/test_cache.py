@@ -1,6 +1,15 @@
+import asyncio
+
 import pytest
+import redis.asyncio
 
+from src.cache_format import encode_value
+from src.migrate_cache_keys import migrate_db
+from src import results_cache
+from src.results_cache import ResultsCache, flush_cache_writes
+from src import service_aggregator, single_flight
 from src.service_aggregator import match_results_to_query
+from tests.helpers.redisMock import redisMock
 
 def test_match_results_to_query():
     query_message = {
@@ -103,3 +112,158 @@ def test_match_results_to_query():
     assert the_result["node_bindings"]["sn"][0]["id"] == "PUBCHEM.COMPOUND:1102"
     assert len(the_result["analyses"][0]["edge_bindings"]) == 1
     assert the_result["analyses"][0]["edge_bindings"]["qedge"] == [{"id":"9057be2ea96e"}]
+
+
+@pytest.mark.asyncio
+async def test_results_cache_round_trip(monkeypatch):
+    monkeypatch.setattr(redis.asyncio, "StrictRedis", redisMock)
+    cache = ResultsCache(creative_redis_db="10", lookup_redis_db="11")
+    # the connection pools are shared
+    assert ResultsCache(creative_redis_db="10", lookup_redis_db="11").lookup_redis is cache.lookup_redis
+    workflow = [{"id": "lookup"}]
+    query_graph = {"nodes": {"n0": {"ids": ["MONDO:1"]}}, "edges": {}}
+    answer = {"message": {"query_graph": query_graph, "results": [{"score": 1}]}, "workflow": workflow}
+    assert await cache.get_lookup_result(workflow, query_graph) is None
+    write = await cache.set_lookup_result(workflow, query_graph, answer)
+    # the caller can keep modifying the answer while the write is in flight
+    answer["pid"] = "abc"
+    del answer["workflow"]
+    await write
+    assert await cache.get_lookup_result(workflow, query_graph) == ({"message": answer["message"], "workflow": workflow}, False)
+
+    await cache.set_result("MONDO:1", "biolink:treats", {}, "disease", "ARAGORN", workflow, False, [], answer)
+    await flush_cache_writes()
+    assert await cache.get_result("MONDO:1", "biolink:treats", {}, "disease", "ARAGORN", workflow, False, []) == (answer, False)
+    await cache.clear_lookup_cache()
+    assert await cache.get_lookup_result(workflow, query_graph) is None
+
+
+def test_cache_keys():
+    cache = ResultsCache.__new__(ResultsCache)
+    workflow = [{"id": "lookup"}]
+    member_ids = ["MONDO:2", "MONDO:1"]
+    key = cache.get_query_key("MONDO:1", "biolink:treats", {}, "disease", "ARAGORN", workflow, True, member_ids)
+    kind, caller, workflow_hash, predicate_prefix, predicate_name, digest = key.key.split(":")
+    assert (kind, caller, predicate_prefix, predicate_name) == ("creative", "ARAGORN", "biolink", "treats")
+    assert len(workflow_hash) == 8 and len(digest) == 32
+    # the canonical key is what the entry used to be stored under
+    assert key.canonical == '{"caller": "ARAGORN", "input_id": "MONDO:1", "mcq": true, "member_ids": ["MONDO:1", "MONDO:2"], ' \
+                            '"predicate": "biolink:treats", "source_input": "disease", "workflow": [{"id": "lookup"}]}'
+    assert member_ids == ["MONDO:2", "MONDO:1"]
+    lookup_key = cache.get_lookup_query_key(workflow, {"nodes": {}, "edges": {}})
+    assert lookup_key.key.startswith(f"lookup:{workflow_hash}:")
+
+
+@pytest.mark.asyncio
+async def test_legacy_cache_keys(monkeypatch):
+    monkeypatch.setattr(redis.asyncio, "StrictRedis", redisMock)
+    cache = ResultsCache(creative_redis_db="12", lookup_redis_db="13")
+    workflow = [{"id": "lookup"}]
+    answers = {n: {"message": {"results": [{"score": n}]}} for n in range(3)}
+    args = {n: (f"MONDO:{n}", "biolink:treats", {}, "disease", "ARAGORN", workflow, False, []) for n in answers}
+    keys = {n: cache.get_query_key(*args[n]) for n in answers}
+    for n, answer in answers.items():
+        await cache.creative_redis.set(keys[n].canonical, encode_value(answer))
+    # read through, which moves the entry
+    # entries from before the TTLs are stale
+    assert await cache.get_result(*args[0]) == (answers[0], True)
+    assert await cache.creative_redis.exists(keys[0].canonical) == 0
+    assert await cache.creative_redis.hget(keys[0].key, "key") == keys[0].canonical.encode()
+    # and the migration moves the rest
+    assert await migrate_db(cache.creative_redis, "creative") == 2
+    assert await migrate_db(cache.creative_redis, "creative") == 0
+    for n, answer in answers.items():
+        assert (await cache.get_value(cache.creative_redis, keys[n])).value == answer
+    # an entry whose canonical key doesn't match is a collision, not a hit
+    await cache.creative_redis.hset(keys[1].key, "key", keys[2].canonical)
+    assert await cache.get_value(cache.creative_redis, keys[1]) is None
+
+    # old lookup keys can't match the canonical query graph, so they aren't looked for
+    query_graph = {"nodes": {"n0": {"ids": ["MONDO:0"]}}, "edges": {}}
+    lookup_key = cache.get_lookup_query_key(workflow, query_graph)
+    await cache.lookup_redis.set(lookup_key.canonical, encode_value(answers[0]))
+    assert await cache.get_lookup_result(workflow, query_graph) is None
+    assert await cache.lookup_redis.exists(lookup_key.canonical) == 1
+
+
+@pytest.mark.asyncio
+async def test_stale_entries(monkeypatch):
+    monkeypatch.setattr(redis.asyncio, "StrictRedis", redisMock)
+    cache = ResultsCache(creative_redis_db="10", lookup_redis_db="11", ruleset_version="v1")
+    await cache.clear_creative_cache()
+    args = ("MONDO:1", "biolink:treats", {}, "disease", "ARAGORN", [{"id": "lookup"}], False, [])
+    answer = {"message": {"results": []}}
+    await cache.set_result(*args, answer)
+    await flush_cache_writes()
+    assert (await cache.get_result(*args)).stale is False
+    key = cache.get_query_key(*args).key
+    # kept for the stale period too
+    assert 0 < await cache.creative_redis.ttl(key) <= results_cache.CREATIVE_CACHE_TTL + results_cache.CACHE_STALE_TTL
+    # new rules
+    assert (await ResultsCache(creative_redis_db="10", ruleset_version="v2").get_result(*args)).stale is True
+    # old answer
+    monkeypatch.setattr(results_cache, "CREATIVE_CACHE_TTL", 60)
+    await cache.creative_redis.hset(key, "written", 0)
+    assert await cache.get_result(*args) == (answer, True)
+
+
+@pytest.mark.asyncio
+async def test_targeted_flush(monkeypatch):
+    monkeypatch.setattr(redis.asyncio, "StrictRedis", redisMock)
+    cache = ResultsCache(creative_redis_db="10", lookup_redis_db="11", ruleset_version="v1")
+    await cache.clear_creative_cache()
+    answer = {"message": {"results": []}}
+    for curie in ["MONDO:1", "MONDO:2"]:
+        for predicate in ["biolink:treats", "biolink:affects"]:
+            await cache.set_result(curie, predicate, {}, "disease", "ARAGORN", [{"id": "lookup"}], False, [], answer)
+    await flush_cache_writes()
+    assert await cache.flush_creative_cache(predicate="biolink:treats", curie="MONDO:1") == 1
+    assert await cache.flush_creative_cache(curie="MONDO:1") == 1
+    assert await cache.flush_creative_cache(version="v0") == 0
+    assert await cache.flush_creative_cache(predicate="biolink:affects") == 1
+    assert await cache.flush_creative_cache(version="v1") == 1
+    assert await cache.creative_redis.dbsize() == 0
+
+
+@pytest.mark.asyncio
+async def test_lookup_cache_keys_merge_qnode(monkeypatch):
+    """Queries with swapped qnode ids have the same canonical query graph, but merging on a different node is a
+    different question."""
+    monkeypatch.setattr(redis.asyncio, "StrictRedis", redisMock)
+    await ResultsCache().clear_lookup_cache()
+    runs = []
+
+    async def run_workflow(message, workflow, guid):
+        merge_qnode = next(params["merge_qnode"] for _, params, op_id in workflow if op_id == "merge_results_by_qnode")
+        runs.append(merge_qnode)
+        # bind the one result to the node that it was merged on
+        results = [{"node_bindings": {merge_qnode: [{"id": "CHEBI:1"}]}, "analyses": []}]
+        return {"message": dict(message["message"], results=results)}, 200
+
+    def query(disease, chemical, merge_qnode):
+        return {
+            "message": {"query_graph": {
+                "nodes": {disease: {"ids": ["MONDO:0005148"]}, chemical: {"categories": ["biolink:ChemicalEntity"]}},
+                "edges": {"e": {"subject": chemical, "object": disease, "predicates": ["biolink:treats"]}},
+            }},
+            "workflow": [{"id": "lookup"}, {"id": "merge_results_by_qnode", "parameters": {"merge_qnode": merge_qnode}}],
+        }
+
+    async def ask(disease, chemical, merge_qnode):
+        answer, status = await service_aggregator.entry(query(disease, chemical, merge_qnode), "guid", "all", "ARAGORN")
+        await flush_cache_writes()
+        # the single flight lock is released in the background
+        await asyncio.gather(*single_flight._releases)
+        assert status == 200
+        assert list(answer["message"]["results"][0]["node_bindings"]) == [merge_qnode]
+        assert answer["workflow"][1]["parameters"]["merge_qnode"] == merge_qnode
+
+    monkeypatch.setattr(service_aggregator, "run_workflow", run_workflow)
+    # merged on the chemical
+    await ask("n0", "n1", "n1")
+    # the same ids, swapped, merged on the disease: not the cached answer
+    await ask("n1", "n0", "n1")
+    assert runs == ["n1", "n1"]
+    # swapped and merged on the chemical is the first question again
+    await ask("n1", "n0", "n0")
+    assert runs == ["n1", "n1"]
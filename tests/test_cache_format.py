@@ -0,0 +1,34 @@
+import gzip
+import json
+
+import pytest
+
+from src import cache_format
+
+ANSWER = {"message": {"results": [{"score": 0.5, "node_bindings": {"n0": [{"id": "MONDO:1"}]}}]}, "status": "Success"}
+
+
+@pytest.mark.parametrize("compression", ["none", "gzip", "zstd", "lz4"])
+@pytest.mark.parametrize("serializer", ["json", "msgpack"])
+def test_round_trip(compression, serializer):
+    try:
+        value = cache_format.encode_value(ANSWER, compression, serializer)
+    except cache_format.CacheFormatError:
+        pytest.skip(f"{compression}/{serializer} not installed")
+    assert cache_format.read_header(value[0]) == (compression, serializer)
+    assert cache_format.decode_value(value) == ANSWER
+
+
+def test_legacy_gzip_values():
+    # what the cache held before the header byte
+    value = gzip.compress(json.dumps(ANSWER).encode())
+    assert cache_format.decode_value(value) == ANSWER
+
+
+def test_unknown_values():
+    with pytest.raises(cache_format.CacheFormatError):
+        cache_format.decode_value(json.dumps(ANSWER).encode())
+    with pytest.raises(cache_format.CacheFormatError):
+        cache_format.decode_value(bytes([0x80 | 7 << 3]) + b"{}")
+    with pytest.raises(cache_format.CacheFormatError):
+        cache_format.encode_value(ANSWER, "brotli", "json")
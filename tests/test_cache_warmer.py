@@ -0,0 +1,87 @@
+import json
+
+import pytest
+
+from src.cache_warmer import CacheWarmer, build_query, parse_inputs, parse_log
+
+QUALIFIER_CONSTRAINTS = [{"qualifier_set": [{"qualifier_type_id": "biolink:object_aspect_qualifier", "qualifier_value": "activity"},
+                                            {"qualifier_type_id": "biolink:object_direction_qualifier", "qualifier_value": "increased"}]}]
+
+
+def test_parse_inputs():
+    lines = [
+        "# curie\tpredicate\tqualifier_constraints",
+        "MONDO:0004975\tbiolink:treats",
+        "",
+        f"NCBIGene:1017\tbiolink:affects\t{json.dumps(QUALIFIER_CONSTRAINTS)}",
+        json.dumps({"curie": "CHEBI:6801", "predicate": "biolink:treats", "source_input": True}),
+    ]
+    assert parse_inputs(lines) == [
+        ("MONDO:0004975", "biolink:treats", [], False),
+        ("NCBIGene:1017", "biolink:affects", QUALIFIER_CONSTRAINTS, False),
+        ("CHEBI:6801", "biolink:treats", [], True),
+    ]
+
+
+def test_parse_log():
+    def log_line(caller, curie, **qualifiers):
+        spec = {"caller": caller, "curie": curie, "predicate": "biolink:treats", "source_input": False, **qualifiers}
+        return f"2024-01-01 00:00:00 | INFO | src.service_aggregator | abc123: Infer query {json.dumps(spec)}\n"
+
+    lines = [
+        log_line("ARAGORN", "MONDO:1"),
+        log_line("ARAGORN", "MONDO:2"),
+        "2024-01-01 00:00:00 | INFO | src.service_aggregator | abc123: Running lookup\n",
+        log_line("ARAGORN", "MONDO:2"),
+        log_line("ROBOKOP", "MONDO:3"),
+        log_line("ROBOKOP", "MONDO:3"),
+        log_line("ROBOKOP", "MONDO:3"),
+        log_line("ARAGORN", "MONDO:4", qualifier_constraints=QUALIFIER_CONSTRAINTS),
+        log_line("ARAGORN", "MONDO:4", qualifier_constraints=QUALIFIER_CONSTRAINTS),
+        log_line("ARAGORN", "MONDO:4", qualifier_constraints=QUALIFIER_CONSTRAINTS),
+    ]
+    assert parse_log(lines, "ARAGORN") == [
+        ("MONDO:4", "biolink:treats", QUALIFIER_CONSTRAINTS, False),
+        ("MONDO:2", "biolink:treats", [], False),
+        ("MONDO:1", "biolink:treats", [], False),
+    ]
+    assert parse_log(lines, "ARAGORN", top=1) == [("MONDO:4", "biolink:treats", QUALIFIER_CONSTRAINTS, False)]
+    assert parse_log(lines, "ROBOKOP") == [("MONDO:3", "biolink:treats", [], False)]
+
+
+def test_build_query():
+    query = build_query("MONDO:0004975", "biolink:treats", [], False)
+    query_graph = query["message"]["query_graph"]
+    assert query_graph["nodes"]["target"]["ids"] == ["MONDO:0004975"]
+    assert "ids" not in query_graph["nodes"]["source"]
+    assert query_graph["nodes"]["source"]["categories"]
+    assert query_graph["edges"]["e0"] == {"subject": "source", "object": "target", "predicates": ["biolink:treats"], "knowledge_type": "inferred"}
+
+    query = build_query("NCBIGene:1017", "biolink:affects", QUALIFIER_CONSTRAINTS, True)
+    query_graph = query["message"]["query_graph"]
+    assert query_graph["nodes"]["source"]["ids"] == ["NCBIGene:1017"]
+    assert query_graph["edges"]["e0"]["qualifier_constraints"] == QUALIFIER_CONSTRAINTS
+
+    with pytest.raises(ValueError):
+        build_query("MONDO:0004975", "biolink:related_to", [], False)
+
+
+@pytest.mark.asyncio
+async def test_warm_counts(monkeypatch):
+    warmer = CacheWarmer(concurrency=2)
+    ran = []
+
+    async def is_fresh(curie, *args):
+        return curie == "MONDO:fresh"
+
+    async def run_query(query):
+        curie = query["message"]["query_graph"]["nodes"]["target"]["ids"][0]
+        ran.append(curie)
+        return 500 if curie == "MONDO:broken" else 200
+
+    monkeypatch.setattr(warmer, "is_fresh", is_fresh)
+    monkeypatch.setattr(warmer, "run_query", run_query)
+    specs = [(curie, "biolink:treats", [], False) for curie in ["MONDO:1", "MONDO:fresh", "MONDO:broken", "MONDO:2"]]
+    stats = await warmer.warm(specs)
+    assert sorted(ran) == ["MONDO:1", "MONDO:2", "MONDO:broken"]
+    assert (stats["warmed"], stats["fresh"], stats["failed"]) == (2, 1, 1)
@@ -0,0 +1,171 @@
+import asyncio
+import os
+from copy import deepcopy
+import pytest
+from reasoner_pydantic import Response as PDResponse
+from src import callback_transport, service_aggregator
+from src.callback_transport import LocalTransport
+
+
+def make_response(n_results):
+    return PDResponse.parse_obj({
+        "message": {
+            "query_graph": {"nodes": {"n0": {"ids": ["MONDO:0005148"]}, "n1": {"categories": ["biolink:ChemicalEntity"]}}, "edges": {}},
+            "knowledge_graph": {"nodes": {}, "edges": {}},
+            "results": [{"node_bindings": {"n1": [{"id": f"CHEBI:{i}", "attributes": []}]}, "analyses": []} for i in range(n_results)],
+        }
+    })
+
+
+@pytest.mark.asyncio
+async def test_local_transport_round_trip():
+    transport = LocalTransport()
+    await transport.create_queue("abc")
+    assert await transport.publish("abc", make_response(1))
+    assert await transport.publish("abc", make_response(2))
+    received = []
+    deadline = asyncio.get_running_loop().time() + 1
+    async for jr in transport.receive("abc", deadline):
+        received.append(jr)
+        if len(received) == 2:
+            break
+    assert [len(jr["message"]["results"]) for jr in received] == [1, 2]
+    # None values are stripped, as they would be by clean_message
+    assert "auxiliary_graphs" not in received[0]["message"]
+    await transport.delete_queue("abc")
+    assert "abc" not in transport.queues
+
+
+@pytest.mark.asyncio
+async def test_local_transport_unknown_guid():
+    transport = LocalTransport()
+    assert not await transport.publish("nobody_waiting", make_response(1))
+
+
+@pytest.mark.asyncio
+async def test_local_transport_timeout():
+    transport = LocalTransport()
+    await transport.create_queue("abc")
+    loop = asyncio.get_running_loop()
+    start = loop.time()
+    with pytest.raises(asyncio.TimeoutError):
+        async for jr in transport.receive("abc", start + 0.2):
+            pass
+    # the deadline is honored, not rounded up to some polling interval
+    assert loop.time() - start < 1
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("compress", [True, False])
+async def test_inline_payload_round_trip(monkeypatch, compress):
+    monkeypatch.setattr(callback_transport, "CALLBACK_INLINE_PAYLOADS", True)
+    monkeypatch.setattr(callback_transport, "CALLBACK_COMPRESS_PAYLOADS", compress)
+    payload = make_response(3).json().encode()
+    message = await callback_transport.make_message("abc", payload)
+    assert message.content_type == callback_transport.INLINE_CONTENT_TYPE
+    jr = callback_transport.process_message(message)
+    assert len(jr["message"]["results"]) == 3
+
+
+@pytest.mark.asyncio
+async def test_oversized_payload_spills_to_disk(monkeypatch, tmp_path):
+    monkeypatch.setattr(callback_transport, "CALLBACK_INLINE_PAYLOADS", True)
+    monkeypatch.setattr(callback_transport, "CALLBACK_MAX_INLINE_BYTES", 10)
+    monkeypatch.setattr(callback_transport, "queue_file_dir", str(tmp_path))
+    payload = make_response(3).json().encode()
+    message = await callback_transport.make_message("abc", payload)
+    assert message.content_type is None
+    file_name = message.body.decode()
+    assert file_name.startswith(str(tmp_path))
+    jr = callback_transport.process_message(message)
+    assert len(jr["message"]["results"]) == 3
+    assert not os.path.exists(file_name)
+
+
+@pytest.mark.asyncio
+async def test_collect_callback_responses(monkeypatch):
+    transport = LocalTransport()
+    monkeypatch.setattr(service_aggregator, "get_callback_transport", lambda: transport)
+    await transport.create_queue("abc")
+
+    async def strider():
+        for n in (1, 2):
+            await asyncio.sleep(0.01)
+            await transport.publish("abc", make_response(n))
+        await transport.publish("abc", PDResponse.parse_obj({"message": {}, "status_communication": {"strider_multiquery_status": "complete"}}))
+
+    asyncio.create_task(strider())
+    responses = await service_aggregator.collect_callback_responses("abc", 2, {"timeout_seconds": 5})
+    assert [len(r["message"]["results"]) for r in responses] == [1, 2]
+    assert "abc" not in transport.queues
+
+
+@pytest.mark.asyncio
+async def test_collect_callback_responses_timeout(monkeypatch):
+    transport = LocalTransport()
+    monkeypatch.setattr(service_aggregator, "get_callback_transport", lambda: transport)
+    await transport.create_queue("abc")
+    await transport.publish("abc", make_response(1))
+    loop = asyncio.get_running_loop()
+    start = loop.time()
+    responses = await service_aggregator.collect_callback_responses("abc", 2, {"timeout_seconds": 1})
+    assert len(responses) == 1
+    assert loop.time() - start < 2
+
+
+@pytest.mark.asyncio
+async def test_subservice_post_uses_callback_payload(monkeypatch):
+    """The callback is already decoded, so subservice_post cleans and returns it without another encode/decode."""
+    payload = make_response(2).dict()
+    assert payload["message"]["auxiliary_graphs"] is None
+    # the worker pool may clean a copy (WORKER_POOL=process) rather than the payload itself
+    expected = service_aggregator.clean_message(deepcopy(payload))
+
+    async def post_with_callback(url, message, guid, params):
+        return [payload]
+
+    monkeypatch.setattr(service_aggregator, "post_with_callback", post_with_callback)
+    message = {"message": {"query_graph": {"nodes": {}, "edges": {}}}}
+    ret_val, status_code = await service_aggregator.subservice_post("strider", "http://strider", message, "abc", asyncquery=True)
+    assert status_code == 200
+    assert ret_val == expected
+    assert "auxiliary_graphs" not in ret_val["message"]
+    assert len(ret_val["message"]["results"]) == 2
+
+
+@pytest.mark.asyncio
+async def test_subservice_post_no_callback(monkeypatch):
+    async def post_with_callback(url, message, guid, params):
+        return []
+
+    monkeypatch.setattr(service_aggregator, "post_with_callback", post_with_callback)
+    message = {"message": {"query_graph": {"nodes": {}, "edges": {}}}}
+    ret_val, status_code = await service_aggregator.subservice_post("strider", "http://strider", message, "abc", asyncquery=True)
+    assert status_code == 500
+    assert ret_val["logs"][-1]["level"] == "ERROR"
+
+
+@pytest.mark.asyncio
+async def test_unreadable_message(monkeypatch, tmp_path):
+    monkeypatch.setattr(callback_transport, "queue_file_dir", str(tmp_path))
+    message = await callback_transport.make_message("abc", make_response(1).json().encode())
+    os.remove(message.body.decode())
+    failure = await callback_transport.read_message("abc", message)
+    assert isinstance(failure, callback_transport.CallbackFailure)
+    assert isinstance(failure.error, FileNotFoundError)
+
+
+@pytest.mark.asyncio
+async def test_collect_callback_responses_failure(monkeypatch):
+    """A callback that can't be read ends the wait, rather than waiting out the deadline"""
+    transport = LocalTransport()
+    monkeypatch.setattr(service_aggregator, "get_callback_transport", lambda: transport)
+    await transport.create_queue("abc")
+    await transport.publish("abc", make_response(1))
+    transport.queues["abc"].put_nowait(callback_transport.CallbackFailure(FileNotFoundError("gone")))
+    loop = asyncio.get_running_loop()
+    start = loop.time()
+    responses = await service_aggregator.collect_callback_responses("abc", 3, {"timeout_seconds": 30})
+    assert len(responses) == 1
+    assert loop.time() - start < 1
+    assert "abc" not in transport.queues
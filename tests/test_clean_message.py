@@ -0,0 +1,47 @@
+import datetime
+from enum import Enum
+from src.service_aggregator import clean_message
+
+
+class Level(str, Enum):
+    ERROR = "ERROR"
+
+
+def test_clean_message():
+    when = datetime.datetime(2023, 1, 2, 3, 4, 5)
+    message = {
+        "message": {
+            "query_graph": {"nodes": {"n0": {"ids": ["MONDO:1"], "categories": None}}, "edges": {}},
+            "results": [{"node_bindings": {"n0": [{"id": "MONDO:1", "attributes": None}]}, "score": 0.5}, None],
+            "knowledge_graph": {"nodes": {"MONDO:1": {"name": None, "categories": ("biolink:Disease",), "attributes": [{"value": {1, 2}}]}}},
+        },
+        "logs": [{"timestamp": when, "level": Level.ERROR, "code": None, "message": "x"}],
+    }
+    cleaned = clean_message(message)
+    # cleaned in place
+    assert cleaned is message
+    assert cleaned == {
+        "message": {
+            "query_graph": {"nodes": {"n0": {"ids": ["MONDO:1"]}}, "edges": {}},
+            # None is only dropped from dicts
+            "results": [{"node_bindings": {"n0": [{"id": "MONDO:1"}]}, "score": 0.5}, None],
+            "knowledge_graph": {"nodes": {"MONDO:1": {"categories": ["biolink:Disease"], "attributes": [{"value": [1, 2]}]}}},
+        },
+        "logs": [{"timestamp": when.isoformat(), "level": "ERROR", "message": "x"}],
+    }
+    # key order is kept
+    assert list(cleaned["logs"][0]) == ["timestamp", "level", "message"]
+
+
+def test_clean_deep_message():
+    """Deeper than the recursion limit"""
+    message = leaf = {}
+    for _ in range(5000):
+        leaf["a"] = {"b": None}
+        leaf = leaf["a"]
+    cleaned = clean_message(message)
+    depth = 0
+    while cleaned:
+        cleaned = cleaned["a"]
+        depth += 1
+    assert depth == 5000
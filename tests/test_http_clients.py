@@ -0,0 +1,41 @@
+import asyncio
+
+import pytest
+from src import http_clients
+from src.http_clients import get_http_client
+
+
+@pytest.mark.asyncio
+async def test_clients_are_shared_per_upstream(monkeypatch):
+    monkeypatch.setenv("RANKER_HTTP_MAX_CONNECTIONS", "7")
+    await http_clients.close_http_clients()
+    await http_clients.init_http_clients()
+    assert get_http_client("strider") is get_http_client("strider")
+    assert get_http_client("omnicorp") is get_http_client("score") is get_http_client("ranker")
+    assert get_http_client("something_new") is get_http_client("default")
+    assert get_http_client("strider") is not get_http_client("nodenorm")
+    stats = await http_clients.http_pool_stats()
+    assert set(stats) == set(http_clients.UPSTREAMS)
+    assert stats["ranker"]["max_connections"] == 7
+    assert stats["strider"]["open_connections"] == {}
+
+    client = get_http_client("strider")
+    await http_clients.close_http_clients()
+    assert client.is_closed
+    # a new client is made on next use
+    assert not get_http_client("strider").is_closed
+    await http_clients.close_http_clients()
+
+
+def test_clients_from_a_stale_loop_are_closed():
+    async def get_client():
+        client = get_http_client("strider")
+        # let the close of the previous loop's client run
+        await asyncio.sleep(0)
+        return client
+
+    old_client = asyncio.run(get_client())
+    new_client = asyncio.run(get_client())
+    assert new_client is not old_client
+    assert old_client.is_closed
+    asyncio.run(http_clients.close_http_clients())
@@ -0,0 +1,56 @@
+import datetime
+import json
+import math
+from enum import Enum
+import pytest
+from src import json_codec
+
+
+class Level(str, Enum):
+    ERROR = "ERROR"
+
+
+MESSAGE = {"message": {"results": [{"score": 0.5, "id": "CHEBI:1", "name": "café"}]},
+           "logs": [{"timestamp": datetime.datetime(2023, 1, 2, 3, 4, 5), "level": Level.ERROR, "tags": {"a"}}]}
+EXPECTED = {"message": {"results": [{"score": 0.5, "id": "CHEBI:1", "name": "café"}]},
+            "logs": [{"timestamp": "2023-01-02T03:04:05", "level": "ERROR", "tags": ["a"]}]}
+
+
+@pytest.fixture(params=["orjson", "json"])
+def backend(request, monkeypatch):
+    if request.param == "json":
+        monkeypatch.setattr(json_codec, "orjson", None)
+    elif json_codec.orjson is None:
+        pytest.skip("orjson is not installed")
+    return request.param
+
+
+def test_round_trip(backend):
+    encoded = json_codec.dumps(MESSAGE)
+    assert isinstance(encoded, bytes)
+    assert json.loads(encoded) == EXPECTED
+    assert json_codec.loads(encoded) == EXPECTED
+    assert json_codec.loads(encoded.decode()) == EXPECTED
+
+
+def test_orjson_fallback(backend):
+    """orjson refuses ints over 64 bits"""
+    assert json_codec.loads(json_codec.dumps({"n": 2 ** 70})) == {"n": 2 ** 70}
+
+
+def test_nan(backend):
+    """Python upstreams encode NaN and Infinity, which orjson won't read"""
+    decoded = json_codec.loads(json.dumps({"score": float("nan"), "max": float("inf")}).encode())
+    assert math.isnan(decoded["score"])
+    assert decoded["max"] == float("inf")
+
+
+def test_invalid_json(backend):
+    with pytest.raises(ValueError):
+        json_codec.loads(b'{"message": ')
+
+
+def test_response(backend):
+    response = json_codec.TRAPIJSONResponse(content=MESSAGE, status_code=200)
+    assert response.headers["content-type"] == "application/json"
+    assert json.loads(response.body) == EXPECTED
@@ -0,0 +1,142 @@
+import json
+import random
+import pytest
+from pydantic.json import pydantic_encoder
+from reasoner_pydantic import KnowledgeGraph
+from src.kgraph_merge import KnowledgeGraphMerger
+
+
+def pydantic_merge(kgraphs):
+    """The merge that combine_messages used to do."""
+    merged = KnowledgeGraph.parse_obj({"nodes": {}, "edges": {}})
+    for kgraph in kgraphs:
+        merged.update(KnowledgeGraph.parse_obj(kgraph))
+    return merged.dict()
+
+
+def native_merge(kgraphs):
+    merger = KnowledgeGraphMerger()
+    for kgraph in kgraphs:
+        merger.update(kgraph)
+    return merger.knowledge_graph
+
+
+def normalize(kgraph):
+    """Drop nulls and put the set valued lists in a canonical order, since pydantic doesn't keep their order."""
+    def strip(obj):
+        if isinstance(obj, dict):
+            return {k: strip(v) for k, v in obj.items() if v is not None}
+        if isinstance(obj, list):
+            return [strip(v) for v in obj]
+        return obj
+
+    def canonical(items):
+        return sorted(items, key=lambda x: json.dumps(x, sort_keys=True))
+
+    kgraph = strip(json.loads(json.dumps(kgraph, default=pydantic_encoder)))
+    for node in kgraph["nodes"].values():
+        node["categories"] = canonical(node["categories"])
+        node["attributes"] = canonical(node["attributes"])
+    for edge in kgraph["edges"].values():
+        edge["attributes"] = canonical(edge.get("attributes", []))
+        for source in edge["sources"]:
+            if "upstream_resource_ids" in source:
+                source["upstream_resource_ids"] = canonical(source["upstream_resource_ids"])
+        edge["sources"] = canonical(edge["sources"])
+    return kgraph
+
+
+def assert_equivalent(kgraphs):
+    assert normalize(native_merge(kgraphs)) == normalize(pydantic_merge(kgraphs))
+
+
+def attribute(type_id, value, **kwargs):
+    return dict({"attribute_type_id": type_id, "value": value}, **kwargs)
+
+
+def source(resource_id, role, upstream=None):
+    s = {"resource_id": resource_id, "resource_role": role}
+    if upstream is not None:
+        s["upstream_resource_ids"] = upstream
+    return s
+
+
+def edge(attributes, sources, subject="CHEBI:1", object="MONDO:1", **kwargs):
+    return dict({"subject": subject, "object": object, "predicate": "biolink:treats", "attributes": attributes, "sources": sources}, **kwargs)
+
+
+def test_node_merge():
+    kg1 = {"nodes": {"CHEBI:1": {"categories": ["biolink:ChemicalEntity"], "attributes": [attribute("biolink:a", 1)]}}, "edges": {}}
+    kg2 = {"nodes": {"CHEBI:1": {"categories": ["biolink:SmallMolecule", "biolink:ChemicalEntity"], "name": "thing",
+                                 "attributes": [attribute("biolink:a", 1), attribute("biolink:b", [1, 2], value_type_id="xsd:int")]},
+                     "MONDO:1": {"categories": ["biolink:Disease"], "attributes": []}}, "edges": {}}
+    kg3 = {"nodes": {"CHEBI:1": {"categories": [], "name": None, "attributes": [attribute("biolink:a", 1, original_attribute_name=None)]}}, "edges": {}}
+    assert_equivalent([kg1, kg2, kg3])
+    merged = native_merge([kg1, kg2, kg3])["nodes"]["CHEBI:1"]
+    assert merged["name"] == "thing"
+    assert merged["categories"] == ["biolink:ChemicalEntity", "biolink:SmallMolecule"]
+    assert len(merged["attributes"]) == 2
+
+
+def test_edge_merge():
+    kl = attribute("biolink:knowledge_level", "knowledge_assertion")
+    kl2 = attribute("biolink:knowledge_level", "prediction")
+    kg1 = {"nodes": {}, "edges": {"e": edge([kl, attribute("biolink:p", 0.1)], [source("infores:a", "primary_knowledge_source"),
+                                                                               source("infores:b", "aggregator_knowledge_source", ["infores:a"])])}}
+    kg2 = {"nodes": {}, "edges": {"e": edge([kl2, attribute("biolink:p", 0.1), attribute("biolink:q", {"x": [1]})],
+                                            [source("infores:b", "aggregator_knowledge_source", ["infores:c", "infores:a"]),
+                                             source("infores:d", "aggregator_knowledge_source")])}}
+    assert_equivalent([kg1, kg2])
+    merged = native_merge([kg1, kg2])["edges"]["e"]
+    # only the first knowledge level is kept
+    assert [a["value"] for a in merged["attributes"] if a["attribute_type_id"] == "biolink:knowledge_level"] == ["knowledge_assertion"]
+    assert [s["resource_id"] for s in merged["sources"]] == ["infores:a", "infores:b", "infores:d"]
+    assert merged["sources"][1]["upstream_resource_ids"] == ["infores:a", "infores:c"]
+
+
+def test_edge_merge_into_empty_attributes():
+    """An edge without attributes takes all of the next edge's attributes, knowledge level included."""
+    kg1 = {"nodes": {}, "edges": {"e": edge([], [source("infores:a", "primary_knowledge_source")])}}
+    kg2 = {"nodes": {}, "edges": {"e": edge([attribute("biolink:agent_type", "manual_agent")], [source("infores:a", "primary_knowledge_source")],
+                                            qualifiers=[{"qualifier_type_id": "biolink:object_aspect_qualifier", "qualifier_value": "activity"}])}}
+    assert_equivalent([kg1, kg2])
+    assert len(native_merge([kg1, kg2])["edges"]["e"]["attributes"]) == 1
+
+
+def test_inputs_not_modified():
+    kg1 = {"nodes": {"CHEBI:1": {"categories": ["biolink:ChemicalEntity"], "attributes": []}},
+           "edges": {"e": edge([], [source("infores:b", "aggregator_knowledge_source", ["infores:a"])])}}
+    kg2 = {"nodes": {"CHEBI:1": {"categories": ["biolink:SmallMolecule"], "attributes": [attribute("biolink:a", 1)]}},
+           "edges": {"e": edge([attribute("biolink:a", 1)], [source("infores:b", "aggregator_knowledge_source", ["infores:c"])])}}
+    before = json.dumps([kg1, kg2], sort_keys=True)
+    native_merge([kg1, kg2])
+    assert json.dumps([kg1, kg2], sort_keys=True) == before
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_random_merge_equivalence(seed):
+    """Many rule responses with heavily overlapping nodes and edges."""
+    rng = random.Random(seed)
+    categories = ["biolink:Gene", "biolink:Protein", "biolink:Disease", "biolink:NamedThing"]
+    attributes = [attribute(f"biolink:a{i}", rng.choice([1, "x", [1, 2], {"k": "v"}])) for i in range(6)]
+    attributes.append(attribute("biolink:knowledge_level", "knowledge_assertion"))
+    attributes.append(attribute("biolink:knowledge_level", "prediction"))
+    attributes.append(attribute("biolink:agent_type", "manual_agent"))
+    resources = [f"infores:r{i}" for i in range(4)]
+    roles = ["primary_knowledge_source", "aggregator_knowledge_source", "supporting_data_source"]
+    kgraphs = []
+    for _ in range(20):
+        kgraph = {"nodes": {}, "edges": {}}
+        for _ in range(rng.randint(0, 8)):
+            node = {"categories": rng.sample(categories, rng.randint(0, 2)), "attributes": rng.sample(attributes, rng.randint(0, 3))}
+            if rng.random() < 0.3:
+                node["name"] = rng.choice(["a", "b"])
+            kgraph["nodes"][f"N:{rng.randint(0, 10)}"] = node
+        for _ in range(rng.randint(0, 8)):
+            sources = []
+            for resource_id in rng.sample(resources, rng.randint(1, 3)):
+                upstream = rng.sample(resources, rng.randint(0, 2)) if rng.random() < 0.5 else None
+                sources.append(source(resource_id, rng.choice(roles), upstream))
+            kgraph["edges"][f"e{rng.randint(0, 10)}"] = edge(rng.sample(attributes, rng.randint(0, 4)), sources)
+        kgraphs.append(kgraph)
+    assert_equivalent(kgraphs)
@@ -0,0 +1,79 @@
+import fakeredis.aioredis
+import pytest
+from src.nodenorm_cache import NodeNormCache, LRUCache
+
+
+def normalized(curie):
+    return {"id": {"identifier": curie.replace("X", "Y")}}
+
+
+@pytest.fixture
+def calls(monkeypatch):
+    """Stand in for node norm, recording the curies each call asked for.  UNKNOWN:1 isn't known to it."""
+    calls = []
+
+    async def fetch(self, curies, guid, timeout, options):
+        calls.append(list(curies))
+        return {curie: None if curie.startswith("UNKNOWN") else normalized(curie) for curie in curies}
+
+    monkeypatch.setattr(NodeNormCache, "fetch", fetch)
+    return calls
+
+
+@pytest.mark.asyncio
+async def test_only_misses_are_fetched(calls):
+    cache = NodeNormCache()
+    result = await cache.get_normalized_nodes(["X:1", "X:2", "UNKNOWN:1"], conflate=True)
+    assert result == {"X:1": normalized("X:1"), "X:2": normalized("X:2"), "UNKNOWN:1": None}
+    result = await cache.get_normalized_nodes(["X:2", "X:3", "UNKNOWN:1"], conflate=True)
+    assert result == {"X:2": normalized("X:2"), "X:3": normalized("X:3"), "UNKNOWN:1": None}
+    assert calls == [["X:1", "X:2", "UNKNOWN:1"], ["X:3"]]
+    # all hot, no call at all
+    await cache.get_normalized_nodes(["X:1", "X:3"], conflate=True)
+    assert len(calls) == 2
+    # different options are cached separately
+    await cache.get_normalized_nodes(["X:1"], conflate=False)
+    assert calls[-1] == ["X:1"]
+    stats = cache.get_stats()
+    assert stats["memory_hits"] == 4
+    assert stats["misses"] == 5
+
+
+@pytest.mark.asyncio
+async def test_redis_tier(calls):
+    redis = fakeredis.aioredis.FakeRedis()
+    first = NodeNormCache(redis)
+    await first.get_normalized_nodes(["X:1", "UNKNOWN:1"])
+    # another worker, with a cold memory cache
+    second = NodeNormCache(redis)
+    result = await second.get_normalized_nodes(["X:1", "UNKNOWN:1"])
+    assert result == {"X:1": normalized("X:1"), "UNKNOWN:1": None}
+    assert len(calls) == 1
+    assert second.get_stats()["redis_hits"] == 2
+    assert 0 < await redis.ttl(NodeNormCache.cache_key("X:1", {})) <= second.ttl
+
+
+@pytest.mark.asyncio
+async def test_failed_fetch(monkeypatch):
+    async def fetch(self, curies, guid, timeout, options):
+        return None
+
+    monkeypatch.setattr(NodeNormCache, "fetch", fetch)
+    cache = NodeNormCache()
+    assert await cache.get_normalized_nodes(["X:1"]) is None
+    assert len(cache.memory) == 0
+
+
+def test_lru_cache(monkeypatch):
+    now = [0]
+    monkeypatch.setattr("src.nodenorm_cache.time.monotonic", lambda: now[0])
+    lru = LRUCache(2, ttl=10)
+    lru.set("a", 1)
+    lru.set("b", 2)
+    assert lru.get("a") == 1
+    lru.set("c", 3)
+    # b was the least recently used
+    assert lru.get("b") is None
+    assert lru.get("a") == 1
+    now[0] = 11
+    assert lru.get("a") is None
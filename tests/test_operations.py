@@ -1,5 +1,5 @@
 import pytest
-from src.operations import filter_kgraph_orphans, sort_results_score
+from src.operations import filter_kgraph_orphans, filter_message_top_n, sort_results_score, top_n_results
 from reasoner_pydantic import Response
 
 def create_message():
@@ -185,3 +185,85 @@ async def test_sorting_multiple_analyses():
     assert(ids[1] in result_4_nodes)
     assert(ids[2] in result_1_nodes)
     assert(ids[3] in result_3_nodes)
+
+
+@pytest.mark.asyncio
+async def test_deorphaning_recursive_support():
+    """Support graphs that support edges in other support graphs are followed all the way down, even when the
+    support loops back on itself or is deeper than the recursion limit."""
+    message = create_message()
+    result_nodes, result_edges, result_auxgraphs = add_result(message)
+    orphan_nodes, orphan_edges, orphan_auxgraphs = add_result(message)
+    # A chain of support graphs under an edge of the result's edge support graph
+    kg_edges = message["knowledge_graph"]["edges"]
+    creative_edge = message["results"][0]["analyses"][0]["edge_bindings"]["e"][0]["id"]
+    support_edge = message["auxiliary_graphs"][kg_edges[creative_edge]["attributes"][0]["value"][0]]["edges"][0]
+    chain_nodes, chain_edges, chain_auxgraphs = set(), set(), set()
+    for _ in range(2000):
+        subject, object = kg_edges[support_edge]["subject"], kg_edges[support_edge]["object"]
+        auxgraph = add_two_hop(message, chain_edges, chain_nodes, chain_auxgraphs, subject, object)
+        chain_auxgraphs.add(auxgraph)
+        add_support_graph_to_edge(message, auxgraph, support_edge)
+        support_edge = message["auxiliary_graphs"][auxgraph]["edges"][1]
+    # and the bottom of the chain is supported by the top
+    add_support_graph_to_edge(message, kg_edges[creative_edge]["attributes"][0]["value"][0], support_edge)
+    message["results"] = message["results"][:1]
+    response = {"message": message}
+    response, status = await filter_kgraph_orphans(response, {}, "")
+    assert status == 200
+    m = response["message"]
+    assert set(m["knowledge_graph"]["nodes"]) == result_nodes | chain_nodes | {"MONDO:1234"}
+    assert set(m["knowledge_graph"]["edges"]) == result_edges | chain_edges
+    assert set(m["auxiliary_graphs"]) >= chain_auxgraphs
+    assert not set(m["auxiliary_graphs"]) & orphan_auxgraphs
+
+
+@pytest.mark.asyncio
+async def test_deorphaning_missing_references():
+    """References to edges and aux graphs that aren't there are skipped, and everything else is still kept."""
+    message = create_message()
+    result_nodes, result_edges, _ = add_result(message)
+    analysis = message["results"][0]["analyses"][0]
+    analysis["edge_bindings"]["e"].append({"id": "missing_edge", "attributes": []})
+    creative_edge = analysis["edge_bindings"]["e"][0]["id"]
+    message["knowledge_graph"]["edges"][creative_edge]["attributes"][0]["value"].insert(0, "missing_auxgraph")
+    response, status = await filter_kgraph_orphans({"message": message}, {}, "")
+    assert status == 200
+    assert set(response["message"]["knowledge_graph"]["edges"]) == result_edges
+    assert set(response["message"]["knowledge_graph"]["nodes"]) == result_nodes | {"MONDO:1234"}
+
+
+@pytest.mark.parametrize("reverse", [True, False])
+@pytest.mark.parametrize("n", [0, 1, 3, 30, 100])
+def test_top_n_results_matches_sort(n, reverse):
+    """Picking the top n gives the same results in the same order as sorting and slicing, ties included"""
+    results = [{"id": i, "analyses": [{"score": (i * 7) % 5 / 4}, {"score": (i * 3) % 4 / 8}]} for i in range(200)]
+    expected = sorted(results, key=lambda x: max([y.get('score', 0) for y in x['analyses']]), reverse=reverse)[:n]
+    assert [r["id"] for r in top_n_results(results, n, reverse)] == [r["id"] for r in expected]
+
+
+@pytest.mark.asyncio
+async def test_filter_message_top_n_zero():
+    message = create_message()
+    for score in [0.3, 0.9]:
+        add_result(message, scores=[score])
+    response, status = await filter_message_top_n({"message": message}, {"max_results": 0}, "")
+    assert status == 200
+    assert response["message"]["results"] == []
+
+
+@pytest.mark.asyncio
+async def test_filter_message_top_n():
+    """Only the best max_results results are kept, best first, along with their part of the knowledge graph"""
+    message = create_message()
+    scores = [0.3, 0.9, 0.1, 0.9, 0.5]
+    result_nodes = [add_result(message, scores=[score])[0] for score in scores]
+    response, status = await filter_message_top_n({"message": message}, {"max_results": 3}, "")
+    assert status == 200
+    ids = [r["node_bindings"]["output"][0]["id"] for r in response["message"]["results"]]
+    # ties stay in their original order
+    assert ids[0] in result_nodes[1]
+    assert ids[1] in result_nodes[3]
+    assert ids[2] in result_nodes[4]
+    for i in [0, 2]:
+        assert not result_nodes[i] & set(response["message"]["knowledge_graph"]["nodes"])
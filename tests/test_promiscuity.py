@@ -1,9 +1,8 @@
 import pytest
 
-from src.service_aggregator import get_promiscuous_qnodes
+from src.service_aggregator import filter_promiscuous_results, find_promiscuous_qnodes, get_promiscuous_qnodes
 
-@pytest.mark.asyncio
-async def test_qgraph():
+def test_qgraph():
     test_graph = {
         "message": {
             "query_graph": {
@@ -61,5 +60,54 @@ async def test_qgraph():
             }
         }
     }
-    better_be_f = await get_promiscuous_qnodes(test_graph)
-    assert better_be_f == ["f"]
\ No newline at end of file
+    better_be_f = get_promiscuous_qnodes(test_graph)
+    assert better_be_f == ["f"]
+
+def rule_response(bound_knodes):
+    """A response to the A<-treats-B-part_of->C<-part_of-D rule, with a result for each list of knodes bound to C"""
+    qgraph = {
+        "nodes": {"a": {}, "b": {}, "c": {}, "d": {}},
+        "edges": {
+            "treats": {"subject": "b", "object": "a", "predicates": ["biolink:treats"]},
+            "part_of_1": {"subject": "b", "object": "c", "predicates": ["biolink:part_of"]},
+            "part_of_2": {"subject": "d", "object": "c", "predicates": ["biolink:part_of"]},
+        },
+    }
+    results = [{"node_bindings": {"a": [{"id": "MONDO:1"}], "b": [{"id": f"CHEBI:{i}"}], "c": [{"id": knode} for knode in knodes],
+                                  "d": [{"id": f"CHEBI:d{i}"}]}, "analyses": []}
+               for i, knodes in enumerate(bound_knodes)]
+    return {"message": {"query_graph": qgraph, "results": results}}
+
+
+def result_ids(response):
+    return [result["node_bindings"]["b"][0]["id"] for result in response["message"]["results"]]
+
+
+def test_filter_promiscuous_results():
+    """Results whose C is bound in more than 10 results go, the rest stay in order"""
+    bound = [["GO:hub"]] * 11 + [["GO:ok"]] * 10 + [["GO:rare"]]
+    bound = [bound[(i * 7) % len(bound)] for i in range(len(bound))]
+    response = rule_response(bound)
+    expected = [f"CHEBI:{i}" for i, knodes in enumerate(bound) if knodes != ["GO:hub"]]
+    filter_promiscuous_results(response, "guid")
+    assert result_ids(response) == expected
+
+
+def test_filter_promiscuous_results_multiple_bindings():
+    """Removing the results of the most common C can bring another C under the limit"""
+    # GO:hub is in 12 results, and GO:other in 11, but 2 of those are also GO:hub's
+    bound = [["GO:hub", "GO:other"]] * 2 + [["GO:hub"]] * 10 + [["GO:other"]] * 9 + [["GO:third"]] * 11
+    response = rule_response(bound)
+    filter_promiscuous_results(response, "guid")
+    assert result_ids(response) == [f"CHEBI:{i}" for i in range(12, 21)]
+
+
+def test_promiscuous_qnodes_memoized():
+    response = rule_response([])
+    assert get_promiscuous_qnodes(response) == ["c"]
+    # the same shape, with other qedge ids
+    edges = response["message"]["query_graph"]["edges"]
+    response["message"]["query_graph"]["edges"] = {f"e{i}": qedge for i, qedge in enumerate(edges.values())}
+    hits = find_promiscuous_qnodes.cache_info().hits
+    assert get_promiscuous_qnodes(response) == ["c"]
+    assert find_promiscuous_qnodes.cache_info().hits == hits + 1
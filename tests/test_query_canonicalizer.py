@@ -0,0 +1,65 @@
+from src.query_canonicalizer import canonicalize_query_graph, invert, relabel_message
+from src.service_aggregator import queries_equivalent
+
+
+def one_hop(disease="disease", chemical="chemical", edge="treats", **extras):
+    return {
+        "nodes": {
+            disease: {"ids": ["MONDO:0005148", "MONDO:0004975"], "categories": ["biolink:Disease"], "is_set": False},
+            chemical: {"categories": ["biolink:ChemicalEntity"], "constraints": []},
+        },
+        "edges": {
+            edge: dict({"subject": chemical, "object": disease, "predicates": ["biolink:treats"]}, **extras),
+        },
+    }
+
+
+def test_same_question_same_canonical_graph():
+    canonical = canonicalize_query_graph(one_hop())
+    renamed = one_hop("on", "sn", "t_edge", attribute_constraints=[], qualifier_constraints=None, knowledge_type="lookup")
+    renamed["nodes"]["on"]["ids"].reverse()
+    del renamed["nodes"]["on"]["is_set"]
+    assert canonicalize_query_graph(renamed).query_graph == canonical.query_graph
+    assert canonical.query_graph["edges"]["e0"]["subject"] == canonical.node_ids["chemical"]
+    assert canonical.query_graph["nodes"][canonical.node_ids["disease"]]["ids"] == ["MONDO:0004975", "MONDO:0005148"]
+
+
+def test_different_questions_differ():
+    inferred = one_hop(knowledge_type="inferred")
+    assert canonicalize_query_graph(inferred).query_graph != canonicalize_query_graph(one_hop()).query_graph
+    reversed_edge = one_hop()
+    reversed_edge["edges"]["treats"].update(subject="disease", object="chemical")
+    assert canonicalize_query_graph(reversed_edge).query_graph != canonicalize_query_graph(one_hop()).query_graph
+
+
+def test_symmetric_graph():
+    # the two ends are interchangeable, whichever is listed first they come out the same
+    def two_hop(a, b):
+        return {
+            "nodes": {a: {"categories": ["biolink:Gene"]}, "mid": {"ids": ["CHEBI:1"]}, b: {"categories": ["biolink:Gene"]}},
+            "edges": {"x": {"subject": a, "object": "mid"}, "y": {"subject": b, "object": "mid"}},
+        }
+
+    assert canonicalize_query_graph(two_hop("a", "b")).query_graph == canonicalize_query_graph(two_hop("b", "a")).query_graph
+
+
+def test_relabel_round_trip():
+    query_graph = one_hop()
+    canonical = canonicalize_query_graph(query_graph)
+    message = {
+        "query_graph": query_graph,
+        "knowledge_graph": {"nodes": {}, "edges": {}},
+        "results": [{"node_bindings": {"disease": [{"id": "MONDO:0005148"}], "chemical": [{"id": "CHEBI:1"}]},
+                     "analyses": [{"resource_id": "infores:aragorn", "edge_bindings": {"treats": [{"id": "e1"}]}}]}],
+    }
+    stored = relabel_message(message, canonical.query_graph, canonical.node_ids, canonical.edge_ids)
+    assert set(stored["results"][0]["node_bindings"]) == {"n0", "n1"}
+    assert set(stored["results"][0]["analyses"][0]["edge_bindings"]) == {"e0"}
+    # the original is untouched
+    assert set(message["results"][0]["node_bindings"]) == {"disease", "chemical"}
+    assert relabel_message(stored, query_graph, invert(canonical.node_ids), invert(canonical.edge_ids)) == message
+
+
+def test_queries_equivalent():
+    assert queries_equivalent(one_hop(), one_hop(attribute_constraints=[], qualifier_constraints=[]))
+    assert not queries_equivalent(one_hop(), one_hop("on"))
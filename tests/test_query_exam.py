@@ -1,5 +1,5 @@
 import pytest
-from src.service_aggregator import create_aux_graph, add_knowledge_edge, merge_results_by_node, filter_repeated_nodes
+from src.service_aggregator import create_aux_graph, add_knowledge_edge, merge_results_by_node, filter_repeated_nodes, binding_key
 from reasoner_pydantic.results import Analysis, EdgeBinding, Result, NodeBinding
 from reasoner_pydantic.auxgraphs import AuxiliaryGraph
 from reasoner_pydantic.message import Response
@@ -134,8 +134,7 @@ def create_3hop_query () -> Response:
     return pydantic_message
 
 
-@pytest.mark.asyncio
-async def test_filter_repeats():
+def test_filter_repeats():
     """Create a 3 hop query with 2 results.  One of them is 4 separate nodes, the other has 2 nodes that are the same.
     Make sure that the result with the repeated node is filtered out, along with its nodes and edges."""
     message = create_3hop_query().dict(exclude_none=True)
@@ -155,7 +154,7 @@ async def test_filter_repeats():
         message["message"]["knowledge_graph"]["nodes"][node_id] = {}
     for edge_id in ["keep:0", "keep:1", "keep:2", "remove:0", "remove:1"]:
         message["message"]["knowledge_graph"]["edges"][edge_id] = {}
-    await filter_repeated_nodes(message, "guid")
+    filter_repeated_nodes(message, "guid")
     assert len(message["message"]["results"]) == 1
     assert len(message["message"]["knowledge_graph"]["nodes"]) == 4
     assert len(message["message"]["knowledge_graph"]["edges"]) == 3
@@ -166,8 +165,12 @@ def test_create_aux_graph():
     eb2 = EdgeBinding(id = 'eb2', attributes=[])
     analysis = Analysis(resource_id = "example.com", edge_bindings = {"qedge1":[eb1], "qedge2":[eb2]})
     agid, aux_graph = create_aux_graph(analysis.to_dict())
-    assert len(agid) == 36
     assert aux_graph["edges"] == ["eb1", "eb2"]
+    # The id comes from the set of edges, whatever they're bound to
+    reordered = Analysis(resource_id = "example.com", edge_bindings = {"qedge3":[eb2], "qedge1":[eb1]})
+    assert create_aux_graph(reordered.to_dict())[0] == agid
+    other = Analysis(resource_id = "example.com", edge_bindings = {"qedge1":[eb1]})
+    assert create_aux_graph(other.to_dict())[0] != agid
     #Make sure that we can parse the aux graph
     axg = AuxiliaryGraph.parse_obj(aux_graph)
 
@@ -204,3 +207,78 @@ def test_add_knowledge_edge():
         ]
     #Does it validate?
     check_message = Response.parse_obj(result_message)
+
+def test_merge_answer_deterministic():
+    """Merging the same results gives the same message every time, and node bindings that differ only in their
+    attributes are both kept."""
+    def merged():
+        result_message = create_result_graph().to_dict()
+        answer = "PUBCHEM.COMPOUND:789"
+        result1 = create_result({"input":"MONDO:1234", "output":answer, "node2": "curie:3"}, {"g":"KEDGE:1", "f":"KEDGE:2"}).to_dict()
+        result2 = create_result({"input":"MONDO:1234", "output":answer, "nodeX": "curie:8"}, {"q":"KEDGE:4", "z":"KEDGE:8"}).to_dict()
+        result2["node_bindings"]["input"][0]["attributes"] = [{"attribute_type_id": "biolink:xref", "value": ["MESH:1"]}]
+        for kedge_id, subject, object in [("KEDGE:1", "MONDO:1234", "curie:3"), ("KEDGE:2", "curie:3", answer),
+                                          ("KEDGE:4", "MONDO:1234", "curie:8"), ("KEDGE:8", "curie:8", answer)]:
+            result_message["message"]["knowledge_graph"]["edges"][kedge_id] = create_pretend_knowledge_edge(subject, object, "biolink:related_to", "infores:kp1")
+        result_message["message"]["results"] = [result1, result2]
+        return merge_results_by_node(result_message, "output", [])
+    first = merged()
+    assert first == merged()
+    assert len(first["message"]["results"][0]["node_bindings"]["input"]) == 2
+    assert len(first["message"]["results"][0]["node_bindings"]["output"]) == 1
+    Response.parse_obj(first)
+
+def test_merge_answer_shared_support_graphs():
+    """Analyses with the same edges share an aux graph, and the inferred edge ids don't change between runs"""
+    result_message = create_result_graph().to_dict()
+    answer = "PUBCHEM.COMPOUND:789"
+    # two rules that found the same path, one of which also found another
+    result1 = create_result({"input":"MONDO:1234", "output":answer, "node2": "curie:3"}, {"g":"KEDGE:1", "f":"KEDGE:2"}).to_dict()
+    result2 = create_result({"input":"MONDO:1234", "output":answer, "node2": "curie:3"}, {"f":"KEDGE:1", "g":"KEDGE:2"}).to_dict()
+    result2["analyses"].append(create_result({}, {"q":"KEDGE:4", "z":"KEDGE:8"}).to_dict()["analyses"][0])
+    for kedge_id, subject, object in [("KEDGE:1", "MONDO:1234", "curie:3"), ("KEDGE:2", "curie:3", answer),
+                                      ("KEDGE:4", "MONDO:1234", "curie:8"), ("KEDGE:8", "curie:8", answer)]:
+        result_message["message"]["knowledge_graph"]["edges"][kedge_id] = create_pretend_knowledge_edge(subject, object, "biolink:related_to", "infores:kp1")
+    result_message["message"]["results"] = [result1, result2]
+    merge_results_by_node(result_message, "output", [])
+    assert len(result_message["message"]["auxiliary_graphs"]) == 2
+    kedge_id = result_message["message"]["results"][0]["analyses"][0]["edge_bindings"]["e"][0]["id"]
+    kedge = result_message["message"]["knowledge_graph"]["edges"][kedge_id]
+    assert kedge["attributes"][0]["value"] == list(result_message["message"]["auxiliary_graphs"])
+    other_message = create_result_graph().to_dict()
+    add_knowledge_edge(other_message, ["ag1"], answer, False)
+    assert list(other_message["message"]["knowledge_graph"]["edges"]) == [kedge_id]
+    Response.parse_obj(result_message)
+
+def test_merge_answer_overlapping_answer_groups():
+    """When one result binds the answer node to A and another to A and B, they're different answer groups that share
+    the inferred edge to A.  That edge is supported by both groups' aux graphs."""
+    result_message = create_result_graph().to_dict()
+    result1 = create_result({"input":"MONDO:1234", "output":"CHEBI:A", "node2": "curie:3"}, {"g":"k1"}).to_dict()
+    result2 = create_result({"input":"MONDO:1234", "output":"CHEBI:A", "node2": "curie:8"}, {"g":"k2"}).to_dict()
+    result2["node_bindings"]["output"].append({"id": "CHEBI:B", "attributes": []})
+    for kedge_id in ["k1", "k2"]:
+        result_message["message"]["knowledge_graph"]["edges"][kedge_id] = create_pretend_knowledge_edge("MONDO:1234", "curie:3", "biolink:related_to", "infores:kp1")
+    result_message["message"]["results"] = [result1, result2]
+    merge_results_by_node(result_message, "output", [])
+    assert len(result_message["message"]["results"]) == 2
+    auxiliary_graphs = result_message["message"]["auxiliary_graphs"]
+    kg_edges = result_message["message"]["knowledge_graph"]["edges"]
+    support = {}
+    for result in result_message["message"]["results"]:
+        for binding in result["analyses"][0]["edge_bindings"]["e"]:
+            kedge = kg_edges[binding["id"]]
+            support[kedge["subject"]] = [set(auxiliary_graphs[ag]["edges"]) for ag in kedge["attributes"][0]["value"]]
+    assert support["CHEBI:A"] == [{"k1"}, {"k2"}]
+    assert support["CHEBI:B"] == [{"k2"}]
+    Response.parse_obj(result_message)
+
+
+def test_binding_key():
+    plain = {"id": "MONDO:1", "attributes": []}
+    assert binding_key(plain) == "MONDO:1"
+    # null fields don't make a binding different, as in the knowledge graph merge
+    assert binding_key({"id": "MONDO:1", "attributes": [], "query_id": None}) == binding_key(plain)
+    assert binding_key({"id": "MONDO:1", "attributes": [], "query_id": "MONDO:2"}) != binding_key(plain)
+    attributes = [{"attribute_type_id": "biolink:score", "value": 1}]
+    assert binding_key({"id": "MONDO:1", "attributes": attributes}) == binding_key({"attributes": attributes, "id": "MONDO:1"})
@@ -1,5 +1,6 @@
 import pytest
-from src.service_aggregator import examine_query
+from copy import deepcopy
+from src.service_aggregator import examine_query, combine_messages, ResponseMerger
 
 
 def test_query_examination():
@@ -74,4 +75,89 @@ def test_query_examination_pathfinder():
     }
     inferred, qnode, anode, pathfinder = examine_query(query)
     assert not inferred
-    assert pathfinder
\ No newline at end of file
+    assert pathfinder
+
+def make_edge(subject, object, predicate="biolink:related_to"):
+    return {"subject": subject, "object": object, "predicate": predicate, "attributes": [],
+            "sources": [{"resource_id": "infores:madeup", "resource_role": "primary_knowledge_source"}]}
+
+
+def make_node(category="biolink:NamedThing"):
+    return {"categories": [category], "attributes": []}
+
+
+def make_rule_responses():
+    """A lookup response with a single direct treats edge, and a two hop rule response with three results."""
+    lookup_query_graph = {
+        "nodes": {"disease": {"ids": ["MONDO:0008029"]}, "chemical": {"categories": ["biolink:ChemicalEntity"]}},
+        "edges": {"t_edge": {"subject": "chemical", "object": "disease", "predicates": ["biolink:treats"]}},
+    }
+    lookup_response = {"message": {
+        "query_graph": lookup_query_graph,
+        "knowledge_graph": {"nodes": {"MONDO:0008029": make_node("biolink:Disease"), "CHEBI:1": make_node("biolink:ChemicalEntity")},
+                            "edges": {"direct": make_edge("CHEBI:1", "MONDO:0008029", "biolink:treats")}},
+        "results": [{"node_bindings": {"disease": [{"id": "MONDO:0008029", "attributes": []}], "chemical": [{"id": "CHEBI:1", "attributes": []}]},
+                     "analyses": [{"resource_id": "infores:strider", "edge_bindings": {"t_edge": [{"id": "direct", "attributes": []}]}}]}],
+    }}
+    rule_query_graph = {
+        "nodes": {"disease": {"ids": ["MONDO:0008029"]}, "chemical": {"categories": ["biolink:ChemicalEntity"]}, "i": {"categories": ["biolink:Gene"]}},
+        "edges": {"e0": {"subject": "chemical", "object": "i", "predicates": ["biolink:affects"]},
+                  "e1": {"subject": "i", "object": "disease", "predicates": ["biolink:gene_associated_with_condition"]}},
+    }
+    rule_kg = {"nodes": {"MONDO:0008029": make_node("biolink:Disease"), "CHEBI:1": make_node("biolink:ChemicalEntity"),
+                         "CHEBI:2": make_node("biolink:ChemicalEntity"), "NCBIGene:1": make_node("biolink:Gene"), "NCBIGene:2": make_node("biolink:Gene")},
+               "edges": {}}
+    rule_results = []
+    for chem, gene in [("CHEBI:1", "NCBIGene:1"), ("CHEBI:1", "NCBIGene:2"), ("CHEBI:2", "NCBIGene:1")]:
+        e0, e1 = f"{chem}-{gene}", f"{gene}-MONDO"
+        rule_kg["edges"][e0] = make_edge(chem, gene, "biolink:affects")
+        rule_kg["edges"][e1] = make_edge(gene, "MONDO:0008029", "biolink:gene_associated_with_condition")
+        rule_results.append({
+            "node_bindings": {"disease": [{"id": "MONDO:0008029", "attributes": []}], "chemical": [{"id": chem, "attributes": []}], "i": [{"id": gene, "attributes": []}]},
+            "analyses": [{"resource_id": "infores:strider", "edge_bindings": {"e0": [{"id": e0, "attributes": []}], "e1": [{"id": e1, "attributes": []}]}}]})
+    rule_response = {"message": {"query_graph": rule_query_graph, "knowledge_graph": rule_kg, "results": rule_results}}
+    original_query_graph = deepcopy(lookup_query_graph)
+    original_query_graph["edges"]["t_edge"]["knowledge_type"] = "inferred"
+    return original_query_graph, lookup_query_graph, [rule_response, lookup_response]
+
+
+def check_merged(merged):
+    results = merged["message"]["results"]
+    assert len(results) == 2
+    by_chem = {r["node_bindings"]["chemical"][0]["id"]: r for r in results}
+    assert set(by_chem) == {"CHEBI:1", "CHEBI:2"}
+    for r in results:
+        assert set(r["node_bindings"]) == {"disease", "chemical"}
+        assert len(r["analyses"]) == 1
+    # CHEBI:1 has one inferred edge supported by two aux graphs, plus the direct lookup edge
+    c1_bindings = [b["id"] for b in by_chem["CHEBI:1"]["analyses"][0]["edge_bindings"]["t_edge"]]
+    assert len(c1_bindings) == 2
+    assert "direct" in c1_bindings
+    inferred = [merged["message"]["knowledge_graph"]["edges"][b] for b in c1_bindings if b != "direct"][0]
+    assert inferred["subject"] == "CHEBI:1"
+    assert inferred["object"] == "MONDO:0008029"
+    assert inferred["predicate"] == "biolink:treats"
+    support = [a for a in inferred["attributes"] if a["attribute_type_id"] == "biolink:support_graphs"][0]["value"]
+    assert len(support) == 2
+    for aux_graph_id in support:
+        assert len(merged["message"]["auxiliary_graphs"][aux_graph_id]["edges"]) == 2
+    assert len(merged["message"]["auxiliary_graphs"]) == 3
+    # 5 distinct rule edges (one is shared), the lookup edge and the two inferred edges
+    assert len(merged["message"]["knowledge_graph"]["edges"]) == 5 + 1 + 2
+
+
+@pytest.mark.asyncio
+async def test_combine_messages():
+    original_query_graph, lookup_query_graph, responses = make_rule_responses()
+    merged = await combine_messages("chemical", original_query_graph, lookup_query_graph, responses)
+    assert merged["message"]["query_graph"] == original_query_graph
+    check_merged(merged)
+
+
+def test_response_merger_order_independent():
+    """Responses come off the callback queue in any order; the lookup response may come first."""
+    original_query_graph, lookup_query_graph, responses = make_rule_responses()
+    merger = ResponseMerger("chemical", original_query_graph, lookup_query_graph)
+    for response in reversed(responses):
+        merger.add(response)
+    check_merged(merger.finish())
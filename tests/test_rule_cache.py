@@ -0,0 +1,97 @@
+import pytest
+import redis.asyncio
+
+from src import service_aggregator
+from src.results_cache import flush_cache_writes
+from src.rule_cache import RuleCache, encode_rule_response
+from src.service_aggregator import aragorn_lookup
+from tests.helpers.redisMock import redisMock
+
+
+def infer_query():
+    return {
+        "message": {
+            "query_graph": {
+                "nodes": {"disease": {"ids": ["MONDO:0011399"]}, "chemical": {"categories": ["biolink:ChemicalEntity"]}},
+                "edges": {"t_edge": {"object": "disease", "subject": "chemical", "predicates": ["biolink:treats"], "knowledge_type": "inferred"}},
+            }
+        }
+    }
+
+
+def rule_response(query_graph):
+    return {
+        "message": {
+            "query_graph": query_graph,
+            "knowledge_graph": {"nodes": {"CHEBI:1": {"name": "chem"}}, "edges": {}},
+            "results": [{"node_bindings": {qnode_id: [{"id": "CHEBI:1"}] for qnode_id in query_graph["nodes"]},
+                         "analyses": [{"resource_id": "infores:kg", "edge_bindings": {qedge_id: [] for qedge_id in query_graph["edges"]}}]}],
+        }
+    }
+
+
+@pytest.mark.asyncio
+async def test_rule_cache_round_trip(monkeypatch):
+    monkeypatch.setattr(redis.asyncio, "StrictRedis", redisMock)
+    cache = RuleCache("strider", redis_db="14")
+    query = {"message": {"query_graph": infer_query()["message"]["query_graph"]}}
+    renamed = {"message": {"query_graph": {
+        "nodes": {"d": {"ids": ["MONDO:0011399"]}, "c": {"categories": ["biolink:ChemicalEntity"]}},
+        "edges": {"e": {"object": "d", "subject": "c", "predicates": ["biolink:treats"], "knowledge_type": "inferred"}},
+    }}}
+    assert await cache.get_responses([query, renamed]) == [None, None]
+    rule_key = cache.get_key(query)
+    assert rule_key.key == cache.get_key(renamed).key
+    await cache.set_response_in_background(rule_key, encode_rule_response(rule_response(query["message"]["query_graph"]), rule_key))
+    hit, renamed_hit = await cache.get_responses([query, renamed])
+    assert hit == rule_response(query["message"]["query_graph"])
+    assert renamed_hit == rule_response(renamed["message"]["query_graph"])
+
+
+@pytest.mark.asyncio
+async def test_aragorn_lookup_only_sends_misses(monkeypatch):
+    monkeypatch.setattr(redis.asyncio, "StrictRedis", redisMock)
+    await RuleCache("strider").redis.flushdb()
+    sent = []
+
+    async def fake_multi_strider(messages, params, guid, bypass_cache):
+        for query in messages.values():
+            sent.append(query)
+            yield rule_response(query["message"]["query_graph"])
+
+    monkeypatch.setattr(service_aggregator, "multi_strider", fake_multi_strider)
+    first, status = await aragorn_lookup(infer_query(), {}, "guid1", True, False, "chemical", False)
+    await flush_cache_writes()
+    n_rules = len(sent)
+    assert status == 200 and n_rules > 15
+    second, status = await aragorn_lookup(infer_query(), {}, "guid2", True, False, "chemical", False)
+    assert len(sent) == n_rules
+    assert second["message"]["results"] == first["message"]["results"]
+    # a bypass or an overwrite gets new responses from strider, and the overwrite writes them back
+    await aragorn_lookup(infer_query(), {}, "guid3", True, False, "chemical", True)
+    assert len(sent) == 2 * n_rules
+    await aragorn_lookup(infer_query(), {}, "guid4", True, False, "chemical", False, True)
+    assert len(sent) == 3 * n_rules
+
+
+@pytest.mark.asyncio
+async def test_robokop_infer_skips_rule_cache_on_overwrite(monkeypatch):
+    monkeypatch.setattr(redis.asyncio, "StrictRedis", redisMock)
+    read = []
+
+    async def get_responses(self, rules, guid=""):
+        read.append(len(rules))
+        return [None] * len(rules)
+
+    async def make_one_request(client, automat_url, message, sem):
+        raise ConnectionError("automat is down")
+
+    monkeypatch.setattr(RuleCache, "get_responses", get_responses)
+    monkeypatch.setattr(service_aggregator, "make_one_request", make_one_request)
+    for bypass_cache, overwrite_cache in [(True, False), (False, True)]:
+        with pytest.raises(ConnectionError):
+            await service_aggregator.robokop_infer(infer_query(), "guid", "disease", "chemical", bypass_cache, overwrite_cache)
+    assert read == []
+    with pytest.raises(ConnectionError):
+        await service_aggregator.robokop_infer(infer_query(), "guid", "disease", "chemical")
+    assert len(read) == 1
@@ -0,0 +1,116 @@
+import asyncio
+
+import pytest
+
+from src import single_flight
+from src.single_flight import lock_name, run_once
+from tests.helpers.redisMock import redisMock
+
+
+@pytest.mark.asyncio
+async def test_identical_queries_run_once():
+    calls = []
+
+    async def compute():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        return {"answer": 42}
+
+    flights = await asyncio.gather(*(run_once("key", compute) for _ in range(5)))
+    assert len(calls) == 1
+    assert [flight.leader for flight in flights].count(True) == 1
+    assert all(flight.result is flights[0].result for flight in flights)
+    # once it's done, the next one runs again
+    assert (await run_once("key", compute)).leader
+    assert len(calls) == 2
+
+
+@pytest.mark.asyncio
+async def test_failed_leader():
+    calls = []
+
+    async def failing():
+        calls.append("failing")
+        await asyncio.sleep(0.05)
+        raise ValueError("strider is down")
+
+    async def compute():
+        calls.append("compute")
+        return "answer"
+
+    first = asyncio.create_task(run_once("key", failing))
+    await asyncio.sleep(0)
+    second = await run_once("key", compute)
+    with pytest.raises(ValueError):
+        await first
+    # the waiting copy ran it itself
+    assert second == ("answer", True)
+    assert calls == ["failing", "compute"]
+
+
+@pytest.mark.asyncio
+async def test_waits_for_other_worker(monkeypatch):
+    monkeypatch.setattr(single_flight, "SINGLE_FLIGHT_WAIT", 10)
+    redis_client = redisMock()
+    await redis_client.set(lock_name("key"), "another worker")
+    cache = {}
+
+    async def compute():
+        raise AssertionError("should have used the other worker's answer")
+
+    async def read_result():
+        return cache.get("key")
+
+    waiting = asyncio.create_task(run_once("key", compute, redis_client, read_result))
+    await asyncio.sleep(0.1)
+    assert not waiting.done()
+    # the other worker finishes
+    cache["key"] = "answer"
+    await redis_client.delete(lock_name("key"))
+    await redis_client.publish(lock_name("key"), "done")
+    assert await asyncio.wait_for(waiting, 5) == ("answer", False)
+
+
+@pytest.mark.asyncio
+async def test_lock_released_after_write():
+    redis_client = redisMock()
+    await redis_client.delete(lock_name("key"))
+    written = asyncio.Event()
+
+    async def compute():
+        assert await redis_client.exists(lock_name("key"))
+        return "answer"
+
+    async def before_release():
+        await written.wait()
+
+    assert await run_once("key", compute, redis_client, before_release=before_release) == ("answer", True)
+    assert await redis_client.exists(lock_name("key"))
+    written.set()
+    await asyncio.gather(*single_flight._releases)
+    assert not await redis_client.exists(lock_name("key"))
+
+
+@pytest.mark.asyncio
+async def test_failed_leader_is_replaced_once():
+    calls = []
+
+    async def failing():
+        calls.append("failing")
+        await asyncio.sleep(0.05)
+        raise ValueError("strider is down")
+
+    async def compute():
+        calls.append("compute")
+        await asyncio.sleep(0.05)
+        return "answer"
+
+    first = asyncio.create_task(run_once("key", failing))
+    await asyncio.sleep(0)
+    flights = await asyncio.gather(*(run_once("key", compute) for _ in range(5)))
+    with pytest.raises(ValueError):
+        await first
+    # only one of the waiting copies took over, the rest shared its answer
+    assert calls == ["failing", "compute"]
+    assert [flight.leader for flight in flights].count(True) == 1
+    assert all(flight.result == "answer" for flight in flights)
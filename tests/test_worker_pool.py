@@ -0,0 +1,64 @@
+import asyncio
+import copy
+import time
+import pytest
+from src import worker_pool
+from src.service_aggregator import clean_rule_response
+
+
+def rule_response():
+    """A rule response where chemical and e are both bound to the same node in one of the results."""
+    def result(chemical, e):
+        return {"node_bindings": {"disease": [{"id": "MONDO:1", "attributes": None}], "chemical": [{"id": chemical}], "e": [{"id": e}]},
+                "analyses": [{"resource_id": "infores:aragorn", "edge_bindings": {"edge_0": [{"id": f"{chemical}-{e}"}]}}]}
+    return {
+        "message": {
+            "query_graph": {"nodes": {"disease": {"ids": ["MONDO:1"]}, "chemical": {}, "e": {}},
+                            "edges": {"edge_0": {"subject": "chemical", "object": "e", "predicates": ["biolink:related_to"]}}},
+            "knowledge_graph": {"nodes": {n: {"name": None} for n in ["MONDO:1", "CHEBI:1", "CHEBI:2", "CHEBI:3"]},
+                                "edges": {"CHEBI:1-CHEBI:2": {"subject": "CHEBI:1", "object": "CHEBI:2"},
+                                          "CHEBI:3-CHEBI:3": {"subject": "CHEBI:3", "object": "CHEBI:3"}}},
+            "results": [result("CHEBI:1", "CHEBI:2"), result("CHEBI:3", "CHEBI:3")],
+            "auxiliary_graphs": None,
+        }
+    }
+
+
+@pytest.fixture
+def pool(monkeypatch, request):
+    monkeypatch.setattr(worker_pool, "WORKER_POOL", request.param)
+    yield request.param
+    worker_pool.shutdown_worker_pool()
+
+
+@pytest.mark.parametrize("pool", ["none", "thread", "process"], indirect=True)
+@pytest.mark.asyncio
+async def test_clean_rule_response_in_pool(pool):
+    expected = clean_rule_response(rule_response(), "guid")
+    assert len(expected["message"]["results"]) == 1
+    assert "CHEBI:3" not in expected["message"]["knowledge_graph"]["nodes"]
+    assert "name" not in expected["message"]["knowledge_graph"]["nodes"]["MONDO:1"]
+    assert await worker_pool.run_cpu_bound(clean_rule_response, rule_response(), "guid") == expected
+
+
+@pytest.mark.parametrize("pool", ["thread"], indirect=True)
+@pytest.mark.asyncio
+async def test_event_loop_stays_responsive(pool):
+    """A long stage in the pool doesn't stop other coroutines from running."""
+    ticks = []
+
+    async def ticker():
+        while True:
+            ticks.append(time.monotonic())
+            await asyncio.sleep(0.01)
+
+    ticking = asyncio.create_task(ticker())
+    await worker_pool.run_cpu_bound(time.sleep, 0.5)
+    ticking.cancel()
+    assert len(ticks) > 10
+
+
+def test_unknown_pool(monkeypatch):
+    monkeypatch.setattr(worker_pool, "WORKER_POOL", "fibers")
+    with pytest.raises(ValueError):
+        worker_pool.get_executor()
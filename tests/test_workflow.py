@@ -1,6 +1,6 @@
 import pytest
 from fastapi.testclient import TestClient
-import redis
+import redis.asyncio
 from src.server import APP as APP
 from src import operations
 import os
@@ -14,7 +14,7 @@ client = TestClient(APP)
 jsondir = 'InputJson_1.2'
 
 def test_bad_ops(monkeypatch):
-    monkeypatch.setattr(redis, "StrictRedis", redisMock)
+    monkeypatch.setattr(redis.asyncio, "StrictRedis", redisMock)
     # get the location of the test file
     dir_path: str = os.path.dirname(os.path.realpath(__file__))
     test_filename = os.path.join(dir_path, jsondir, 'workflow_422.json')
@@ -30,7 +30,7 @@ def test_bad_ops(monkeypatch):
 
 def test_lookup_only(monkeypatch):
     """This has a workflow with a single op (lookup).  So the result should not have scores"""
-    monkeypatch.setattr(redis, "StrictRedis", redisMock)
+    monkeypatch.setattr(redis.asyncio, "StrictRedis", redisMock)
     init_db()
     dir_path: str = os.path.dirname(os.path.realpath(__file__))
     test_filename = os.path.join(dir_path, jsondir, 'workflow_200.json')